@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""Assemble HAF-pipe .afSite files into a sites x samples afmat, streaming.
+
+Replaces the rbind/spread of Get_tp_RData_Downsampled.R and the right_join
+of JoinTpRData_downsampled.R. Files are named like HAFpipe_wrapper.sh writes
+them, `<sample>.bam.<chrom>.afSite`, with (at least) `pos` and `af` columns.
+
+1. The site index is the sorted union of positions per arm; it is read from
+   `--sites` (chrom, pos) when given, otherwise collected from the `pos`
+   column of every file.
+2. The matrix is pre-allocated as a memory-mapped `.npy` file filled with NaN,
+   and worker processes each read one file and write its frequencies into
+   the sample's column at the positions' rows. Peak memory per worker is
+   about one file.
+3. As with `na.omit` in JoinTpRData_downsampled.R, only sites with a frequency
+   in every sample are kept (`--keep-missing` keeps all); the complete rows
+   are copied block by block into the final `afmat.npy`.
+
+`sites.csv` (chrom, pos, site_idx) and `samps.csv` (sample.name, freq_idx)
+are written alongside, with 1-based indices as in Figure4/01_process_data.R.
+`--samps` merges sample metadata (treatment, cage, tpt, biol.rep, tech.rep,
+...) by sample.name. The matrix is float64 like the one 01 writes (`--dtype
+float32` halves it; 03 and afstore.py read either).
+
+The output directory takes the place of the RData file: 01_process_data.R
+reads it when given as an argument and applies its sample filters (the I
+treatment, cages above 10, biological and technical replicates, timepoints):
+
+    python assemble_afmat.py 04_HAFs_V2/ out/ --samps meta.csv --processes 8
+    Rscript --vanilla 01_process_data.R /path/to/out    # from Figure4/
+"""
+
+import argparse
+import glob
+import os
+import re
+
+import multiprocess as mp
+import numpy as np
+import polars as pl
+
+CHROMS = ["2L", "2R", "3L", "3R", "X"]
+AFSITE = re.compile(r"^(?P<sample>.+)\.bam\.(?P<chrom>[^.]+)\.afSite$")
+
+
+def find_files(haf_dir, tpts=None):
+    """(sample, chrom, path) for every .afSite file, sorted by sample"""
+    files = []
+    for path in glob.glob(os.path.join(haf_dir, "*.afSite")):
+        m = AFSITE.match(os.path.basename(path))
+        if m is None:
+            continue
+        if tpts is not None and not any(
+            m["sample"].startswith(f"tp{t}_") for t in tpts
+        ):
+            continue
+        files.append((m["sample"], m["chrom"], path))
+    return sorted(files)
+
+
+def read_afsite(path, columns=("pos", "af")):
+    return pl.read_csv(
+        path,
+        columns=list(columns),
+        schema_overrides={"pos": pl.UInt32, "af": pl.Float64},
+    )
+
+
+def _positions(path):
+    return read_afsite(path, ["pos"])["pos"].to_numpy()
+
+
+def site_index(files, processes=1, sites=None):
+    """Sorted positions per arm: {chrom: uint32 array}"""
+    if sites is not None:
+        d = pl.read_csv(
+            sites, columns=["chrom", "pos"], schema_overrides={"pos": pl.UInt32}
+        )
+        return {
+            c: np.unique(g["pos"].to_numpy())
+            for (c,), g in d.group_by("chrom", maintain_order=True)
+        }
+
+    index = {}
+    with mp.Pool(processes) as pool:
+        # positions of one file at a time are merged into the arm's index
+        paths = [path for _, _, path in files]
+        for (_, chrom, _), pos in zip(files, pool.imap(_positions, paths)):
+            index[chrom] = np.union1d(index.get(chrom, []), pos).astype(np.uint32)
+    return index
+
+
+_index = {}
+
+
+def _init(index):
+    # the site index is sent to each worker once, not with every file
+    _index.update(index)
+
+
+def _fill(task):
+    # write one file's frequencies into its column of the shared matrix
+    path, col, matrix, chrom, offset = task
+    positions = _index[chrom]
+    afmat = np.load(matrix, mmap_mode="r+")
+    d = read_afsite(path)
+    pos, af = d["pos"].to_numpy(), d["af"].to_numpy()
+    i = np.searchsorted(positions, pos)
+    found = i < len(positions)
+    found[found] = positions[i[found]] == pos[found]
+    rows = offset + i[found]
+    afmat[rows, col] = af[found]
+    afmat.flush()
+    return int(found.sum()), int((~found).sum())
+
+
+def assemble(
+    haf_dir,
+    out,
+    tpts=None,
+    sites=None,
+    processes=1,
+    dtype="float64",
+    keep_missing=False,
+    samps=None,
+    block=100_000,
+):
+    files = find_files(haf_dir, tpts)
+    if not files:
+        raise FileNotFoundError(f"no .afSite files in {haf_dir}")
+    os.makedirs(out, exist_ok=True)
+
+    index = site_index(files, processes, sites)
+    chroms = [c for c in CHROMS if c in index] + sorted(set(index) - set(CHROMS))
+    offsets = np.cumsum([0] + [len(index[c]) for c in chroms])
+    offset = dict(zip(chroms, offsets[:-1].tolist()))
+    n_sites = int(offsets[-1])
+
+    samples = sorted({s for s, _, _ in files})
+    column = {s: j for j, s in enumerate(samples)}
+
+    partial = os.path.join(out, "afmat.partial.npy")
+    afmat = np.lib.format.open_memmap(
+        partial, mode="w+", dtype=dtype, shape=(n_sites, len(samples))
+    )
+    for start in range(0, n_sites, block):
+        afmat[start : start + block] = np.nan
+    afmat.flush()
+    del afmat
+
+    tasks = [
+        (path, column[s], partial, c, offset[c])
+        for s, c, path in files
+        if c in index
+    ]
+    with mp.Pool(processes, initializer=_init, initargs=(index,)) as pool:
+        counts = np.array(pool.map(_fill, tasks, chunksize=1))
+    if counts[:, 1].any():
+        print(f"{counts[:, 1].sum()} positions were not in the site index")
+
+    chrom = np.repeat(chroms, [len(index[c]) for c in chroms])
+    pos = np.concatenate([index[c] for c in chroms])
+
+    # keep complete rows, copying block by block into the final matrix
+    afmat = np.load(partial, mmap_mode="r")
+    if keep_missing:
+        keep = np.ones(n_sites, dtype=bool)
+    else:
+        keep = np.concatenate(
+            [
+                ~np.isnan(afmat[start : start + block]).any(axis=1)
+                for start in range(0, n_sites, block)
+            ]
+        )
+    final = np.lib.format.open_memmap(
+        os.path.join(out, "afmat.npy"),
+        mode="w+",
+        dtype=dtype,
+        shape=(int(keep.sum()), len(samples)),
+    )
+    row = 0
+    for start in range(0, n_sites, block):
+        rows = afmat[start : start + block][keep[start : start + block]]
+        final[row : row + len(rows)] = rows
+        row += len(rows)
+    final.flush()
+    del afmat, final
+    os.remove(partial)
+
+    pl.DataFrame({"chrom": chrom[keep], "pos": pos[keep]}).with_columns(
+        pl.int_range(1, pl.len() + 1).alias("site_idx")
+    ).write_csv(os.path.join(out, "sites.csv"))
+
+    samps_df = pl.DataFrame({"sample.name": samples}).with_columns(
+        pl.int_range(1, pl.len() + 1).alias("freq_idx")
+    )
+    if samps is not None:
+        samps_df = samps_df.join(pl.read_csv(samps), on="sample.name", how="left")
+    samps_df.write_csv(os.path.join(out, "samps.csv"))
+    return int(keep.sum()), n_sites, len(samples)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("haf_dir", help="directory with the .afSite files")
+    parser.add_argument("out", help="directory for afmat.npy, sites.csv, samps.csv")
+    parser.add_argument("--tpts", nargs="+", help="only files starting tp<T>_")
+    parser.add_argument("--sites", help="CSV with chrom, pos: the site index")
+    parser.add_argument("--samps", help="CSV with sample metadata by sample.name")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--dtype", choices=["float32", "float64"], default="float64")
+    parser.add_argument("--keep-missing", action="store_true")
+    args = parser.parse_args()
+
+    kept, n_sites, n_samps = assemble(
+        args.haf_dir,
+        args.out,
+        tpts=args.tpts,
+        sites=args.sites,
+        processes=args.processes,
+        dtype=args.dtype,
+        keep_missing=args.keep_missing,
+        samps=args.samps,
+    )
+    print(f"afmat: {kept} of {n_sites} sites x {n_samps} samples in {args.out}")
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Batch simulator for Ace haplotype frequencies under viability selection.
+
+Haplotypes are IGFG (S), VGFG (R1), VGFA (R2) and VAYG (R3), coded 0-3 as in
+`data/viability.values.simulations.csv`, which holds the viability w_ij of
+every genotype at each malathion concentration. Each generation the
+population is exposed to the concentration given by the treatment schedule
+and, with random mating, haplotype i goes from p_i to
+
+    p_i' = p_i * sum_j w_ij p_j / sum_kl p_k w_kl p_l
+
+optionally followed by Wright-Fisher sampling of 2N haplotypes (drift).
+All parameter sets and replicates are propagated together as arrays:
+viabilities of shape (sets, concs, 4, 4), frequencies of shape
+(sets, replicates, 4). `dominance` builds such parameter sets from the
+measured table by setting the S/R heterozygote viabilities to
+w_SS + h (w_RR - w_SS) for a grid of dominance coefficients h.
+
+    python ace_sim.py --h 0 0.25 0.5 0.75 1 --replicates 200 --pop-size 2000
+
+writes the trajectories (one row per set, replicate, generation and
+haplotype) and the resistance, i.e. mean viability at each concentration,
+to `data/sim_ace_trajectories.parquet` and `data/sim_ace_resistance.parquet`.
+
+This is not the model behind the Figure 3 simulations
+(`Figure3/data/sim_allele_freqs_*_cages.csv`), whose code is not in this
+repository. Even under the all-0 ppm untreated schedule, started from that
+file's t=1, it drifts from the file by up to 0.03 by t=10 (VAYG 0.119 vs
+0.144): fitting the file's untreated steps needs 0 ppm S/R heterozygote
+viabilities of about 0.88, above the 0.834-0.872 in the table. `--check`
+prints the gap against both files.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+HAPLOTYPES = ["IGFG", "VGFG", "VGFA", "VAYG"]
+DATA = os.path.join(os.path.dirname(__file__), "data")
+VIABILITIES = os.path.join(DATA, "viability.values.simulations.csv")
+# the Figure 3 simulations, by schedule
+REFERENCE = os.path.join(
+    os.path.dirname(__file__), "..", "Figure3", "data", "sim_allele_freqs_{}_cages.csv"
+)
+
+# treated-cage haplotype frequencies at t=0 of Figure 3b; the four sum to
+# 0.982 (the rest are other haplotypes), so they are scaled to 1 here, as the
+# first step of the Figure 3 simulations does
+P0_OBSERVED = [0.6314, 0.0601, 0.0923, 0.1983]
+P0 = (np.array(P0_OBSERVED) / sum(P0_OBSERVED)).tolist()
+# concentration (ppm) during each generation t -> t + 1
+SCHEDULES = {
+    "treated": [0, 2.5, 2.5, 2.5, 2.5, 7.5, 0, 0, 0, 0],
+    "untreated": [0] * 10,
+}
+
+
+def read_viabilities(path=VIABILITIES):
+    """Concentrations and the symmetric (concs, 4, 4) viability array"""
+    d = pd.read_csv(path, dtype={"genotypes": str})
+    concs = np.sort(d["conc"].unique())
+    w = np.full((len(concs), 4, 4), np.nan)
+    k = np.searchsorted(concs, d["conc"])
+    i = d["genotypes"].str[0].astype(int).to_numpy()
+    j = d["genotypes"].str[1].astype(int).to_numpy()
+    w[k, i, j] = w[k, j, i] = d["viabilities"].to_numpy()
+    if np.isnan(w).any():
+        raise ValueError(f"{path}: not every genotype has a viability")
+    return concs, w
+
+
+def dominance(w, h):
+    """Parameter sets with S/Rk heterozygotes at w_SS + h (w_RkRk - w_SS)
+
+    h has shape (sets,) for one coefficient shared by R1-R3, or (sets, 3)
+    for one per resistant haplotype; w is (concs, 4, 4).
+    """
+    h = np.asarray(h, dtype=np.float64)
+    h = np.broadcast_to(h[:, None] if h.ndim == 1 else h, (len(h), 3))
+    ws = np.repeat(w[None], len(h), axis=0)
+    for k in range(1, 4):
+        het = w[:, 0, 0] + h[:, k - 1, None] * (w[:, k, k] - w[:, 0, 0])
+        ws[:, :, 0, k] = ws[:, :, k, 0] = het
+    return ws
+
+
+def schedule_index(concs, schedule):
+    # rows of the viability array for each generation of the schedule
+    schedule = np.asarray(schedule, dtype=np.float64)
+    idx = np.searchsorted(concs, schedule)
+    idx = np.minimum(idx, len(concs) - 1)
+    unknown = concs[idx] != schedule
+    if unknown.any():
+        raise ValueError(
+            f"no viabilities for {sorted(set(schedule[unknown]))} ppm, "
+            f"only for {concs.tolist()}"
+        )
+    return idx
+
+
+def select(p, w):
+    # one generation of viability selection with random mating;
+    # p is (..., 4) and w (..., 4, 4)
+    marginal = np.einsum("...ij,...j->...i", w, p)
+    p = p * marginal
+    return p / p.sum(axis=-1, keepdims=True)
+
+
+def drift(p, pop_size, rng):
+    # Wright-Fisher sampling of 2N haplotypes in every replicate
+    counts = rng.multinomial(2 * pop_size, p / p.sum(axis=-1, keepdims=True))
+    return counts / (2 * pop_size)
+
+
+def simulate(w, concs, schedule, p0=P0, replicates=1, pop_size=None, seed=None):
+    """Frequencies of shape (sets, replicates, generations + 1, 4)
+
+    w is (concs, 4, 4) or (sets, concs, 4, 4); p0 is (4,) or (sets, 4) and
+    must sum to 1. Without pop_size the model is deterministic and replicates
+    are copies.
+    """
+    w = np.asarray(w, dtype=np.float64)
+    if w.ndim == 3:
+        w = w[None]
+    n_sets = w.shape[0]
+    p = np.broadcast_to(np.asarray(p0, dtype=np.float64), (n_sets, 4))
+    total = p.sum(axis=-1)
+    if not np.allclose(total, 1, rtol=0, atol=1e-6):
+        raise ValueError(
+            f"p0 sums to {total.tolist()}, not 1; scale it to 1 or add the "
+            "missing frequency to one of the haplotypes"
+        )
+    p = np.repeat(p[:, None], replicates, axis=1)
+
+    idx = schedule_index(concs, schedule)
+    rng = np.random.default_rng(seed)
+    out = np.empty((n_sets, replicates, len(idx) + 1, 4))
+    out[:, :, 0] = p
+    for t, k in enumerate(idx):
+        # the same viabilities for all replicates of a set
+        p = select(p, w[:, None, k])
+        if pop_size:
+            p = drift(p, pop_size, rng)
+        out[:, :, t + 1] = p
+    return out
+
+
+def read_reference(name):
+    """(generations, 4) frequencies of a Figure 3 simulation"""
+    d = pd.read_csv(REFERENCE.format(name)).set_index("allele")
+    return d.loc[HAPLOTYPES].to_numpy().T
+
+
+def reference_gap(w, concs, name, start=1):
+    """Simulated minus Figure 3 frequencies, from the file's generation start
+
+    The file's t=0 row does not sum to 1, so the default start is t=1.
+    """
+    ref = read_reference(name)
+    freqs = simulate(w, concs, SCHEDULES[name][start:], p0=ref[start])[0, 0]
+    return pd.DataFrame(
+        freqs - ref[start:],
+        index=pd.RangeIndex(start, len(ref), name="generation"),
+        columns=HAPLOTYPES,
+    )
+
+
+def resistance(freqs, w):
+    """Mean viability sum_ij p_i w_ij p_j at every concentration
+
+    freqs is (sets, replicates, generations, 4) and w (sets, concs, 4, 4);
+    the result is (sets, replicates, generations, concs).
+    """
+    w = np.asarray(w)
+    if w.ndim == 3:
+        w = w[None]
+    return np.einsum("srti,scij,srtj->srtc", freqs, w, freqs)
+
+
+def tidy_trajectories(freqs, params):
+    # long table: set, parameters, replicate, generation, haplotype, frequency
+    s, r, t, h = np.indices(freqs.shape).reshape(4, -1)
+    d = pd.DataFrame(
+        {
+            "set": s.astype(np.uint32),
+            "replicate": r.astype(np.uint32),
+            "generation": t.astype(np.uint8),
+            "haplotype": pd.Categorical.from_codes(h, HAPLOTYPES),
+            "frequency": freqs.reshape(-1).astype(np.float32),
+        }
+    )
+    return params.merge(d, on="set")
+
+
+def tidy_resistance(res, concs, params):
+    s, r, t, c = np.indices(res.shape).reshape(4, -1)
+    d = pd.DataFrame(
+        {
+            "set": s.astype(np.uint32),
+            "replicate": r.astype(np.uint32),
+            "generation": t.astype(np.uint8),
+            "conc": concs[c],
+            "resistance": res.reshape(-1).astype(np.float32),
+        }
+    )
+    return params.merge(d, on="set")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--viabilities", default=VIABILITIES)
+    parser.add_argument(
+        "--schedule",
+        default="treated",
+        help=f"one of {list(SCHEDULES)} or comma-separated ppm per generation",
+    )
+    parser.add_argument("--p0", type=float, nargs=4, default=P0)
+    parser.add_argument(
+        "--h",
+        type=float,
+        nargs="+",
+        help="dominance coefficients to sweep (default: the measured table)",
+    )
+    parser.add_argument("--replicates", type=int, default=1)
+    parser.add_argument(
+        "--pop-size", type=int, help="N for drift (default: deterministic)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=DATA)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only print the differences from the Figure 3 simulations",
+    )
+    args = parser.parse_args()
+
+    concs, w = read_viabilities(args.viabilities)
+    if args.check:
+        for name in SCHEDULES:
+            gap = reference_gap(w, concs, name)
+            print(f"{name}: simulated - Figure 3, from t=1\n{gap.round(4)}")
+            print(f"max |difference| {gap.abs().to_numpy().max():.4f}\n")
+        raise SystemExit
+    if args.schedule in SCHEDULES:
+        schedule = SCHEDULES[args.schedule]
+    else:
+        schedule = [float(c) for c in args.schedule.split(",")]
+
+    if args.h is None:
+        ws, params = w[None], pd.DataFrame({"set": [0]})
+    else:
+        ws = dominance(w, args.h)
+        params = pd.DataFrame({"set": np.arange(len(args.h)), "h": args.h})
+    params["set"] = params["set"].astype(np.uint32)
+
+    freqs = simulate(
+        ws,
+        concs,
+        schedule,
+        p0=args.p0,
+        replicates=args.replicates,
+        pop_size=args.pop_size,
+        seed=args.seed,
+    )
+    res = resistance(freqs, ws)
+
+    tidy_trajectories(freqs, params).to_parquet(
+        os.path.join(args.out, "sim_ace_trajectories.parquet"), index=False
+    )
+    tidy_resistance(res, concs, params).to_parquet(
+        os.path.join(args.out, "sim_ace_resistance.parquet"), index=False
+    )
+    print(
+        f"{freqs.shape[0]} parameter sets x {freqs.shape[1]} replicates x "
+        f"{freqs.shape[2]} generations"
+    )
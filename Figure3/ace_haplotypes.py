@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Ace haplotype frequencies per cage and timepoint from the HAF .freq files.
+
+Python version of sections 2.1 and 3.1-3.3 of Fig_3bc_ExtFig4ab_final.Rmd.
+Each `.freq` file holds, per window on 3R, the estimated frequency of every
+founder line (columns in SNP table order). A file is reduced while it is
+read, line by line, to the mean frequency of each founder over the windows
+that overlap the Ace resistance sites (end >= 9063921, start <= 9069721);
+the founder means are then summed into Ace haplotypes, with each line
+contributing half its frequency to each of its two haplotypes. The lines'
+haplotypes are read from the alleles at the four resistance sites in the SNP
+table, as in section 2.1. Files are processed in parallel.
+
+The output is one long table, one row per file (tpt, generation, cage,
+treatment) and haplotype:
+
+    python ace_haplotypes.py --processes 8 --main-csv AceHaplo_freq.csv
+
+`--main-csv` also writes the table used for the figure (`AceHaplo_freq.csv`
+in the Rmd): matched timepoints renumbered 1-8, no I cages, no E11/E12 and
+only the four main haplotypes.
+"""
+
+import argparse
+import os
+import re
+
+import multiprocess as mp
+import numpy as np
+import pandas as pd
+
+ACE_SITES = [9069721, 9069408, 9069054, 9063921]
+WINDOW_START, WINDOW_END = 9063921, 9069721
+
+# alleles at ACE_SITES -> the two Ace haplotypes of a line
+HAPLOTYPE_CODES = {
+    "TCAC": "IGFG.IGFG",
+    "CSWS": "VGFA.VAYG",
+    "CCAS": "VGFG.VGFA",
+    "TCWC": "IGFG.IGYG",
+    "CGTC": "VAYG.VAYG",
+    "CCAC": "VGFG.VGFG",
+    "CCAG": "VGFA.VGFA",
+    "YSWS": "IGFG.VAYA",
+    "TCAS": "IGFG.IGFA",
+    "YSAC": "IGFG.VAFG",
+    "YSWC": "IGFG.VAYG",
+    "YCAS": "IGFG.VGFA",
+    "CSWC": "VGFG.VAYG",
+}
+HAPLOTYPES = ["IGFG", "VGFG", "VGFA", "VAYG", "IGFA", "IGYG", "VAFG", "VAYA"]
+MAIN = ["IGFG", "VGFG", "VGFA", "VAYG"]
+
+# Mark's sampling timepoints matched between E and P cages, renumbered 1-8
+MAIN_TPTS = {1: 1, 3: 2, 5: 3, 7: 4, 9: 5, 10: 6, 11: 7, 13: 8}
+DATES = {
+    1: "2021-07-13",
+    2: "2021-07-20",
+    3: "2021-07-26",
+    4: "2021-08-04",
+    5: "2021-08-10",
+    6: "2021-08-17",
+    7: "2021-08-24",
+    9: "2021-09-07",
+    10: "2021-09-21",
+    11: "2021-10-20",
+    13: "2021-12-22",
+}
+
+SNPTABLE = "data/inbredv2_withHets.orch2021.3R.snpTable.npute"
+FREQS = "data/Freqs"
+
+
+def _split(line, sep):
+    return line.rstrip("\n").split(sep) if sep else line.split()
+
+
+def line_haplotypes(path=SNPTABLE):
+    """Founder line ids (SNP table order) and their Ace haplotype pairs"""
+    with open(path) as f:
+        header = f.readline()
+        sep = "," if "," in header else "\t" if "\t" in header else None
+        # the first two columns are the position and the reference
+        lines = [c.strip('"') for c in _split(header, sep)[2:]]
+        alleles = {}
+        for row in f:
+            pos = row.split(sep, 1)[0] if sep else row.split(None, 1)[0]
+            if int(pos) in ACE_SITES:
+                alleles[int(pos)] = [a.strip('"') for a in _split(row, sep)[2:]]
+                if len(alleles) == len(ACE_SITES):
+                    break
+    missing = set(ACE_SITES) - set(alleles)
+    if missing:
+        raise ValueError(f"{path}: no rows for Ace sites {sorted(missing)}")
+    codes = ["".join(a) for a in zip(*(alleles[p] for p in ACE_SITES))]
+    return lines, [HAPLOTYPE_CODES.get(c) for c in codes]
+
+
+def haplotype_weights(haplotypes):
+    # lines x HAPLOTYPES: 1/2 per copy; lines with an unknown code get 0
+    w = np.zeros((len(haplotypes), len(HAPLOTYPES)))
+    for i, pair in enumerate(haplotypes):
+        if pair is None:
+            continue
+        for h in pair.split("."):
+            w[i, HAPLOTYPES.index(h)] += 0.5
+    return w
+
+
+def window_means(path, start=WINDOW_START, end=WINDOW_END):
+    """Mean founder frequencies over the windows overlapping [start, end]"""
+    total, count = None, None
+    with open(path) as f:
+        for row in f:
+            fields = row.split(None, 3)
+            if int(fields[2]) < start or int(fields[1]) > end:
+                continue
+            values = np.array(fields[3].split(), dtype=object)
+            values[values == "NA"] = "nan"
+            x = values.astype(np.float64)
+            if total is None:
+                total, count = np.zeros(len(x)), np.zeros(len(x))
+            ok = ~np.isnan(x)
+            total[ok] += x[ok]
+            count[ok] += 1
+    if total is None:
+        raise ValueError(f"{path}: no windows overlap {start}-{end}")
+    with np.errstate(invalid="ignore"):
+        return total / count
+
+
+def sample_info(path):
+    # tp<T>_<generation>_<cage>_... as separated in the Rmd
+    tpt, generation, cage = os.path.basename(path).split("_")[:3]
+    return {
+        "tpt": int(tpt.removeprefix("tp")),
+        "generation": generation,
+        "cage": cage,
+        "treatment": re.sub(r"\d+", "", cage, count=1),
+    }
+
+
+def find_freq_files(folder=FREQS):
+    # 3R files only, without replicate and re-run files
+    return sorted(
+        os.path.join(folder, f)
+        for f in os.listdir(folder)
+        if "3R.freqs" in f and not any(x in f for x in ["rep", "Rd", "TechRep"])
+    )
+
+
+def aggregate(files, weights, processes=1):
+    """Long table: tpt, generation, cage, treatment, haplotype, frequency"""
+    with mp.Pool(processes) as pool:
+        means = pool.map(window_means, files, chunksize=1)
+    freqs = np.vstack(means)
+    if freqs.shape[1] != weights.shape[0]:
+        raise ValueError(
+            f"{freqs.shape[1]} founder columns in the .freq files, "
+            f"{weights.shape[0]} lines in the SNP table"
+        )
+    # NaN founders (no estimate in any window) propagate, as in the Rmd
+    haps = freqs @ weights
+
+    info = pd.DataFrame([sample_info(f) for f in files])
+    d = info.loc[info.index.repeat(len(HAPLOTYPES))].reset_index(drop=True)
+    d["haplotype"] = pd.Categorical(
+        np.tile(HAPLOTYPES, len(files)), categories=HAPLOTYPES
+    )
+    d["frequency"] = haps.reshape(-1).astype(np.float32)
+    return d.astype({"tpt": np.uint8})
+
+
+def main_haplotypes(d):
+    # the filtered table of section 3.3.1 (AceHaplo_freq.csv)
+    d = d[d["haplotype"].isin(MAIN) & d["tpt"].isin(list(MAIN_TPTS))]
+    d = d[(d["treatment"] != "I") & ~d["cage"].isin(["E11", "E12"])]
+    return (
+        d.assign(
+            Date=d["tpt"].map(DATES),
+            tpt=d["tpt"].map(MAIN_TPTS),
+            haplotype=d["haplotype"].cat.set_categories(MAIN),
+        )
+        .rename(columns={"haplotype": "haplotype_class"})
+        .loc[:, ["tpt", "cage", "treatment", "Date", "haplotype_class", "frequency"]]
+        .sort_values(["tpt", "cage", "haplotype_class"])
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--freqs", default=FREQS, help="directory of .freq files")
+    parser.add_argument("--snptable", default=SNPTABLE)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--out", default="data/ace_haplotype_freqs.parquet")
+    parser.add_argument("--main-csv", help="also write the filtered figure table")
+    args = parser.parse_args()
+
+    lines, pairs = line_haplotypes(args.snptable)
+    files = find_freq_files(args.freqs)
+    d = aggregate(files, haplotype_weights(pairs), args.processes)
+    d.to_parquet(args.out, index=False)
+    if args.main_csv:
+        main_haplotypes(d).to_csv(args.main_csv, index=False)
+    print(f"{len(files)} files, {len(lines)} founder lines -> {args.out}")
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
+import argparse
 import os
 import numpy as np
-import numpy.ma as ma
-import multiprocess as mp
 import pandas as pd
-from tqdm import tqdm
+
+from checkpoint import add_checkpoint_argument, open_checkpoints
+from instrument import Run, add_arguments
+from regions import FLANK, add_region_argument, chroms, select_regions
+from repeatmask import add_mask_argument, drop_masked, load_mask
+from packed import PackedGenotypes, ace_r, publish
+from shared import SharedArrays, map_blocks
+from tables import ACE_R2S, conform, measure, read_snptable_numeric
 
 THRESH = 0.03
 
@@ -112,31 +118,38 @@ def assign_linked_status(d, r2_thresh):
     return ace_r2s_long
 
 
-if __name__ == "__main__":
-    snptables = [
-        f"data/snptables/Orchard2021/{f}"
-        for f in os.listdir("data/snptables/Orchard2021/")
+def load_snptable(region=None, mask=None, directory="data/snptables/Orchard2021/"):
+    """All numeric SNP tables as one frame, -1 (missing) replaced by NaN"""
+    paths = [
+        os.path.join(directory, f)
+        for f in os.listdir(directory)
         if f.endswith(".snpTable.numeric")
     ]
+    if region:
+        # inbredv2_withHets.orch2021.{chrom}.snpTable.numeric
+        paths = [f for f in paths if f.split(".")[-3] in chroms(region)]
 
-    # read csv files
-    snptables = [pd.read_csv(f) for f in snptables]
-    # add the chrom column
-    snptables = [df.assign(chrom=df.columns[0]) for df in snptables]
-    # rename the first column to pos
-    snptables = [df.rename(columns={df.columns[0]: "pos"}) for df in snptables]
+    # read csv files with compact dtypes, adding the chrom column and
+    # renaming the first column to pos
+    snptables = [read_snptable_numeric(f) for f in paths]
 
-    snptable = pd.concat(snptables)
+    # with the matching flank, which 04a/04b need around the regions
+    snptable = select_regions(pd.concat(snptables), region, FLANK)
+    # SNPs in repeats, with --mask
+    snptable = drop_masked(snptable, mask)
 
     # replace -1 with na
     snptable = snptable.replace(-1, np.nan)
     # snptable = snptable[snptable["chrom"] != "X"]
+    return snptable
 
-    snptable.to_csv("data/processed/snptable.csv", index=False)
 
-    ace_table = pd.read_csv("data/raw/ace_haplotypes.csv")
+def ace_dosages(ace_table):
+    """Ace allele dosages (Ace_S, Ace_R1, Ace_R2, Ace_R3 x lines)
 
-    ace_table = (
+    ace_table is data/raw/ace_haplotypes.csv.
+    """
+    return (
         ace_table.assign(
             l1=ace_table["Haplotype.aa"].apply(lambda x: x.split(".")[0]),
             l2=ace_table["Haplotype.aa"].apply(lambda x: x.split(".")[1]),
@@ -168,44 +181,25 @@ if __name__ == "__main__":
         / 2
     )
 
-    ace_table.to_csv("data/processed/ace_snptable.csv")
-
-    # make sure columns are ordered the right way in both tables
-    snptable = snptable[["chrom", "pos"] + list(ace_table.columns)]
-
-    # compute all r^2 values for each ace allele
-    ace_r2s = snptable[["chrom", "pos"]].copy()
-
-    s_row = ma.masked_invalid(ace_table.loc["Ace_S"].values)
-    r1_row = ma.masked_invalid(ace_table.loc["Ace_R1"].values)
-    r2_row = ma.masked_invalid(ace_table.loc["Ace_R2"].values)
-    r3_row = ma.masked_invalid(ace_table.loc["Ace_R3"].values)
 
-    snp_rows = []
+def ace_correlations(packed, ace_table, checkpoint=None):
+    """r and r^2 of every SNP with each Ace allele
 
-    for _, row in tqdm(
-        snptable.iterrows(), total=snptable.shape[0], desc="Preparing data..."
-    ):
-        snp_row = ma.masked_invalid(row[2:].astype(float).values)
-        mask = ~snp_row.mask
-
-        snp_rows.append((snp_row, mask))
-
-    def compute_r2(row):
-        snp_row, mask = row
-
-        s = ma.corrcoef(snp_row[mask], s_row[mask])[0, 1]
-        r1 = ma.corrcoef(snp_row[mask], r1_row[mask])[0, 1]
-        r2 = ma.corrcoef(snp_row[mask], r2_row[mask])[0, 1]
-        r3 = ma.corrcoef(snp_row[mask], r3_row[mask])[0, 1]
-
-        return np.array([s, r1, r2, r3])
+    checkpoint keeps the finished SNP blocks (see checkpoint.py).
+    """
+    ace_r2s = pd.DataFrame({"chrom": packed.chrom, "pos": packed.pos})
 
     print("Computing r^2 values in parallel...")
-    with mp.Pool(10) as pool:
-        results = pool.map(compute_r2, snp_rows)
-
-    results = np.array(results)
+    # lines without an Ace haplotype are missing in the Ace rows and drop out
+    ace = ace_table.reindex(columns=packed.lines)
+    ace = PackedGenotypes.from_dosages(
+        ace.loc[["Ace_S", "Ace_R1", "Ace_R2", "Ace_R3"]].to_numpy(), packed.lines
+    )
+    with SharedArrays() as shared:
+        # published once; the workers only receive row ranges
+        publish(shared, packed, ace)
+        results = map_blocks(ace_r, len(packed), shared, checkpoint=checkpoint)
+        results = np.vstack(results)
 
     ace_r2s.loc[:, "S_r"] = results[:, 0]
     ace_r2s.loc[:, "R1_r"] = results[:, 1]
@@ -217,11 +211,62 @@ if __name__ == "__main__":
     ace_r2s["R1_r2"] = ace_r2s["R1_r"] ** 2
     ace_r2s["R2_r2"] = ace_r2s["R2_r"] ** 2
     ace_r2s["R3_r2"] = ace_r2s["R3_r"] ** 2
+    return ace_r2s
+
 
+def classify(ace_r2s):
+    """Linked status of every SNP and Ace allele at the three r^2 thresholds"""
     ace_r2s_03 = assign_linked_status(ace_r2s, 0.03)
     ace_r2s_1 = assign_linked_status(ace_r2s, 0.1)
     ace_r2s_2 = assign_linked_status(ace_r2s, 0.2)
 
     d = pd.concat([ace_r2s_03, ace_r2s_1, ace_r2s_2])
+    return conform(d.astype({"r": "float64"}), ACE_R2S, "ace_r2s")
+
+
+if __name__ == "__main__":
+    parser = add_mask_argument(add_region_argument(argparse.ArgumentParser()))
+    parser = add_checkpoint_argument(parser)
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("02_process_snptables", args)
+
+    run.begin("load")
+    snptable = load_snptable(args.region, load_mask(args))
+
+    run.rows(snptable.shape[0])
+    measure(run, "snptable", snptable)
+
+    run.begin("write")
+    snptable.to_csv("data/processed/snptable.csv", index=False)
+    # bit planes of all lines for the correlation and count kernels
+    packed = PackedGenotypes.from_snptable(snptable)
+    packed.save()
+    run.frame(
+        "snptable_packed",
+        rows=len(packed),
+        nbytes=packed.nbytes,
+        wide_bytes=8 * len(packed) * len(packed.lines),
+    )
+
+    run.begin("load")
+    ace_table = ace_dosages(pd.read_csv("data/raw/ace_haplotypes.csv"))
+    ace_table.to_csv("data/processed/ace_snptable.csv")
+    run.end(rows=ace_table.shape[1])
+
+    # compute all r^2 values for each ace allele
+    run.begin("correlate")
+    checkpoint = open_checkpoints(
+        args, "ace_r", packed.one, packed.two, packed.obs, packed.lines, ace_table
+    )
+    ace_r2s = ace_correlations(packed, ace_table, checkpoint)
+    run.end(rows=ace_r2s.shape[0])
+
+    run.begin("classify")
+    d = classify(ace_r2s)
+    measure(run, "ace_r2s", d)
+
+    run.end(rows=d.shape[0])
 
-    d.to_parquet("data/processed/ace_r2s.parquet")
+    run.begin("write")
+    d.write_parquet("data/processed/ace_r2s.parquet")
+    run.finish()
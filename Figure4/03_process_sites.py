@@ -1,170 +1,143 @@
 #!/usr/bin/env python
 
-import pandas as pd
-import polars as pl
+import argparse
+
 import numpy as np
-import numpy.ma as ma
-from tqdm import tqdm
+import polars as pl
 
+from afstore import afmat_sizes, open_afmat
+from instrument import Run, add_arguments
+from regions import FLANK, add_region_argument, select_regions
+from repeatmask import add_mask_argument, drop_masked, load_mask
+from tables import (
+    CAGE,
+    CHROM,
+    SWEEP,
+    SWEEP_TPTS,
+    TREATMENT,
+    drop_empty_cages,
+    measure,
+    scan_lm_sites,
+    write_sites_main,
+)
 
-if __name__ == "__main__":
-    samps_initial = (
-        pl.read_csv("data/processed/samps.csv")
-        .with_columns(pl.col("freq_idx").sub(1))
-        .filter(pl.col("tpt").is_in([2, 6]))
-        .with_columns(
-            pl.concat_str(
-                [
-                    pl.col("treatment"),
-                    pl.lit("_"),
-                    pl.col("cage"),
-                    pl.lit("-"),
-                    pl.col("tpt"),
-                ]
-            ).alias("cage_label-tpt")
+
+def read_samps(path="data/processed/samps.csv"):
+    """Samples with 0-based afmat columns, sorted by timepoint (lazy)"""
+    return (
+        pl.scan_csv(path)
+        .select(["treatment", "cage", "tpt", "freq_idx"])
+        .cast(
+            {
+                "treatment": TREATMENT,
+                "cage": CAGE,
+                "tpt": pl.Int8,
+                "freq_idx": pl.UInt32,
+            }
         )
-        .select(["cage_label-tpt", "freq_idx"])
+        .with_columns(pl.col("freq_idx").sub(1))
+        .sort("tpt")
     )
 
-    afmat_indices = [
-        ":".join(map(str, x))
-        for x in zip(samps_initial["cage_label-tpt"], samps_initial["freq_idx"])
-    ]
 
-    afmat = np.load("data/processed/afmat.npy")
-
-    sites = (
-        pl.scan_csv(
-            "data/processed/sites.csv",
-        )
-        # convert from 1-indexed to 0-indexed
-        .with_columns(pl.col("site_idx").sub(1))
+def read_site_list(path="data/processed/sites.csv"):
+    """chrom, pos and the 0-based afmat row of every site (lazy)"""
+    return (
+        pl.scan_csv(path)
         # add r2 values and tag sites by linked status
         .drop_nulls()
-        # add the other index needed to use the afmat
-        .with_columns(pl.lit(afmat_indices).alias("afmat_indices"))
-        .explode("afmat_indices")
-        #   split the afmat_indices into cage_label-tpt and freq_idx on :
-        .with_columns(
-            pl.col("afmat_indices")
-            .str.split_exact(":", 1)
-            .struct.rename_fields(["cage_label-tpt", "freq_idx"])
-        )
-        .unnest("afmat_indices")
-        .cast({"freq_idx": pl.Int64})
-        #   split on - to get cage_label and tpt
-        .with_columns(
-            pl.col("cage_label-tpt")
-            .str.split_exact("-", 1)
-            .struct.rename_fields(["cage_label", "tpt"])
-        )
-        .unnest("cage_label-tpt")
-        .cast({"tpt": pl.Int64})
-        # split on _ to get treatment and cage
-        .with_columns(
-            pl.col("cage_label")
-            .str.split_exact("_", 1)
-            .struct.rename_fields(["treatment", "cage"])
-        )
-        .unnest("cage_label")
-        .cast({"cage": pl.Int64})
-        # .filter([pl.col("tpt") == 2])  # , pl.col('treatment') == 'P'])
-        # add the afmat values
-        .with_columns(
-            pl.struct([pl.col("site_idx"), pl.col("freq_idx")]).alias("afmat_indices")
-        )
-        .with_columns(
-            pl.col("afmat_indices")
-            .map_elements(lambda s: afmat[s["site_idx"], s["freq_idx"]], return_dtype=pl.Float64)
-            .alias("initial_freq")
-        )
-        .drop(["freq_idx", "afmat_indices"])
-    ).collect()
-
-    samps = (
-        pl.scan_csv("data/processed/samps.csv")
-        .sort("tpt")
-        .with_columns(pl.col("freq_idx").sub(1))
+        .select(["chrom", "pos", "site_idx"])
+        .cast({"chrom": CHROM, "pos": pl.UInt32, "site_idx": pl.UInt32})
+        # convert from 1-indexed to 0-indexed
+        .with_columns(pl.col("site_idx").sub(1))
     )
 
-    samps_trt = (
-        samps.filter(pl.col("tpt").is_in([2, 3, 4, 5, 6]))
-        .group_by(["cage", "treatment"])
-        .agg([pl.col("freq_idx")])
-        .with_columns(pl.lit("trt").alias("sweep"))
-    )
-    samps_post_trt = (
-        samps.filter(pl.col("tpt").is_in([6, 7, 8]))
-        .group_by(["cage", "treatment"])
-        .agg([pl.col("freq_idx")])
-        .with_columns(pl.lit("post_trt").alias("sweep"))
-    )
-    samps = pl.concat([samps_trt, samps_post_trt])
 
-    lm_sites = (
-        pl.scan_csv("data/raw/sigsite_malathion.csv")
-        .drop(["treatment"])
-        .rename(
-            {
-                "comparison": "sweep",
-                "cage": "treatment",
-                "estimate": "lm_slope",
-                "sigLevel": "significance_level",
-                "effect_size": "lm_effect",
-            }
-        )
-        .filter([pl.col("sweep") != "1_2"])
+def explode(sites, samps, region=None, mask=None):
+    """One row per site x initial sample"""
+    # the samples each site's trajectory starts from: tpt 2 for the
+    # treatment sweep and tpt 6 for the post-treatment sweep
+    samps_initial = (
+        samps.filter(pl.col("tpt").is_in([2, 6]))
         .with_columns(
-            [
-                pl.col("sweep").replace({"2_6": "trt", "6_8": "post_trt"}),
-            ]
-        )
-        .select(
-            [
-                "chrom",
-                "pos",
-                "treatment",
-                "sweep",
-                "lm_slope",
-                "significance_level",
-                "lm_effect",
-            ]
+            pl.col("tpt")
+            .replace_strict({2: "trt", 6: "post_trt"}, return_dtype=SWEEP)
+            .alias("sweep")
         )
+        .select(["treatment", "cage", "sweep"])
+    )
+    # only gather the afmat rows of the regions and the matching flank
+    sites = select_regions(sites.lazy(), region, FLANK)
+    # and leave out sites in repeats, with --mask
+    sites = drop_masked(sites, mask)
+    return sites.join(samps_initial.lazy(), how="cross").collect()
+
+
+def sweep_samples(samps):
+    """First and last afmat column of each (treatment, cage, sweep)"""
+    return pl.concat(
+        [
+            samps.filter(pl.col("tpt").is_in(tpts))
+            .sort("tpt", "freq_idx")
+            .group_by(["cage", "treatment"])
+            .agg(
+                pl.col("freq_idx").first().alias("first"),
+                pl.col("freq_idx").last().alias("last"),
+            )
+            .with_columns(pl.lit(sweep, dtype=SWEEP).alias("sweep"))
+            .lazy()
+            for sweep, tpts in SWEEP_TPTS.items()
+        ]
     )
 
+
+def gather_freqs(sites, samps, afmat, lm_sites):
+    """Per-site, cage and sweep GLM effects, total_delta and freq0"""
     sites = (
-        sites.lazy()
-        .drop(["initial_freq"])
-        # relabel tpt to mean one of the two sweeps: trt or post_trt
-        .rename({"tpt": "sweep"})
-        .with_columns(
-            pl.col("sweep").cast(pl.String).replace({2: "trt", 6: "post_trt"})
-        )
         # the E2 cage has no data, so drop data for it
-        .filter(~((pl.col("treatment") == "E") & (pl.col("cage") == 2)))
-        .join(lm_sites, on=["chrom", "pos", "treatment", "sweep"], how="left")
+        drop_empty_cages(sites.lazy())
+        .join(lm_sites.lazy(), on=["chrom", "pos", "treatment", "sweep"], how="left")
         .drop_nulls()
-        .join(samps, on=["cage", "treatment", "sweep"], how="left")
-        .with_columns(
-            pl.struct([pl.col("site_idx"), pl.col("freq_idx")]).alias("afmat_indices")
-        )
-        .with_columns(
-            pl.col("afmat_indices")
-            .map_elements(
-                lambda s: list(afmat[s["site_idx"], s["freq_idx"]]),
-                return_dtype=pl.List(pl.Float64),
-            )
-            .alias("freq")
-        )
-        .drop(["site_idx", "freq_idx", "afmat_indices"])
-        # compute deltas: total and diff
-        .with_columns(
-            (pl.col("freq").list.last() - pl.col("freq").list.first()).alias(
-                "total_delta"
-            ),
-            pl.col("freq").list.diff(1, null_behavior="drop").alias("delta"),
-        )
-        # .join(pl.from_pandas(sweep_r2s[['chrom','pos', 'r2']]).lazy(), on=["chrom", "pos"], how="left")
-        .with_columns(pl.col("freq").list.first().alias("freq0"))
-        .drop("delta", "freq")
-    ).collect().write_parquet("data/processed/sites_main.parquet")
+        .join(sweep_samples(samps), on=["cage", "treatment", "sweep"])
+        .collect()
+    )
+
+    # freq0 and total_delta only need the sweep's first and last sample, so
+    # afmat is read with two fancy indexes rather than a lookup per row
+    rows = sites["site_idx"].to_numpy()
+    first = np.asarray(afmat[rows, sites["first"].to_numpy()], dtype=np.float32)
+    last = np.asarray(afmat[rows, sites["last"].to_numpy()], dtype=np.float32)
+    return sites.drop("site_idx", "first", "last").with_columns(
+        pl.Series("total_delta", last - first),
+        pl.Series("freq0", first),
+    )
+
+
+if __name__ == "__main__":
+    parser = add_mask_argument(add_region_argument(argparse.ArgumentParser()))
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("03_process_sites", args)
+
+    run.begin("load")
+    samps = read_samps()
+
+    # memory-mapped; afmat.q16.npy (see afstore.py) when it has been written
+    afmat = open_afmat()
+    run.end(rows=afmat.shape[0])
+    disk, nbytes, wide = afmat_sizes(afmat)
+    run.frame("afmat", rows=afmat.shape[0], nbytes=nbytes, wide_bytes=wide)
+    run.meta["afmat_disk_bytes"] = disk
+
+    # one row per site x initial sample
+    run.begin("explode")
+    sites = explode(read_site_list(), samps, args.region, load_mask(args))
+    run.end(rows=sites.shape[0])
+    measure(run, "sites_x_samples", sites)
+
+    run.begin("join")
+    sites = gather_freqs(sites, samps, afmat, scan_lm_sites())
+    run.end(rows=sites.shape[0])
+
+    run.begin("write")
+    measure(run, "sites_main", write_sites_main(sites))
+    run.finish()
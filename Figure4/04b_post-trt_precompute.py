@@ -1,87 +1,77 @@
 #!/usr/bin/env python
 
+import argparse
+
 import pandas as pd
 import polars as pl
 import numpy as np
-import numpy.ma as ma
 from tqdm import tqdm
-import multiprocess as mp
 
-if __name__ == "__main__":
-    # SNPTABLES and R2S
-    # compute linkage with R3 vs rest
-    ace_table = pd.read_csv("data/processed/ace_snptable.csv", index_col=0)
-    snptable = pd.read_csv("data/processed/snptable.csv")
+from checkpoint import add_checkpoint_argument, open_checkpoints
+from genome_index import GenomeIndex
+from instrument import Run, add_arguments
+from packed import PackedGenotypes, ace_r, group_sums, load_genotypes, publish
+from regions import FLANK, add_region_argument, select_regions
+from repeatmask import add_mask_argument, drop_masked, load_mask
+from shared import SharedArrays, map_blocks
+from tables import (
+    CHROM,
+    SWEEP_R2S,
+    conform,
+    measure,
+    read_sites_main,
+    write_table,
+)
 
-    snptable = snptable[["chrom", "pos"] + list(ace_table.columns)]
-    sweep_r2s = snptable[["chrom", "pos"]].copy()
 
-    s_row = ma.masked_invalid(ace_table.loc["Ace_S"].values) + ma.masked_invalid(
-        ace_table.loc["Ace_R1"].values
-    )
-    r_row = ma.masked_invalid(ace_table.loc["Ace_R2"].values) + ma.masked_invalid(
-        ace_table.loc["Ace_R3"].values
-    )
+def sweep_correlations(snps, ace_table, checkpoint=None):
+    """r and r^2 of every SNP with the R2 + R3 dosage of the lines
 
-    snp_rows = []
-    for _, row in tqdm(
-        snptable.iterrows(), total=snptable.shape[0], desc="Preparing data..."
-    ):
-        snp_row = ma.masked_invalid(row[2:].astype(float).values)
-        mask = ~snp_row.mask
+    checkpoint keeps the finished SNP blocks (see checkpoint.py).
+    """
+    sweep_r2s = pd.DataFrame({"chrom": snps.chrom, "pos": snps.pos})
 
-        snp_rows.append((snp_row, mask))
+    # lines without an Ace haplotype are missing in the Ace rows and drop out
+    ace_table = ace_table.reindex(columns=snps.lines)
 
-    def compute_r2(row):
-        snp_row, mask = row
-        r = ma.corrcoef(snp_row[mask], r_row[mask])[0, 1]
-        return r
+    s_row = ace_table.loc["Ace_S"] + ace_table.loc["Ace_R1"]
+    r_row = ace_table.loc["Ace_R2"] + ace_table.loc["Ace_R3"]
 
     print("Computing r^2 values in parallel...")
-    with mp.Pool(10) as pool:
-        results = pool.map(compute_r2, snp_rows)
-
-    results = np.array(results)
+    with SharedArrays() as shared:
+        # published once; the workers only receive row ranges
+        publish(shared, snps, PackedGenotypes.from_dosages([r_row], snps.lines))
+        results = map_blocks(ace_r, len(snps), shared, checkpoint=checkpoint)
+        results = np.vstack(results)[:, 0]
 
     sweep_r2s.loc[:, "r"] = results
     sweep_r2s.loc[:, "r2"] = sweep_r2s["r"] ** 2
-    sweep_r2s.to_csv("data/processed/sweep_r2s.csv")
+    return sweep_r2s
 
-    snptable = pd.read_csv("data/processed/snptable.csv")
-    snptable = snptable[["chrom", "pos"] + list(snptable.columns[1:-1])]
 
-    snp_positions = snptable[["chrom", "pos"]]
-    snptable = snptable.drop(columns=["chrom", "pos"]).T
+# COUNT CONDITION
 
-    ace_snptable = pd.read_csv("data/processed/ace_snptable.csv")
 
-    # COUNT CONDITION
+def count_thresh(snpcounts, thresh):
+    # first, we want many ref in R and many derived in S
+    a = (snpcounts["Ri"] > thresh) & (snpcounts["S"] > thresh)
+    # or, we want many derived in R and many ref in S
+    b = (snpcounts["R"] > thresh) & (snpcounts["Si"] > thresh)
+    return a | b
 
-    def count_thresh(snpcounts, thresh):
-        # first, we want many ref in R and many derived in S
-        a = (snpcounts["Ri"] > thresh) & (snpcounts["S"] > thresh)
-        # or, we want many derived in R and many ref in S
-        b = (snpcounts["R"] > thresh) & (snpcounts["Si"] > thresh)
-        return a | b
 
-    snptable = pd.read_csv("data/processed/snptable.csv")
-    snptable = snptable[["chrom", "pos"] + list(snptable.columns[1:-1])]
+def snp_counts(snps, ace_table):
+    """R and S line frequencies of each SNP's alleles for the count condition"""
+    # lines without an Ace haplotype count as S
+    resistant = ace_table.loc[["Ace_R2", "Ace_R3"]].sum() > 0.5
+    resistant = resistant.reindex(snps.lines, fill_value=False).to_numpy()
 
-    snp_positions = snptable[["chrom", "pos"]]
-    snptable = snptable.drop(columns=["chrom", "pos"]).T
-
-    ace_snptable = pd.read_csv("data/processed/ace_snptable.csv")
-
-    snptable["resistance"] = ace_snptable.iloc[2:, 1:].sum()
-    snptable["resistance"] = snptable["resistance"].apply(
-        lambda x: "R" if x > 0.5 else "S"
+    # sums of the observed dosages in R and in S lines, by popcount
+    snpcounts = pd.DataFrame({"chrom": snps.chrom, "pos": snps.pos}).assign(
+        R=group_sums(snps, resistant), S=group_sums(snps, ~resistant)
     )
 
-    snpcounts = pd.concat(
-        [snp_positions, snptable.groupby("resistance").sum().T], axis=1
-    )
-
-    print(ace_snptable.iloc[2:, 1:].sum().value_counts())
+    print(ace_table.loc[["Ace_R2", "Ace_R3"]].sum().value_counts())
 
     snpcounts["Si"] = 59 - snpcounts["S"]
     snpcounts["Ri"] = 17 - snpcounts["R"]
@@ -90,18 +80,22 @@ if __name__ == "__main__":
     snpcounts["Si"] = snpcounts["Si"] / 59
     snpcounts["R"] = snpcounts["R"] / 17
     snpcounts["Ri"] = snpcounts["Ri"] / 17
+    return snpcounts
 
-    # JOIN ALL
 
+def join_sites(sites_main, sweep_r2s, snpcounts, region=None, thresh=0.60):
+    """The post_trt rows of sites_main, and the flipped linked and unlinked sites
 
+    Returns sites, sites_linked and the freq0 of the linked and unlinked
+    sites per (chrom, pos, treatment) to match on. thresh is the frequency
+    the count condition asks of the alleles in R and S lines.
+    """
     # OVERWRITE freq0 for post_trt with freq0 for trt
-    sites = pl.read_parquet("data/processed/sites_main.parquet")
-
     sites = (
-        sites.filter(pl.col("sweep") == "post_trt")
+        sites_main.filter(pl.col("sweep") == "post_trt")
         .drop("freq0")
         .join(
-            sites.filter(pl.col("sweep") == "trt").select(
+            sites_main.filter(pl.col("sweep") == "trt").select(
                 ["chrom", "pos", "treatment", "cage", "freq0"]
             ),
             on=["chrom", "pos", "treatment", "cage"],
@@ -109,23 +103,24 @@ if __name__ == "__main__":
         )
         .drop_nulls()
         .join(
-            pl.from_pandas(sweep_r2s[["chrom", "pos", "r", "r2"]]),
+            conform(sweep_r2s, SWEEP_R2S, "sweep_r2s"),
             on=["chrom", "pos"],
             how="left",
         )
         .with_columns(pl.col("r").gt(0).alias("r2_flip"))
     )
 
-    thresh = 0.60
     snps = snpcounts[count_thresh(snpcounts, thresh)][["chrom", "pos"]]
 
-    positions_union = pl.from_pandas(snps[["chrom", "pos"]])
+    positions_union = pl.from_pandas(snps[["chrom", "pos"]]).cast({"chrom": CHROM})
     sites_linked = (
         positions_union.join(sites, on=["chrom", "pos"], how="left")
         .to_pandas()
         .dropna()
     )
     sites_linked = sites_linked.query("r2 > 0.03")
+    # linked SNPs from the regions only, unlinked ones also from the flank
+    sites_linked = select_regions(sites_linked, region)
     # sites_linked['pos'] = sites_linked['pos'] / 1e6
 
     # select matched snps
@@ -176,7 +171,11 @@ if __name__ == "__main__":
     )
 
     print(f"Linked: \n{linked_initials.head()}")
+    return sites, sites_linked, linked_initials, unlinked_initials
+
 
+def match_unlinked(sites, linked_initials, unlinked_initials):
+    """An unlinked SNP of matching freq0 near each linked SNP, per treatment"""
     positions_E = []
 
     for chrom in ["2L", "2R", "3L", "3R", "X"]:
@@ -191,9 +190,13 @@ if __name__ == "__main__":
             .to_pandas()
             .reset_index()
         )
+        uidx = GenomeIndex(u["chrom"], u["pos"])
         for _, lr in tqdm(l.iterrows(), total=l.shape[0], desc=f"Chromosome {chrom}"):
-            pos, lfreqs = lr["pos"], lr["freq0"]
-            uclose = u.query("pos > @pos - 500000 and pos < @pos + 500000")
+            # plain int so that the flank bounds cannot wrap around in uint32
+            pos, lfreqs = int(lr["pos"]), lr["freq0"]
+            uclose = u.iloc[
+                uidx.interval(chrom, pos - 500000, pos + 500000, closed="neither")
+            ]
             close_positions = []
             for _, ur in uclose.iterrows():
                 upos, ufreqs = ur["pos"], ur["freq0"]
@@ -217,9 +220,13 @@ if __name__ == "__main__":
             .to_pandas()
             .reset_index()
         )
+        uidx = GenomeIndex(u["chrom"], u["pos"])
         for _, lr in tqdm(l.iterrows(), total=l.shape[0], desc=f"Chromosome {chrom}"):
-            pos, lfreqs = lr["pos"], lr["freq0"]
-            uclose = u.query("pos > @pos - 500000 and pos < @pos + 500000")
+            # plain int so that the flank bounds cannot wrap around in uint32
+            pos, lfreqs = int(lr["pos"]), lr["freq0"]
+            uclose = u.iloc[
+                uidx.interval(chrom, pos - 500000, pos + 500000, closed="neither")
+            ]
             close_positions = []
             for _, ur in uclose.iterrows():
                 upos, ufreqs = ur["pos"], ur["freq0"]
@@ -245,7 +252,11 @@ if __name__ == "__main__":
         )
 
     sites_unlinked_sample = pd.concat(sites_unlinked_sample)
+    return sites_unlinked_sample
 
+
+def plot_table(sites_linked, sites_unlinked_sample):
+    """The sites_post table of linked and matched unlinked sites"""
     sites_linked_plot = (
         sites_linked[
             [
@@ -277,9 +288,60 @@ if __name__ == "__main__":
         .reset_index(drop=True)
     )
 
-    pd.concat(
+    return pd.concat(
         [
             sites_linked_plot.assign(link="linked"),
             sites_unlinked_sample_plot.assign(link="unlinked"),
         ]
-    ).to_csv("plot_data/sites_post.csv")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--csv", action="store_true", help="also export the plot table as CSV"
+    )
+    parser = add_checkpoint_argument(add_mask_argument(add_region_argument(parser)))
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("04b_post-trt_precompute", args)
+
+    # SNPTABLES and R2S
+    # compute linkage with R3 vs rest
+    run.begin("load")
+    ace_table = pd.read_csv("data/processed/ace_snptable.csv", index_col=0)
+    # bit-packed genotypes of all lines, written by 02; with --mask, SNPs in
+    # repeats are neither linked nor matched
+    mask = load_mask(args)
+    snps = load_genotypes(args.region, mask)
+    run.end(rows=len(snps))
+
+    run.begin("correlate")
+    # the same blocks in 04a and 04b, so either can reuse the other's
+    checkpoint = open_checkpoints(
+        args, "sweep_r", snps.one, snps.two, snps.obs, snps.lines, ace_table
+    )
+    sweep_r2s = sweep_correlations(snps, ace_table, checkpoint)
+    sweep_r2s.to_csv("data/processed/sweep_r2s.csv")
+    run.end(rows=sweep_r2s.shape[0])
+
+    run.begin("count")
+    snpcounts = snp_counts(snps, ace_table)
+    run.end(rows=snpcounts.shape[0])
+
+    # JOIN ALL
+    run.begin("join")
+    sites_main = select_regions(read_sites_main(), args.region, FLANK)
+    sites, sites_linked, linked_initials, unlinked_initials = join_sites(
+        drop_masked(sites_main, mask), sweep_r2s, snpcounts, args.region
+    )
+    run.end(rows=sites.shape[0])
+    measure(run, "sites", sites)
+
+    run.begin("match")
+    sites_unlinked_sample = match_unlinked(sites, linked_initials, unlinked_initials)
+    run.end(rows=sites_unlinked_sample.shape[0])
+
+    run.begin("write")
+    table = plot_table(sites_linked, sites_unlinked_sample)
+    write_table(table, "sites_post", csv=args.csv)
+    run.finish()
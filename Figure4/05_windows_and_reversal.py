@@ -1,100 +1,112 @@
 #!/usr/bin/env python
 
+import argparse
+
 import pandas as pd
 import polars as pl
 import numpy as np
-import numpy.ma as ma
 from tqdm import tqdm
-import multiprocess as mp
+
+from bootstrap import cage_deviations, hierarchical_windows
+from checkpoint import add_checkpoint_argument, open_checkpoints, unit_rng
+from genome_index import GenomeIndex
+from instrument import Run, add_arguments
+from regions import add_region_argument, select_regions, window_start
+from tables import read_sites_main, read_table, scan_lm_sites, write_table
 
 
-def compute_windows(d, w=1e6):
+def compute_windows(
+    d, w=1e6, start=0, replicates=100_000, seed=None, unit=(), checkpoint=None
+):
+    # with a seed, each window resamples from a generator of its own, keyed by
+    # unit (the group) and the window start, so windows loaded from a
+    # checkpoint do not shift the draws of the others
     max_pos = d["pos"].max()
-    breakpoints = np.arange(0, max_pos, w)
+    breakpoints = np.arange(start, max_pos, w)
     breakpoints = list(breakpoints) + [breakpoints[-1] + w]
     windows = zip(breakpoints[:-1], breakpoints[1:])
 
+    # d holds one chromosome arm
+    idx = GenomeIndex("arm", d["pos"].to_numpy())
+
     rows = []
     for start, end in tqdm(windows, total=len(breakpoints) - 1):
-        dw = d.query("pos >= @start and pos <= @end")
+        key = (*unit, start)
+        if checkpoint is not None and key in checkpoint:
+            rows.append(checkpoint.load(key))
+            continue
+        rng = np.random if seed is None else unit_rng(seed, key)
+        dw = d.iloc[idx.interval("arm", start, end)]
         # print(dw.shape)
         lm_e = dw["lm_effect"]  # .abs()
 
-        boots_lm = np.zeros(100_000)
-        # bootstrap 1000 times, get quantiles and median
-        for i in range(100_000):
-            b_lm = np.random.choice(lm_e, size=len(lm_e), replace=True)
+        boots_lm = np.zeros(replicates)
+        # bootstrap, get quantiles and median
+        for i in range(replicates):
+            b_lm = rng.choice(lm_e, size=len(lm_e), replace=True)
             boots_lm[i] = np.median(b_lm)
 
-        rows.append(
-            {
-                "mid": (start + end) / 2,
-                "lm_median": np.median(boots_lm),
-                "lm_lower": np.quantile(boots_lm, 0.025),
-                "lm_upper": np.quantile(boots_lm, 0.975),
-                "nsnp": dw.shape[0],
-            }
-        )
+        row = {
+            "mid": (start + end) / 2,
+            "lm_median": np.median(boots_lm),
+            "lm_lower": np.quantile(boots_lm, 0.025),
+            "lm_upper": np.quantile(boots_lm, 0.975),
+            "nsnp": dw.shape[0],
+        }
+        if checkpoint is not None:
+            checkpoint.save(key, row)
+        rows.append(row)
 
     return pd.DataFrame(rows)
 
 
-if __name__ == "__main__":
-    d = pd.read_csv("plot_data/sites.csv").drop(columns=["Unnamed: 0"])
-    dwin = (
-        d.groupby(["treatment", "chrom", "link"])
-        .apply(compute_windows)
-        .reset_index()
-        .drop(columns=["level_3"])
-    )
-    dwin.to_csv("plot_data/windows.csv")
+def hierarchical(d, main, region=None, replicates=100_000, seed=None, checkpoint=None):
+    """Window rows of every (treatment, chrom, link) group, cages resampled too"""
+    parts = []
+    for (treatment, chrom, link), g in d.groupby(
+        ["treatment", "chrom", "link"], observed=True
+    ):
+        dev = cage_deviations(g, main.filter(pl.col("treatment") == treatment))
+        start = window_start(region, chrom, 1e6)
+        unit = (treatment, chrom, link)
+        w = hierarchical_windows(
+            g, dev, 1e6, start, replicates, seed, unit, checkpoint
+        )
+        parts.append(w.assign(treatment=treatment, chrom=chrom, link=link))
+    return pd.concat(parts)
 
-    d_post = pd.read_csv("plot_data/sites_post.csv").drop(columns=["Unnamed: 0"])
-    dwin_post = (
-        d_post.groupby(["treatment", "chrom", "link"])
-        .apply(compute_windows)
+
+def snp_windows(d, region=None, replicates=100_000, seed=None, checkpoint=None):
+    """Window rows of every (treatment, chrom, link) group, SNPs resampled"""
+
+    def region_windows(g):
+        # windows from the start of the region rather than from 0
+        start = window_start(region, g.name[1], 1e6)
+        return compute_windows(g, 1e6, start, replicates, seed, g.name, checkpoint)
+
+    return (
+        d.groupby(["treatment", "chrom", "link"], observed=True)
+        .apply(region_windows)
         .reset_index()
         .drop(columns=["level_3"])
     )
-    dwin_post.to_csv("plot_data/windows_post.csv")
 
-    # also process lm sites here to get reversal data
-    lmd = lm_sites = (
-        (
-            pl.scan_csv("data/raw/sigsite_malathion.csv")
-            .drop(["treatment"])
-            .rename(
-                {
-                    "comparison": "sweep",
-                    "cage": "treatment",
-                    "estimate": "lm_slope",
-                    "sigLevel": "significance_level",
-                    "effect_size": "lm_effect",
-                }
-            )
-            .filter([pl.col("sweep") != "1_2"])
-            .with_columns(
-                [
-                    pl.col("sweep").replace({"2_6": "trt", "6_8": "post_trt"}),
-                ]
-            )
-            .select(
-                [
-                    "chrom",
-                    "pos",
-                    "treatment",
-                    "sweep",
-                    "lm_effect",
-                ]
-            )
-        )
+
+def lm_effects(lm_sites):
+    """One GLM effect per site, treatment and sweep, as pandas"""
+    return (
+        lm_sites.lazy()
+        .select(["chrom", "pos", "treatment", "sweep", "lm_effect"])
         .collect()
         .to_pandas()
         .drop_duplicates()
     )
 
-    d = (
-        pd.read_csv("plot_data/sites.csv")[["chrom", "pos", "link", "treatment"]]
+
+def reversal(d, lmd):
+    """The trt and post_trt effects of the sites in d side by side"""
+    return (
+        d[["chrom", "pos", "link", "treatment"]]
         .drop_duplicates()
         .merge(lmd, on=["chrom", "pos", "treatment"], how="left")
         .dropna()
@@ -108,6 +120,91 @@ if __name__ == "__main__":
         .drop_duplicates()
     )
 
-    d.to_csv("plot_data/reversal.csv")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--csv", action="store_true", help="also export the plot tables as CSV"
+    )
+    parser.add_argument(
+        "--bootstrap",
+        choices=["snp", "hierarchical"],
+        default="snp",
+        help="resample SNPs only, or cages and then SNPs (bootstrap.py)",
+    )
+    parser.add_argument(
+        "--replicates",
+        type=int,
+        default=100_000,
+        help="bootstrap replicates per window",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="seed of the bootstrap; needed to resume exactly"
+    )
+    parser = add_checkpoint_argument(add_region_argument(parser))
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("05_windows_and_reversal", args)
+
+    run.begin("load")
+    # matched unlinked SNPs can lie in the flank of a region; leave them out
+    d = select_regions(read_table("sites"), args.region).to_pandas()
+    run.end(rows=d.shape[0])
+
+    if args.bootstrap == "hierarchical":
+        # per-cage total_delta of the same sites, from 03
+        run.begin("load")
+        main = select_regions(read_sites_main(), args.region)
+        run.end(rows=main.shape[0])
+
+    # everything the window rows depend on
+    params = (args.bootstrap, args.replicates, args.seed, args.region)
+
+    run.begin("bootstrap")
+    if args.bootstrap == "hierarchical":
+        trt = main.filter(pl.col("sweep") == "trt")
+        checkpoint = open_checkpoints(args, "windows", d, trt, *params)
+        dwin = hierarchical(d, trt, args.region, args.replicates, args.seed, checkpoint)
+    else:
+        checkpoint = open_checkpoints(args, "windows", d, *params)
+        dwin = snp_windows(d, args.region, args.replicates, args.seed, checkpoint)
+    run.end(rows=dwin.shape[0])
+
+    run.begin("write")
+    write_table(dwin, "windows", csv=args.csv)
+
+    run.begin("load")
+    d_post = select_regions(read_table("sites_post"), args.region).to_pandas()
+    run.end(rows=d_post.shape[0])
+
+    run.begin("bootstrap")
+    if args.bootstrap == "hierarchical":
+        post = main.filter(pl.col("sweep") == "post_trt")
+        checkpoint = open_checkpoints(args, "windows_post", d_post, post, *params)
+        dwin_post = hierarchical(
+            d_post, post, args.region, args.replicates, args.seed, checkpoint
+        )
+    else:
+        checkpoint = open_checkpoints(args, "windows_post", d_post, *params)
+        dwin_post = snp_windows(
+            d_post, args.region, args.replicates, args.seed, checkpoint
+        )
+    run.end(rows=dwin_post.shape[0])
+
+    run.begin("write")
+    write_table(dwin_post, "windows_post", csv=args.csv)
+
+    # also process lm sites here to get reversal data
+    run.begin("load")
+    lmd = lm_effects(select_regions(scan_lm_sites(), args.region))
+    run.end(rows=lmd.shape[0])
+
+    run.begin("join")
+    d = select_regions(read_table("sites"), args.region).to_pandas()
+    d = reversal(d, lmd)
+    run.end(rows=d.shape[0])
+
+    run.begin("write")
+    write_table(d, "reversal", csv=args.csv)
+    run.finish()
 
 
@@ -1,89 +1,70 @@
 #!/usr/bin/env python
+import argparse
+
 import pandas as pd
+import polars as pl
 from scipy import stats
 
-d = (
-    pd.read_csv("plot_data/sites.csv")
-    .drop(columns=["Unnamed: 0"])
-    .query('treatment == "P" and chrom == "3R"')
-)
-d["lm_effect"] = -d["lm_effect"]
+from instrument import Run, add_arguments
+from regions import add_region_argument, select_regions
+from tables import MWU, read_table, write_table
 
 binsize = 1e6
 
-# use the pos column to assign bin id to each site with 500000 bp bins
-d["bin"] = (d["pos"] / binsize).astype(int)
-d["binmid"] = d["bin"] * binsize + binsize / 2
-
-
-def mwu(df):
-    linked = df.query('link == "linked"')["lm_effect"]
-    unlinked = df.query('link == "unlinked"')["lm_effect"]
-    return pd.Series(stats.mannwhitneyu(linked, unlinked, alternative="greater").pvalue)
-
-
-dmwuR = (
-    d.groupby(["chrom", "bin", "binmid"])
-    .apply(mwu)
-    .reset_index()
-    .rename(columns={0: "pval"})
-)
-
-d = (
-    pd.read_csv("plot_data/sites.csv")
-    .drop(columns=["Unnamed: 0"])
-    .query('treatment == "P" and chrom == "3L"')
-)
-d["lm_effect"] = -d["lm_effect"]
-
-# use the pos column to assign bin id to each site with 500000 bp bins
-d["bin"] = (d["pos"] / binsize).astype(int)
-d["binmid"] = d["bin"] * binsize + binsize / 2
-
-
-def mwu(df):
-    linked = df.query('link == "linked"')["lm_effect"]
-    unlinked = df.query('link == "unlinked"')["lm_effect"]
-    return pd.Series(stats.mannwhitneyu(linked, unlinked, alternative="greater").pvalue)
-
-
-dmwuL = (
-    d.groupby(["chrom", "bin", "binmid"])
-    .apply(mwu)
-    .reset_index()
-    .rename(columns={0: "pval"})
-)
-
-d = (
-    pd.read_csv("plot_data/sites_post.csv")
-    .drop(columns=["Unnamed: 0"])
-    .query('treatment == "P" and chrom == "3R"')
-)
 
-d["lm_effect"] = -d["lm_effect"]
+def mwu_bins(d, chrom, alternative):
+    """Per-bin MWU p-values of linked vs unlinked -lm_effect in P on one arm"""
+    d = d.query('treatment == "P" and chrom == @chrom').copy()
+    d["lm_effect"] = -d["lm_effect"]
 
-# use the pos column to assign bin id to each site with 500000 bp bins
-d["bin"] = (d["pos"] / binsize).astype(int)
-d["binmid"] = d["bin"] * binsize + binsize / 2
+    # use the pos column to assign bin id to each site with 500000 bp bins
+    d["bin"] = (d["pos"] / binsize).astype(int)
+    d["binmid"] = d["bin"] * binsize + binsize / 2
 
+    def mwu(df):
+        linked = df.query('link == "linked"')["lm_effect"]
+        unlinked = df.query('link == "unlinked"')["lm_effect"]
+        return pd.Series(
+            stats.mannwhitneyu(linked, unlinked, alternative=alternative).pvalue
+        )
 
-def mwu(df):
-    linked = df.query('link == "linked"')["lm_effect"]
-    unlinked = df.query('link == "unlinked"')["lm_effect"]
-    return pd.Series(stats.mannwhitneyu(linked, unlinked, alternative="less").pvalue)
+    return (
+        d.groupby(["chrom", "bin", "binmid"], observed=True)
+        .apply(mwu)
+        .reset_index()
+        .rename(columns={0: "pval"})
+    )
 
 
-dmwuRev = (
-    d.groupby(["chrom", "bin", "binmid"])
-    .apply(mwu)
-    .reset_index()
-    .rename(columns={0: "pval"})
-)
+def mwu_tests(sites, sites_post):
+    """The mwu table: 3L and 3R during treatment, 3R reversal after it"""
+    dmwuR = mwu_bins(sites, "3R", "greater")
+    dmwuL = mwu_bins(sites, "3L", "greater")
+    dmwuRev = mwu_bins(sites_post, "3R", "less")
 
-pd.concat(
-    [
+    # in region mode an arm can have no bins
+    parts = [
         dmwuL.assign(sweep="trt", chrom="3L"),
         dmwuR.assign(sweep="trt", chrom="3R"),
         dmwuRev.assign(sweep="rev", chrom="3R"),
     ]
-).to_csv("plot_data/mwu.csv", index=False)
+    parts = [p for p in parts if len(p)]
+    return pd.concat(parts) if parts else pl.DataFrame(schema=MWU)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", action="store_true", help="also export mwu as CSV")
+    args = add_arguments(add_region_argument(parser)).parse_args()
+    run = Run.from_args("06_mwu_tests", args)
+
+    run.begin("test")
+    dmwu = mwu_tests(
+        select_regions(read_table("sites"), args.region).to_pandas(),
+        select_regions(read_table("sites_post"), args.region).to_pandas(),
+    )
+    run.end(rows=dmwu.shape[0])
+
+    run.begin("write")
+    write_table(dmwu, "mwu", csv=args.csv)
+    run.finish()
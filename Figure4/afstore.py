@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Quantized storage for the allele frequency matrix (afmat).
+
+`01_process_data.R` writes `afmat.npy` as dense float64, far more precision
+than HAF-pipe frequency estimates carry. This module stores it as uint16
+fixed point instead: a frequency f in [0, 1] is kept as round(f * 65534),
+and 65535 marks a missing value (NaN). The maximum absolute error is
+1 / (2 * 65534) ~ 7.6e-6 plus float32 rounding (< 1.2e-7), well below the
+resolution of any pooled-sequencing frequency; the file is 4x smaller than
+float64 and half the size of float32.
+
+The quantized file is a plain `.npy` array, so it is memory-mapped and only
+the rows or blocks a stage touches are read and dequantized to float32:
+
+    python afstore.py data/processed/afmat.npy   # writes afmat.q16.npy
+
+    afmat = open_afmat()        # q16 if current, else afmat.npy
+    afmat[site_idx, freq_idx]   # float32
+    for start, block in afmat.blocks(100_000): ...
+
+`convert` records the size, mtime and shape of the afmat.npy it read in
+`afmat.q16.json`; `open_afmat` only uses the q16 file while they still match,
+so rerunning `01_process_data.R` cannot leave 03 reading stale frequencies.
+
+`ColumnStore` keeps the same quantized values in append-only column chunks,
+so that new sequencing timepoints can be added without rewriting the
+existing matrix (see update_sites.py).
+"""
+
+import argparse
+import json
+import os
+import warnings
+
+import numpy as np
+import polars as pl
+
+from tables import PROCESSED
+
+SCALE = 65534
+MISSING = 65535
+MAX_ERROR = 0.5 / SCALE + float(np.finfo(np.float32).eps)
+
+AFMAT = os.path.join(PROCESSED, "afmat.npy")
+AFMAT_Q16 = os.path.join(PROCESSED, "afmat.q16.npy")
+
+
+def quantize(freqs):
+    freqs = np.asarray(freqs)
+    missing = np.isnan(freqs)
+    lo, hi = np.nanmin(freqs, initial=0), np.nanmax(freqs, initial=0)
+    if lo < 0 or hi > 1:
+        raise ValueError(f"frequencies outside [0, 1] (range {lo} to {hi})")
+    q = np.rint(np.where(missing, 0, freqs) * SCALE).astype(np.uint16)
+    q[missing] = MISSING
+    return q
+
+
+def dequantize(q):
+    q = np.asarray(q)
+    f = q.astype(np.float32) * np.float32(1 / SCALE)
+    f[q == MISSING] = np.nan
+    return f
+
+
+class QuantizedAfmat:
+    """Memory-mapped uint16 afmat that dequantizes to float32 on access"""
+
+    def __init__(self, path=AFMAT_Q16):
+        self.path = path
+        self.q = np.load(path, mmap_mode="r")
+        if self.q.dtype != np.uint16:
+            raise TypeError(f"{path}: expected uint16, got {self.q.dtype}")
+        self.shape = self.q.shape
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return dequantize(self.q[key])
+
+    def blocks(self, rows=100_000):
+        # (first row, float32 block) pairs covering the whole matrix
+        for start in range(0, self.shape[0], rows):
+            yield start, dequantize(self.q[start : start + rows])
+
+    @property
+    def nbytes(self):
+        # bytes held once the whole matrix is paged in
+        return self.q.nbytes
+
+    def __array__(self, dtype=None, copy=None):
+        f = dequantize(self.q)
+        return f if dtype is None else f.astype(dtype)
+
+
+def source_stamp(path):
+    """Size, mtime and shape of an .npy file, to tell whether it changed"""
+    stat = os.stat(path)
+    shape = list(np.load(path, mmap_mode="r").shape)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "shape": shape}
+
+
+def stamp_path(q16):
+    return os.path.splitext(q16)[0] + ".json"
+
+
+def convert(src=AFMAT, dst=AFMAT_Q16, rows=100_000):
+    # block by block, so the float64 matrix is never fully in memory
+    freqs = np.load(src, mmap_mode="r")
+    out = np.lib.format.open_memmap(
+        dst, mode="w+", dtype=np.uint16, shape=freqs.shape
+    )
+    error = 0.0
+    for start in range(0, freqs.shape[0], rows):
+        block = np.asarray(freqs[start : start + rows])
+        out[start : start + rows] = q = quantize(block)
+        diff = np.abs(dequantize(q) - block)
+        error = max(error, float(np.nanmax(diff, initial=0)))
+    out.flush()
+    with open(stamp_path(dst), "w") as f:
+        json.dump({"source": source_stamp(src)}, f)
+    return error
+
+
+def open_afmat(directory=PROCESSED):
+    # prefer the quantized matrix while it matches the float64 one from 01
+    q16 = os.path.join(directory, os.path.basename(AFMAT_Q16))
+    src = os.path.join(directory, os.path.basename(AFMAT))
+    if os.path.exists(q16):
+        if not os.path.exists(src):
+            # only the quantized copy was kept
+            return QuantizedAfmat(q16)
+        try:
+            with open(stamp_path(q16)) as f:
+                stamp = json.load(f)["source"]
+        except (OSError, ValueError, KeyError):
+            stamp = None
+        if stamp == source_stamp(src):
+            return QuantizedAfmat(q16)
+        warnings.warn(
+            f"{q16} was not built from the current {src}; reading {src}. "
+            "Rerun afstore.py to update it."
+        )
+    return np.load(src, mmap_mode="r")
+
+
+def afmat_sizes(afmat):
+    # (bytes on disk, bytes in memory, bytes as float64) for the run reports
+    n = int(np.prod(afmat.shape))
+    path = afmat.path if isinstance(afmat, QuantizedAfmat) else afmat.filename
+    return os.path.getsize(path), int(afmat.nbytes), 8 * n
+
+
+class ColumnStore:
+    """Append-only afmat stored as column chunks, one file per append
+
+    Each chunk holds the frequencies of the samples added together, stored
+    samples x sites (one contiguous row per sample column) and quantized
+    as above, so reading a sample's column touches only its own bytes and
+    adding samples never rewrites existing chunks. `manifest.json` lists
+    the chunks and their samples' metadata; it is replaced atomically after
+    the new chunk is written.
+
+        store = ColumnStore.create("data/processed/afstore", afmat, samps)
+        store.append(new_freqs, new_samps)      # sites x new samples
+        store.columns([0, 5])                   # float32, sites x 2
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.n_sites = self.manifest["n_sites"]
+        self._chunks = {}
+
+    @classmethod
+    def create(cls, path, freqs=None, samps=None, n_sites=None):
+        os.makedirs(path, exist_ok=True)
+        if n_sites is None:
+            n_sites = freqs.shape[0]
+        manifest = {"n_sites": int(n_sites), "scale": SCALE, "chunks": []}
+        cls._write_manifest(path, manifest)
+        store = cls(path)
+        if freqs is not None:
+            store.append(freqs, samps)
+        return store
+
+    @classmethod
+    def _write_manifest(cls, path, manifest):
+        tmp = os.path.join(path, cls.MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(path, cls.MANIFEST))
+
+    @property
+    def n_samples(self):
+        return sum(len(c["samples"]) for c in self.manifest["chunks"])
+
+    def samps(self):
+        """Sample metadata with 0-based freq_idx in append order"""
+        rows = [s for c in self.manifest["chunks"] for s in c["samples"]]
+        return pl.DataFrame(rows).with_columns(
+            pl.int_range(pl.len(), dtype=pl.UInt32).alias("freq_idx")
+        )
+
+    def append(self, freqs, samps, rows=100_000):
+        """Add sample columns; freqs is sites x samples, samps a frame"""
+        if freqs.shape[0] != self.n_sites:
+            raise ValueError(f"expected {self.n_sites} sites, got {freqs.shape[0]}")
+        samps = pl.DataFrame(samps).drop("freq_idx", strict=False)
+        if samps.height != freqs.shape[1]:
+            raise ValueError(f"{freqs.shape[1]} columns but {samps.height} samples")
+
+        start = self.n_samples
+        name = f"chunk-{len(self.manifest['chunks']):05d}.npy"
+        out = np.lib.format.open_memmap(
+            os.path.join(self.path, name),
+            mode="w+",
+            dtype=np.uint16,
+            shape=(freqs.shape[1], self.n_sites),
+        )
+        for r in range(0, self.n_sites, rows):
+            out[:, r : r + rows] = quantize(np.asarray(freqs[r : r + rows])).T
+        out.flush()
+        del out
+
+        manifest = dict(self.manifest)
+        manifest["chunks"] = self.manifest["chunks"] + [
+            {"file": name, "start": start, "samples": samps.to_dicts()}
+        ]
+        self._write_manifest(self.path, manifest)
+        self.manifest = manifest
+        return np.arange(start, start + samps.height)
+
+    def _chunk(self, i):
+        if i not in self._chunks:
+            file = self.manifest["chunks"][i]["file"]
+            self._chunks[i] = np.load(os.path.join(self.path, file), mmap_mode="r")
+        return self._chunks[i]
+
+    def columns(self, freq_idx, sites=slice(None)):
+        """float32 sites x len(freq_idx), reading only those columns"""
+        starts = np.array([c["start"] for c in self.manifest["chunks"]])
+        freq_idx = np.atleast_1d(freq_idx)
+        n = len(range(self.n_sites)[sites])
+        out = np.empty((n, len(freq_idx)), dtype=np.float32)
+        for j, f in enumerate(freq_idx):
+            i = int(np.searchsorted(starts, f, side="right")) - 1
+            out[:, j] = dequantize(self._chunk(i)[f - starts[i], sites])
+        return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("src", nargs="?", default=AFMAT)
+    parser.add_argument("dst", nargs="?", default=AFMAT_Q16)
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    error = convert(args.src, args.dst, args.rows)
+    before, after = os.path.getsize(args.src), os.path.getsize(args.dst)
+    print(
+        f"{args.src}: {before / 2**20:.1f} MiB -> {args.dst}: {after / 2**20:.1f} MiB "
+        f"({before / after:.1f}x), max abs error {error:.2e} (bound {MAX_ERROR:.2e})"
+    )
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Benchmark the Figure4 Python stages on synthetic data across scales.
+
+For every scale (SNPs per chromosome arm) a working directory is populated by
+`synth.py` and the numbered stages are run in it as subprocesses, exactly as
+they would be run by hand. Per-stage wall time and the step breakdown from each
+stage's run report are collected into one JSON file, which can be compared to
+an earlier benchmark:
+
+    python bench.py --scales 500 2000 8000 --stages 02 03 04a 04b
+    python bench.py --scales 500 2000 --compare reports/bench-20260101-120000.json
+
+All stages run by default. Stage 05 runs 100,000 bootstrap iterations per
+window and dominates any run it is part of; `--replicates` lowers that.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import synth
+from instrument import REPORTS, compare
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ["02", "03", "04a", "04b", "05", "06"]
+
+
+def stage_script(stage):
+    (script,) = glob.glob(os.path.join(HERE, f"{stage}_*.py"))
+    return script
+
+
+def run_stage(stage, workdir, report_dir, extra=()):
+    script = stage_script(stage)
+    name = os.path.basename(script)[:-3]
+    before = set(glob.glob(os.path.join(report_dir, f"{name}-*.json")))
+
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, script, "--report-dir", report_dir, *extra],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    wall = time.perf_counter() - t0
+
+    record = {"stage": stage, "wall_s": wall, "returncode": proc.returncode}
+    new = set(glob.glob(os.path.join(report_dir, f"{name}-*.json"))) - before
+    if proc.returncode != 0:
+        record["stderr"] = proc.stderr[-2000:]
+    elif new:
+        with open(max(new, key=os.path.getmtime)) as f:
+            record["report"] = json.load(f)
+    return record
+
+
+def bench(scales, stages, workdir, seed=0, replicates=None, **synth_args):
+    results = []
+    for scale in scales:
+        root = os.path.join(workdir, f"snps{scale}")
+        report_dir = os.path.join(root, REPORTS)
+        n_sites, n_samps = synth.generate(
+            root, snps_per_arm=scale, seed=seed, **synth_args
+        )
+        for stage in stages:
+            extra = []
+            if stage == "05" and replicates is not None:
+                extra = ["--replicates", str(replicates)]
+            record = run_stage(stage, root, report_dir, extra)
+            record.update(snps_per_arm=scale, n_sites=n_sites, n_samps=n_samps)
+            status = "ok" if record["returncode"] == 0 else "FAILED"
+            print(f"snps/arm={scale:<8} {stage:<4} {record['wall_s']:8.1f}s  {status}")
+            results.append(record)
+            if record["returncode"] != 0:
+                # later stages depend on this one's outputs
+                break
+    return results
+
+
+def compare_benchmarks(old, new, tolerance):
+    old_records = {(r["snps_per_arm"], r["stage"]): r for r in old["results"]}
+    regressions = []
+    for r in new["results"]:
+        o = old_records.get((r["snps_per_arm"], r["stage"]))
+        if o is None or "report" not in o or "report" not in r:
+            continue
+        print(f"\n== snps/arm={r['snps_per_arm']} stage {r['stage']}")
+        for step in compare(o["report"], r["report"], tolerance):
+            regressions.append(f"{r['snps_per_arm']}/{r['stage']}/{step}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[500, 2000], help="SNPs per arm"
+    )
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--lines", type=int, default=76)
+    parser.add_argument("--cages", type=int, default=10)
+    parser.add_argument("--timepoints", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replicates", type=int, help="bootstrap replicates of 05")
+    parser.add_argument("--workdir", help="keep generated data here")
+    parser.add_argument("--out", help="results file (default: reports/bench-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="figure4-bench-")
+    started = datetime.now()
+    try:
+        results = bench(
+            args.scales,
+            args.stages,
+            workdir,
+            seed=args.seed,
+            replicates=args.replicates,
+            lines=args.lines,
+            cages=args.cages,
+            timepoints=args.timepoints,
+        )
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = args.out or os.path.join(
+        HERE, REPORTS, f"bench-{started.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    summary = {
+        "started": started.isoformat(timespec="seconds"),
+        "argv": sys.argv,
+        "results": results,
+    }
+    with open(out, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"results written to {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_benchmarks(json.load(f), summary, args.tolerance)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,150 @@
+"""Hierarchical cage-and-SNP bootstrap of the window medians of lm_effect.
+
+`compute_windows` in 05 resamples SNPs within a window only, as if the GLM
+effects were free of cage-to-cage noise. Here each replicate first draws the
+cages of the treatment with replacement and then the SNPs of the window. The
+spread between cages comes from the per-cage total_delta in
+`sites_main.parquet` (03): a SNP's value under cage weights w is
+
+    lm_effect + sum_c w_c (total_delta_c - mean_c total_delta)
+
+so the full set of cages gives back lm_effect itself. Both levels are
+batched weight matrices rather than loops:
+
+- cage weights W (replicates x cages), drawn once per group, so that all
+  windows of an arm see the same cage resamples,
+- SNP counts K (replicates x SNPs) per window, from one draw of indices,
+
+and a batch of replicate medians is a matrix product, one row-wise sort and
+a cumulative sum of K. The windows are those of `compute_windows`, and
+`05_windows_and_reversal.py --bootstrap hierarchical` writes the same
+window tables from them.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from checkpoint import unit_rng
+
+# replicates x SNPs elements per batch
+BATCH_ELEMENTS = 1 << 22
+
+
+def cage_deviations(sites, main):
+    """Per-cage deviations of total_delta from the cage mean, for each site
+
+    sites holds one treatment of sites.arrow / sites_post.arrow (pandas),
+    main the rows of sites_main for that treatment and sweep (polars).
+    Returns a (sites, cages) matrix in the orientation of sites' lm_effect;
+    04a/04b flip some SNPs, which shows as an lm_effect of opposite sign to
+    that in sites_main. Cages without a row add no deviation.
+    """
+    cages = np.unique(main["cage"].to_numpy())
+    wide = (
+        main.pivot(on="cage", index=["chrom", "pos", "lm_effect"], values="total_delta")
+        .rename({str(c): f"cage_{c}" for c in cages})
+        .rename({"lm_effect": "main_effect"})
+    )
+    columns = [f"cage_{c}" for c in cages]
+    x = (
+        pl.from_pandas(sites[["chrom", "pos"]])
+        .cast({"chrom": main["chrom"].dtype, "pos": main["pos"].dtype})
+        .join(wide, on=["chrom", "pos"], how="left", maintain_order="left")
+    )
+    delta = x.select(columns).to_numpy().astype(np.float64)
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # sites without any cage row have an all-NaN row
+        warnings.simplefilter("ignore", RuntimeWarning)
+        dev = np.nan_to_num(delta - np.nanmean(delta, axis=1, keepdims=True))
+    flip = np.sign(sites["lm_effect"].to_numpy()) * np.sign(
+        x["main_effect"].fill_null(0).to_numpy()
+    )
+    return dev * np.where(flip < 0, -1.0, 1.0)[:, None]
+
+
+def cage_weights(replicates, cages, rng):
+    """(replicates, cages) resampling weights that sum to 1 per replicate"""
+    draws = rng.integers(0, cages, (replicates, cages))
+    return counts(draws, cages) / cages
+
+
+def counts(draws, n):
+    """Row-wise multiplicities of the indices in draws, (rows, n)"""
+    rows = len(draws)
+    flat = draws + n * np.arange(rows)[:, None]
+    return np.bincount(flat.ravel(), minlength=rows * n).reshape(rows, n)
+
+
+def weighted_medians(values, k):
+    """Median of each row of values repeated k times (k sums to n per row)"""
+    n = values.shape[1]
+    order = np.argsort(values, axis=1)
+    v = np.take_along_axis(values, order, axis=1)
+    c = np.cumsum(np.take_along_axis(k, order, axis=1), axis=1)
+    # ranks (n + 1) // 2 and n // 2 + 1 are the two middle elements
+    rows = np.arange(len(values))
+    lo = (c < (n + 1) // 2).sum(axis=1)
+    hi = (c < n // 2 + 1).sum(axis=1)
+    return (v[rows, lo] + v[rows, hi]) / 2
+
+
+def window_replicates(effect, dev, w, rng):
+    """Replicate medians of one window's SNPs under the cage weights w"""
+    n = len(effect)
+    boots = np.empty(len(w))
+    batch = max(1, BATCH_ELEMENTS // n)
+    for a in range(0, len(w), batch):
+        wb = w[a : a + batch]
+        # the deviations sum to 0 over cages, so the weights need no centring
+        values = effect + wb @ dev.T
+        k = counts(rng.integers(0, n, (len(wb), n)), n)
+        boots[a : a + batch] = weighted_medians(values, k)
+    return boots
+
+
+def hierarchical_windows(
+    d, dev, w=1e6, start=0, replicates=100_000, seed=None, unit=(), checkpoint=None
+):
+    """compute_windows with cages and SNPs resampled
+
+    d holds one (treatment, chrom, link) group, unit its key, and dev its rows
+    of cage_deviations. The cage weights are drawn from the seed and unit, the
+    SNPs of each window from the seed, unit and window start, so windows
+    loaded from a checkpoint leave the others' draws unchanged.
+    """
+    order = np.argsort(d["pos"].to_numpy(), kind="stable")
+    pos = d["pos"].to_numpy()[order].astype(np.int64)
+    effect = d["lm_effect"].to_numpy()[order].astype(np.float64)
+    dev = dev[order]
+
+    breakpoints = np.arange(start, pos.max(), w)
+    breakpoints = np.r_[breakpoints, breakpoints[-1] + w]
+    weights = cage_weights(replicates, dev.shape[1], unit_rng(seed, unit))
+
+    rows = []
+    for lo, hi in zip(breakpoints[:-1], breakpoints[1:]):
+        key = (*unit, lo)
+        if checkpoint is not None and key in checkpoint:
+            rows.append(checkpoint.load(key))
+            continue
+        # both ends included, as GenomeIndex.interval in compute_windows
+        a, b = np.searchsorted(pos, lo, "left"), np.searchsorted(pos, hi, "right")
+        if b > a:
+            rng = unit_rng(seed, key)
+            boots = window_replicates(effect[a:b], dev[a:b], weights, rng)
+        else:
+            boots = np.full(1, np.nan)
+        row = {
+            "mid": (lo + hi) / 2,
+            "lm_median": np.median(boots),
+            "lm_lower": np.quantile(boots, 0.025),
+            "lm_upper": np.quantile(boots, 0.975),
+            "nsnp": b - a,
+        }
+        if checkpoint is not None:
+            checkpoint.save(key, row)
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,107 @@
+"""Resumable work units for the long-running stages.
+
+The correlation pools of 02, 04a and 04b and the window bootstraps of 05 are
+split into units that do not depend on each other: SNP blocks (start, stop)
+and (treatment, chrom, link, window start) tasks. With `--checkpoint [DIR]`
+each finished unit is written to
+
+    DIR/<stage>-<digest>/<unit>.pkl
+
+right away, through a temporary file that is renamed into place, so a unit's
+file is either complete or absent. The digest covers everything the results
+depend on (input arrays and frames, parameters, seeds), so a rerun with the
+same inputs and seed loads the finished units and computes only the rest,
+while changed inputs start a new store. The bootstraps draw each unit from
+its own generator, seeded by the seed and the unit, so a resumed run gives
+the same numbers as an uninterrupted one. Remove DIR to start over.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+CHECKPOINTS = "checkpoints"
+
+
+def digest(*parts):
+    """A hex digest of arrays, frames and plain values"""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(repr((part.shape, part.dtype.str)).encode())
+            h.update(np.ascontiguousarray(part).data)
+        elif isinstance(part, pd.DataFrame):
+            h.update(repr(list(part.columns)).encode())
+            h.update(pd.util.hash_pandas_object(part, index=False).to_numpy())
+        elif isinstance(part, pl.DataFrame):
+            h.update(repr(part.schema).encode())
+            h.update(part.hash_rows(seed=0).to_numpy())
+        else:
+            h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+def unit_rng(seed, unit):
+    """A generator of its own for one work unit; fresh entropy without seed"""
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, zlib.crc32(repr(unit).encode())])
+
+
+class Checkpoints:
+    """The finished units of one stage and set of inputs"""
+
+    def __init__(self, directory, stage, *inputs):
+        self.path = os.path.join(directory, f"{stage}-{digest(*inputs)}")
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, unit):
+        name = "_".join(str(u) for u in unit) if isinstance(unit, tuple) else unit
+        return os.path.join(self.path, f"{name}.pkl")
+
+    def __contains__(self, unit):
+        return os.path.exists(self._file(unit))
+
+    def __len__(self):
+        return sum(f.endswith(".pkl") for f in os.listdir(self.path))
+
+    def load(self, unit):
+        with open(self._file(unit), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, unit, value):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._file(unit))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return value
+
+
+def add_checkpoint_argument(parser):
+    parser.add_argument(
+        "--checkpoint",
+        nargs="?",
+        const=CHECKPOINTS,
+        help="keep finished work units in this directory (default "
+        f"{CHECKPOINTS}) and skip them when rerun",
+    )
+    return parser
+
+
+def open_checkpoints(args, stage, *inputs):
+    """The Checkpoints of --checkpoint for these inputs, or None"""
+    if not args.checkpoint:
+        return None
+    return Checkpoints(args.checkpoint, stage, *inputs)
@@ -0,0 +1,146 @@
+"""Sorted (chrom, pos) index over sites, afmat rows and per-site values.
+
+The index keeps one position-sorted array per chromosome arm, so exact
+lookups, interval and nearest-neighbour queries are binary searches instead of
+string joins or full-table `query` calls. Sites are identified by `site_idx`,
+the 0-based row of `afmat` (and of any array aligned with it). When the sites
+are already stored sorted by chrom and position - as `sites.csv` is - interval
+queries return slices, and `take` hands back views of `afmat` or of attached
+per-site arrays (r, r2, lm_effect) without copying.
+
+    idx = GenomeIndex.from_sites(pl.read_csv("data/processed/sites.csv"))
+    ace = idx.take(afmat, "3R", 8_569_500, 9_569_500)
+"""
+
+import numpy as np
+
+from tables import CHROMS
+
+
+class GenomeIndex:
+    def __init__(self, chrom, pos, site_idx=None):
+        pos = np.asarray(pos, dtype=np.int64)
+        # a scalar chrom labels a frame that holds a single arm
+        chrom = np.broadcast_to(np.asarray(chrom).astype(str), pos.shape)
+        if site_idx is None:
+            site_idx = np.arange(len(pos))
+        site_idx = np.asarray(site_idx, dtype=np.int64)
+
+        # known arms first, in the usual order, then anything else
+        names = list(dict.fromkeys(chrom.tolist()))
+        self.chroms = [c for c in CHROMS if c in names] + [
+            c for c in names if c not in CHROMS
+        ]
+        rank = {c: i for i, c in enumerate(self.chroms)}
+        codes = _codes(chrom, rank)
+
+        order = np.lexsort((pos, codes))
+        self.pos = pos[order]
+        self.site_idx = site_idx[order]
+        self.n = len(pos)
+        self.size = int(site_idx.max()) + 1 if self.n else 0
+        # rows stored in (chrom, pos) order with site_idx == row number
+        self.contiguous = bool(np.array_equal(self.site_idx, np.arange(self.n)))
+
+        bounds = np.searchsorted(codes[order], np.arange(len(self.chroms) + 1))
+        self.bounds = {
+            c: (int(bounds[i]), int(bounds[i + 1])) for i, c in enumerate(self.chroms)
+        }
+        self.values = {}
+
+    @classmethod
+    def from_sites(cls, sites, one_based=True):
+        # sites.csv carries 1-based R indices in site_idx
+        site_idx = None
+        if "site_idx" in sites.columns:
+            site_idx = np.asarray(sites["site_idx"]) - (1 if one_based else 0)
+        return cls(np.asarray(sites["chrom"]), np.asarray(sites["pos"]), site_idx)
+
+    def __len__(self):
+        return self.n
+
+    def _range(self, chrom, start, end, closed="both"):
+        lo, hi = self.bounds.get(chrom, (0, 0))
+        pos = self.pos[lo:hi]
+        left = "left" if closed in ("both", "left") else "right"
+        right = "right" if closed in ("both", "right") else "left"
+        return lo + np.searchsorted(pos, start, left), lo + np.searchsorted(
+            pos, end, right
+        )
+
+    def interval(self, chrom, start, end, closed="both"):
+        """site_idx of the sites in [start, end] on `chrom` (see `closed`)"""
+        lo, hi = self._range(chrom, start, end, closed)
+        return self.site_idx[lo:hi]
+
+    def positions(self, chrom, start=None, end=None, closed="both"):
+        lo, hi = self.bounds.get(chrom, (0, 0))
+        if start is not None or end is not None:
+            lo, hi = self._range(
+                chrom,
+                -np.inf if start is None else start,
+                np.inf if end is None else end,
+                closed,
+            )
+        return self.pos[lo:hi]
+
+    def lookup(self, chrom, pos):
+        """site_idx for each (chrom, pos), -1 where the site is not indexed"""
+        chrom = np.broadcast_to(np.asarray(chrom).astype(str), np.shape(pos))
+        pos = np.asarray(pos, dtype=np.int64)
+        out = np.full(pos.shape, -1, dtype=np.int64)
+        for c in np.unique(chrom):
+            if c not in self.bounds:
+                continue
+            lo, hi = self.bounds[c]
+            sel = chrom == c
+            i = np.searchsorted(self.pos[lo:hi], pos[sel])
+            i_clip = np.minimum(i, hi - lo - 1)
+            found = (i < hi - lo) & (self.pos[lo:hi][i_clip] == pos[sel])
+            out[sel] = np.where(found, self.site_idx[lo + i_clip], -1)
+        return out
+
+    def nearest(self, chrom, pos, k=1):
+        """site_idx of the k sites closest to `pos` on `chrom`, closest first"""
+        lo, hi = self.bounds.get(chrom, (0, 0))
+        k = min(k, hi - lo)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        # the k nearest lie within k rows either side of the insertion point
+        i = np.searchsorted(self.pos[lo:hi], pos)
+        a, b = max(i - k, 0), min(i + k, hi - lo)
+        dist = np.abs(self.pos[lo + a : lo + b] - pos)
+        best = np.argsort(dist, kind="stable")[:k]
+        return self.site_idx[lo + a + best]
+
+    def take(self, array, chrom, start, end, closed="both"):
+        """Rows of a site-aligned array in an interval; a view when possible"""
+        lo, hi = self._range(chrom, start, end, closed)
+        if self.contiguous:
+            return array[lo:hi]
+        return array[self.site_idx[lo:hi]]
+
+    def attach(self, name, values):
+        # per-site values aligned with site_idx, e.g. r2 or lm_effect
+        values = np.asarray(values)
+        if len(values) != self.size:
+            raise ValueError(f"{name}: expected {self.size} values, got {len(values)}")
+        self.values[name] = values
+        return self
+
+    def get(self, name, chrom, start, end, closed="both"):
+        return self.take(self.values[name], chrom, start, end, closed)
+
+    def align(self, chrom, pos, values, fill=np.nan):
+        """Scatter values keyed by (chrom, pos) into a site-aligned array"""
+        values = np.asarray(values)
+        idx = self.lookup(chrom, pos)
+        out = np.full(self.size, fill, dtype=np.result_type(values.dtype, type(fill)))
+        out[idx[idx >= 0]] = values[idx >= 0]
+        return out
+
+
+def _codes(chrom, rank):
+    # np.unique sorts the names; map its inverse onto the index's chrom order
+    names, inverse = np.unique(chrom, return_inverse=True)
+    return np.array([rank[c] for c in names], dtype=np.int64)[inverse]
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""Per-step timing, memory and row-count reports for the Figure4 stages.
+
+Every numbered Python script creates a `Run`, brackets its work in named steps
+(load, correlate, classify, join, match, bootstrap, write) and writes a JSON
+report to `reports/` when it finishes. Running this module directly compares
+two reports step by step:
+
+    python instrument.py reports/old.json reports/new.json --tolerance 0.2
+"""
+
+import argparse
+import cProfile
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+REPORTS = "reports"
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_RSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+
+def _peak_rss(who=resource.RUSAGE_SELF):
+    # VmHWM follows resets through clear_refs, ru_maxrss does not
+    if who == resource.RUSAGE_SELF:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return resource.getrusage(who).ru_maxrss * _RSS_SCALE
+
+
+def _reset_peak_rss():
+    # Linux can reset the high-water mark so that each step reports its own
+    # peak; elsewhere the peak is cumulative over the process lifetime
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _children_cpu():
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--report-dir",
+        default=REPORTS,
+        help="directory for the JSON run report (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="attach a sampling profiler (pyinstrument, else cProfile)",
+    )
+    return parser
+
+
+class Run:
+    def __init__(self, stage, report_dir=REPORTS, profile=False):
+        self.stage = stage
+        self.report_dir = report_dir
+        self.steps = []
+        self.meta = {}
+        self._open = None
+        self._started = datetime.now()
+        self._t0 = (time.perf_counter(), time.process_time(), _children_cpu())
+        self._profiler = self._start_profiler() if profile else None
+
+    @classmethod
+    def from_args(cls, stage, args):
+        return cls(stage, args.report_dir, args.profile)
+
+    def _start_profiler(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument not installed, falling back to cProfile")
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+
+    def begin(self, name):
+        if self._open is not None:
+            self.end()
+        per_step = _reset_peak_rss()
+        self._open = {
+            "name": name,
+            "per_step_rss": per_step,
+            "t": (time.perf_counter(), time.process_time(), _children_cpu()),
+        }
+
+    def end(self, rows=None):
+        if self._open is None:
+            return
+        wall, cpu, child_cpu = self._open["t"]
+        if rows is None:
+            rows = self._open.get("rows")
+        self.steps.append(
+            {
+                "name": self._open["name"],
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu,
+                "children_cpu_s": _children_cpu() - child_cpu,
+                "peak_rss_bytes": _peak_rss(),
+                "peak_rss_is_per_step": self._open["per_step_rss"],
+                "rows": None if rows is None else int(rows),
+            }
+        )
+        self._open = None
+
+    def frame(self, name, rows, nbytes, wide_bytes=None):
+        # size of an in-memory frame, next to what it would take uncompacted
+        self.meta.setdefault("frames", {})[name] = {
+            "rows": int(rows),
+            "bytes": int(nbytes),
+            "wide_bytes": int(nbytes if wide_bytes is None else wide_bytes),
+        }
+
+    def rows(self, n):
+        # attach a row count to the open step without closing it
+        if self._open is not None:
+            self._open["rows"] = int(n)
+
+    @contextmanager
+    def step(self, name):
+        self.begin(name)
+        try:
+            yield self
+        finally:
+            self.end()
+
+    def report(self):
+        wall, cpu, child_cpu = self._t0
+        return {
+            "stage": self.stage,
+            "started": self._started.isoformat(timespec="seconds"),
+            "argv": sys.argv,
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "meta": self.meta,
+            "steps": self.steps,
+            "total": {
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu,
+                "children_cpu_s": _children_cpu() - child_cpu,
+                "peak_rss_bytes": _peak_rss(),
+                "children_peak_rss_bytes": _peak_rss(resource.RUSAGE_CHILDREN),
+            },
+        }
+
+    def finish(self):
+        self.end()
+        os.makedirs(self.report_dir, exist_ok=True)
+        stamp = self._started.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.report_dir, f"{self.stage}-{stamp}")
+
+        if self._profiler is not None:
+            if isinstance(self._profiler, cProfile.Profile):
+                self._profiler.disable()
+                self._profiler.dump_stats(f"{base}.prof")
+            else:
+                self._profiler.stop()
+                with open(f"{base}.html", "w") as f:
+                    f.write(self._profiler.output_html())
+
+        report = self.report()
+        with open(f"{base}.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+        for s in self.steps:
+            rows = "" if s["rows"] is None else f", {s['rows']:,} rows"
+            print(
+                f"[{self.stage}] {s['name']}: {s['wall_s']:.1f}s wall, "
+                f"{s['cpu_s'] + s['children_cpu_s']:.1f}s cpu, "
+                f"{s['peak_rss_bytes'] / 2**20:.0f} MiB peak{rows}"
+            )
+        for name, f in self.meta.get("frames", {}).items():
+            print(
+                f"[{self.stage}] {name}: {f['rows']:,} rows, "
+                f"{f['bytes'] / 2**20:.1f} MiB (wide dtypes: "
+                f"{f['wide_bytes'] / 2**20:.1f} MiB)"
+            )
+        return report
+
+
+def _by_step(report):
+    # a step name may occur several times in one run, e.g. two "load" phases
+    steps = {}
+    for s in report["steps"]:
+        agg = steps.setdefault(s["name"], {"wall_s": 0.0, "peak_rss_bytes": 0})
+        agg["wall_s"] += s["wall_s"]
+        agg["peak_rss_bytes"] = max(agg["peak_rss_bytes"], s["peak_rss_bytes"])
+    steps["total"] = report["total"]
+    return steps
+
+
+def compare(old, new, tolerance=0.2, min_seconds=0.5):
+    old_steps, new_steps = _by_step(old), _by_step(new)
+    regressions = []
+    print(
+        f"{'step':<12}{'old s':>10}{'new s':>10}{'ratio':>8}"
+        f"{'old MiB':>10}{'new MiB':>10}"
+    )
+    for name, n in new_steps.items():
+        o = old_steps.get(name)
+        if o is None:
+            continue
+        ratio = n["wall_s"] / o["wall_s"] if o["wall_s"] > 0 else float("nan")
+        print(
+            f"{name:<12}{o['wall_s']:>10.2f}{n['wall_s']:>10.2f}{ratio:>8.2f}"
+            f"{o['peak_rss_bytes'] / 2**20:>10.0f}{n['peak_rss_bytes'] / 2**20:>10.0f}"
+        )
+        # ignore timing noise on steps that only take a moment
+        slower = ratio > 1 + tolerance and n["wall_s"] - o["wall_s"] > min_seconds
+        grew = n["peak_rss_bytes"] > o["peak_rss_bytes"] * (1 + tolerance)
+        if slower or grew:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare two run reports")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown or memory growth that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = compare(old, new, args.tolerance)
+    if regressions:
+        print(f"regressions: {', '.join(regressions)}")
+        sys.exit(1)
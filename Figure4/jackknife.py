@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Leave-one-cage-out jackknife of the per-site and per-window summaries.
+
+`sites_main.parquet` (03) holds freq0 and total_delta per site, treatment,
+cage and sweep. They are first put in the orientation of 04a/04b's
+join_sites: post_trt rows take the trt freq0 of their cage, and sites with
+r > 0 to R2 + R3 in `sweep_r2s.csv` (r2_flip) get 1 - freq0 and
+-total_delta. Each site is then summarised by its mean over cages, and the
+mean with each cage left out is derived from the same running sums,
+
+    mean_(-c) = (sum - x_c) / (n - 1)
+
+for every cage at once, so the deletions cost one pass over the table rather
+than one pipeline run per cage. Sites a cage has no row for keep the full
+mean when that cage is left out.
+
+The window medians of these cage means are then taken over the matched
+sites in `plot_data/sites.arrow` (trt) and `plot_data/sites_post.arrow`
+(post_trt), per (treatment, chrom, link) and `--window` bp window counted
+from 0. There each site takes the orientation of its lm_effect in those
+tables, as `bootstrap.cage_deviations` does (04a/04b keep the matched
+unlinked sites unflipped). One median call per window over the sites x cages matrix of
+left-out means gives all deletions together. These are medians of freq0 and
+total_delta, which have per-cage values; the lm_effect medians of 05 come
+from GLM fits over all cages and are not jackknifed here.
+Each window row carries the full-data median, the left-out median and the
+jackknife standard error sqrt((g - 1) / g * sum (m_(-c) - m_(.))^2) over the
+g cages of the treatment.
+
+    python jackknife.py --window 1000000
+
+writes the per-site left-out means to `data/processed/jackknife_sites.parquet`
+and the window table to `plot_data/jackknife_windows.arrow`.
+"""
+
+import argparse
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from instrument import Run, add_arguments
+from tables import (
+    CAGE,
+    CHROM,
+    JACKKNIFE_SITES,
+    POS,
+    PROCESSED,
+    conform,
+    read_sites_main,
+    read_table,
+    table_path,
+    write_table,
+)
+
+VALUES = ["freq0", "total_delta"]
+# each value for the other allele of a site
+FLIPPED = {"freq0": lambda x: 1 - x, "total_delta": np.negative}
+LINKS = {"trt": "sites", "post_trt": "sites_post"}
+CAGE_KEYS = ["chrom", "pos", "treatment", "cage"]
+
+
+def read_flips(path=table_path("sweep_r2s", PROCESSED, "csv")):
+    # r2_flip of 04a/04b: sites positively correlated with R2 + R3
+    return (
+        pl.scan_csv(path)
+        .select(
+            pl.col("chrom").cast(CHROM),
+            pl.col("pos").cast(POS),
+            pl.col("r").gt(0).alias("r2_flip"),
+        )
+        .collect()
+    )
+
+
+def orient(main, flips):
+    """freq0 and total_delta as 04a/04b flip and replace them"""
+    trt = main.filter(pl.col("sweep") == "trt")
+    # as in 04b, post_trt rows start from the trt freq0 of their cage
+    post = (
+        main.filter(pl.col("sweep") == "post_trt")
+        .drop("freq0")
+        .join(trt.select(*CAGE_KEYS, "freq0"), on=CAGE_KEYS)
+        .select(main.columns)
+    )
+    flip = pl.col("r2_flip").fill_null(False)
+    return (
+        pl.concat([trt, post])
+        .join(flips, on=["chrom", "pos"], how="left")
+        .with_columns(
+            pl.when(flip).then(1 - pl.col("freq0")).otherwise("freq0").alias("freq0"),
+            *(
+                pl.when(flip).then(-pl.col(c)).otherwise(c).alias(c)
+                for c in ["total_delta", "lm_effect"]
+            ),
+        )
+        .drop("r2_flip")
+    )
+
+
+def reorient(summaries, flip):
+    """summaries (full, loo) of VALUES for the other allele where flip"""
+    return {
+        v: (
+            np.where(flip, FLIPPED[v](full), full),
+            np.where(flip[:, None], FLIPPED[v](loo), loo),
+        )
+        for v, (full, loo) in summaries.items()
+    }
+
+
+def cage_matrix(g, column, cages):
+    """sites x cages matrix of one value; NaN where a cage has no row"""
+    x = np.full((g["row"].max() + 1, len(cages)), np.nan)
+    col = np.searchsorted(cages, g["cage"].to_numpy())
+    x[g["row"].to_numpy(), col] = g[column].to_numpy()
+    return x
+
+
+def leave_one_out(x):
+    """Full mean over cages (sites,) and left-out means (sites, cages)"""
+    present = ~np.isnan(x)
+    n = present.sum(axis=1, keepdims=True)
+    total = np.nansum(x, axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        full = total / n
+        loo = (total - np.where(present, x, 0)) / (n - present)
+    return full[:, 0], loo
+
+
+def jackknife_se(loo, axis=-1):
+    g = np.sum(~np.isnan(loo), axis=axis)
+    dev = loo - np.nanmean(loo, axis=axis, keepdims=True)
+    with np.errstate(invalid="ignore"):
+        return np.sqrt((g - 1) / g * np.nansum(dev**2, axis=axis))
+
+
+def site_jackknife(g):
+    """Per-site cage means of VALUES with every cage left out in turn
+
+    g holds one (treatment, sweep) of sites_main; returns the sites (chrom,
+    pos, lm_effect, in that order), the cages, and {value: (full, loo)}.
+    """
+    sites = g.select("chrom", "pos", "lm_effect").unique(["chrom", "pos"])
+    sites = sites.sort("chrom", "pos")
+    sites = sites.with_row_index("row")
+    g = g.join(sites, on=["chrom", "pos"])
+    cages = np.unique(g["cage"].to_numpy())
+    return (
+        sites.drop("row"),
+        cages,
+        {v: leave_one_out(cage_matrix(g, v, cages)) for v in VALUES},
+    )
+
+
+def window_jackknife(pos, summaries, cages, window=1_000_000):
+    """Window rows for sites of one arm sorted by pos"""
+    k = pos // window
+    starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+    ends = np.r_[starts[1:], len(k)]
+    rows = []
+    for a, b in zip(starts, ends):
+        # all deletions at once: one median over the window's sites x cages
+        medians = {
+            v: (np.nanmedian(full[a:b]), np.nanmedian(loo[a:b], axis=0))
+            for v, (full, loo) in summaries.items()
+        }
+        se = {v: jackknife_se(m) for v, (_, m) in medians.items()}
+        for j, cage in enumerate(cages):
+            row = {"mid": (k[a] + 0.5) * window, "nsnp": b - a, "cage": cage}
+            for v, (full, loo) in medians.items():
+                row[f"{v}_median"] = loo[j]
+                row[f"{v}_full"] = full
+                row[f"{v}_se"] = se[v]
+            rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--window", type=int, default=1_000_000)
+    parser.add_argument(
+        "--out", default=table_path("jackknife_sites", PROCESSED, "parquet")
+    )
+    parser.add_argument(
+        "--r2s",
+        default=table_path("sweep_r2s", PROCESSED, "csv"),
+        help="the correlations with R2 + R3 written by 04a, for r2_flip",
+    )
+    parser.add_argument(
+        "--csv", action="store_true", help="also export the plot table as CSV"
+    )
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("jackknife", args)
+
+    run.begin("load")
+    main = read_sites_main().select(
+        "chrom", "pos", "treatment", "cage", "sweep", "lm_effect", *VALUES
+    )
+    main = orient(main, read_flips(args.r2s))
+    run.end(rows=main.height)
+
+    writer, windows = None, []
+    for (treatment, sweep), g in main.group_by(
+        "treatment", "sweep", maintain_order=True
+    ):
+        run.begin(f"sites {treatment} {sweep}")
+        sites, cages, summaries = site_jackknife(g)
+        # long per-site table: one row per site and left-out cage
+        loo = sites.select(
+            pl.col("chrom").repeat_by(len(cages)).explode(),
+            pl.col("pos").repeat_by(len(cages)).explode(),
+        ).with_columns(
+            pl.lit(treatment).alias("treatment"),
+            pl.lit(sweep).alias("sweep"),
+            pl.Series("cage", np.tile(cages, sites.height), dtype=CAGE),
+            *(pl.Series(v, m.reshape(-1)) for v, (_, m) in summaries.items()),
+        )
+        loo = conform(loo, JACKKNIFE_SITES, "jackknife_sites")
+        if writer is None:
+            writer = pq.ParquetWriter(args.out, loo.to_arrow().schema)
+        writer.write_table(loo.to_arrow())
+        run.end(rows=loo.height)
+
+        run.begin(f"windows {treatment} {sweep}")
+        links = (
+            read_table(LINKS[sweep])
+            .filter(pl.col("treatment") == treatment)
+            .select("chrom", "pos", "link", pl.col("lm_effect").alias("plot_effect"))
+            .unique()
+        )
+        matched = sites.with_row_index("row").join(links, on=["chrom", "pos"])
+        n = len(windows)
+        for (chrom, link), m in matched.group_by("chrom", "link"):
+            m = m.sort("pos")
+            row = m["row"].to_numpy()
+            # the allele of the site in sites.arrow / sites_post.arrow
+            flip = (m["lm_effect"] * m["plot_effect"]).to_numpy() < 0
+            window_summaries = {v: (f[row], l[row]) for v, (f, l) in summaries.items()}
+            for r in window_jackknife(
+                m["pos"].to_numpy(),
+                reorient(window_summaries, flip),
+                cages,
+                args.window,
+            ):
+                r.update(treatment=treatment, sweep=sweep, chrom=chrom, link=link)
+                windows.append(r)
+        run.end(rows=len(windows) - n)
+    if writer is not None:
+        writer.close()
+
+    run.begin("write")
+    windows = pl.DataFrame(windows).sort(
+        "treatment", "sweep", "chrom", "link", "mid", "cage"
+    )
+    write_table(windows, "jackknife_windows", csv=args.csv)
+    run.finish()
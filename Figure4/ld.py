@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Distance-bounded SNP-SNP linkage disequilibrium from the inbred-line tables.
+
+Pairwise r2 is computed between all SNPs on an arm that are at most
+`--max-dist` bp apart, using the genotype matrix of the
+`*.snpTable.numeric` files. SNPs are processed in position-sorted tiles; each
+tile is only paired with the tiles that overlap its distance window, so memory
+scales with tile size times window size rather than with SNP count squared.
+Correlations are pairwise-complete (missing calls drop the pair, as in the
+ma.corrcoef calls in 02/04a/04b) and computed with six matrix products per
+tile pair. Only pairs with r2 >= `--min-r2` are written, as a sparse table:
+
+    chrom, pos_a, pos_b, r2, n_obs
+
+    python ld.py --region 3R:8000000-10000000 --max-dist 200000
+
+Also writes the r2 decay curve, the mean r2 by distance bin over all pairs
+within `--max-dist` (accumulated before the `--min-r2` threshold), and LD
+blocks, i.e. runs of SNPs joined by pairs with r2 >= `--block-r2`.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+
+from instrument import Run, add_arguments
+from regions import parse_region
+from tables import CHROM, CHROMS, POS, read_snptable_numeric
+
+SNPTABLES = "data/snptables/Orchard2021"
+
+LD_PAIRS = {
+    "chrom": CHROM,
+    "pos_a": POS,
+    "pos_b": POS,
+    "r2": pl.Float32,
+    "n_obs": pl.UInt16,
+}
+
+
+def load_genotypes(chrom, start=None, end=None, snp_dir=SNPTABLES):
+    # positions and a SNPs x lines float32 matrix with NaN for missing calls
+    path = os.path.join(
+        snp_dir, f"inbredv2_withHets.orch2021.{chrom}.snpTable.numeric"
+    )
+    df = read_snptable_numeric(path).sort_values("pos")
+    if start is not None:
+        df = df[(df["pos"] >= start) & (df["pos"] <= end)]
+    g = df.drop(columns=["pos", "chrom"]).to_numpy(dtype=np.float32)
+    g[g < 0] = np.nan
+    return df["pos"].to_numpy(dtype=np.int64), g
+
+
+def _tile_stats(g):
+    # float64 so that the one-pass variances do not lose precision
+    m = ~np.isnan(g)
+    x = np.where(m, g, 0).astype(np.float64)
+    return m.astype(np.float64), x, x * x
+
+
+def tile_r2(a, b):
+    """Pairwise-complete r2 and pair counts between two tiles of SNPs"""
+    ma_, xa, xxa = a
+    mb, xb, xxb = b
+    n = ma_ @ mb.T
+    sx = xa @ mb.T
+    sy = ma_ @ xb.T
+    sxx = xxa @ mb.T
+    syy = ma_ @ xxb.T
+    sxy = xa @ xb.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sxy - sx * sy / n
+        va = sxx - sx * sx / n
+        vb = syy - sy * sy / n
+        r2 = cov * cov / (va * vb)
+    # monomorphic pairs and pairs without observations have no defined r2
+    r2[~np.isfinite(r2)] = np.nan
+    return np.minimum(r2, 1), n
+
+
+class Decay:
+    """Running sum and count of r2 by distance bin"""
+
+    def __init__(self, max_dist, bin_size=1000):
+        self.bin_size = bin_size
+        bins = max_dist // bin_size + 1
+        self.sum = np.zeros(bins)
+        self.count = np.zeros(bins, dtype=np.int64)
+
+    def add(self, dist, r2):
+        b = dist // self.bin_size
+        self.sum += np.bincount(b, weights=r2, minlength=len(self.sum))
+        self.count += np.bincount(b, minlength=len(self.count))
+
+
+def ld_pairs(pos, g, max_dist, min_r2=0.1, min_obs=10, tile=1024, decay=None):
+    """Yield (i, j, r2, n) arrays for SNP pairs within max_dist, tile by tile
+
+    With a Decay, every pair with a defined r2 and at least min_obs calls is
+    added to it, whether or not it passes min_r2.
+    """
+    n_snps = len(pos)
+    starts = np.arange(0, n_snps, tile)
+    for a0 in starts:
+        a1 = min(a0 + tile, n_snps)
+        sa = _tile_stats(g[a0:a1])
+        # last SNP that can pair with anything in this tile
+        reach = np.searchsorted(pos, pos[a1 - 1] + max_dist, side="right")
+        for b0 in range(a0, reach, tile):
+            b1 = min(b0 + tile, n_snps)
+            sb = sa if b0 == a0 else _tile_stats(g[b0:b1])
+            r2, n = tile_r2(sa, sb)
+
+            i, j = np.indices(r2.shape)
+            i, j = i + a0, j + b0
+            dist = pos[j] - pos[i]
+            valid = (j > i) & (dist <= max_dist) & (n >= min_obs) & ~np.isnan(r2)
+            if decay is not None:
+                decay.add(dist[valid], r2[valid])
+            keep = valid & (r2 >= min_r2)
+            if keep.any():
+                yield i[keep], j[keep], r2[keep], n[keep]
+
+
+def ld_table(chrom, pos, g, **kwargs):
+    parts = [
+        pl.DataFrame(
+            {
+                "chrom": chrom,
+                "pos_a": pos[i],
+                "pos_b": pos[j],
+                "r2": r2,
+                "n_obs": n.astype(np.uint16),
+            }
+        )
+        for i, j, r2, n in ld_pairs(pos, g, **kwargs)
+    ]
+    if not parts:
+        return pl.DataFrame(schema=LD_PAIRS)
+    return pl.concat(parts).cast(LD_PAIRS)
+
+
+def ld_decay(chrom, decay):
+    # mean r2 by distance over all pairs, not only those written out
+    on = decay.count > 0
+    return pl.DataFrame(
+        {
+            "chrom": chrom,
+            "dist": np.flatnonzero(on) * decay.bin_size,
+            "r2_mean": decay.sum[on] / decay.count[on],
+            "n_pairs": decay.count[on],
+        }
+    ).cast({"chrom": CHROM})
+
+
+def ld_blocks(pairs, block_r2=0.5):
+    # merge the spans of strongly linked pairs into non-overlapping blocks
+    return (
+        pairs.filter(pl.col("r2") >= block_r2)
+        .sort("chrom", "pos_a")
+        .with_columns(pl.col("pos_b").cum_max().over("chrom").alias("reach"))
+        .with_columns(
+            (pl.col("pos_a") > pl.col("reach").shift(1).over("chrom"))
+            .fill_null(True)
+            .cum_sum()
+            .over("chrom")
+            .alias("block")
+        )
+        .group_by("chrom", "block")
+        .agg(
+            pl.col("pos_a").min().alias("start"),
+            pl.col("pos_b").max().alias("end"),
+            pl.len().alias("n_pairs"),
+            pl.col("r2").mean().alias("r2_mean"),
+        )
+        .sort("chrom", "start")
+        .drop("block")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--chroms", nargs="+", default=CHROMS)
+    parser.add_argument("--region", help="restrict to chrom:start-end")
+    parser.add_argument("--max-dist", type=int, default=100_000)
+    parser.add_argument("--min-r2", type=float, default=0.1)
+    parser.add_argument("--min-obs", type=int, default=10)
+    parser.add_argument("--block-r2", type=float, default=0.5)
+    parser.add_argument("--decay-bin", type=int, default=1000)
+    parser.add_argument("--tile", type=int, default=1024)
+    parser.add_argument("--snp-dir", default=SNPTABLES)
+    parser.add_argument("--out", default="data/processed/ld")
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("ld", args)
+
+    chroms, start, end = args.chroms, None, None
+    if args.region:
+        chrom, start, end = parse_region(args.region)
+        chroms = [chrom]
+
+    tables, decays = [], []
+    for chrom in chroms:
+        run.begin("load")
+        pos, g = load_genotypes(chrom, start, end, args.snp_dir)
+        run.end(rows=len(pos))
+
+        run.begin("correlate")
+        decay = Decay(args.max_dist, args.decay_bin)
+        pairs = ld_table(
+            chrom,
+            pos,
+            g,
+            max_dist=args.max_dist,
+            min_r2=args.min_r2,
+            min_obs=args.min_obs,
+            tile=args.tile,
+            decay=decay,
+        )
+        run.end(rows=pairs.height)
+        tables.append(pairs)
+        decays.append(ld_decay(chrom, decay))
+        del g
+
+    run.begin("write")
+    pairs = pl.concat(tables)
+    os.makedirs(args.out, exist_ok=True)
+    pairs.write_parquet(os.path.join(args.out, "ld_pairs.parquet"))
+    pl.concat(decays).write_parquet(
+        os.path.join(args.out, "ld_decay.parquet")
+    )
+    ld_blocks(pairs, args.block_r2).write_parquet(
+        os.path.join(args.out, "ld_blocks.parquet")
+    )
+    run.end(rows=pairs.height)
+    run.finish()
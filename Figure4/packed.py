@@ -0,0 +1,214 @@
+"""Bit-packed inbred-line genotypes and popcount kernels.
+
+Genotype calls in the SNP tables are 0, 0.5, 1 or missing. Here a call is
+stored as two value bits and an observed bit, each in its own bit plane with
+one bit per line, packed into uint64 words (SNPs x words):
+
+    one  - the call is 0.5
+    two  - the call is 1
+    obs  - the call is not missing
+
+That is 3 bits per call instead of 64 for float64 (up to 21x smaller; rows
+are padded to whole words), so blocks of SNPs stay cache-resident. With
+x = 2 * dosage in {0, 1, 2}, x = one + 2 two and x^2 = one + 4 two, so the
+sums behind a pairwise-complete correlation of a SNP with an Ace dosage row
+y are popcounts of ANDed words, e.g.
+
+    n     = popcount(obs_x & obs_y)
+    sum x = popcount(one_x & obs_y) + 2 popcount(two_x & obs_y)
+    sum xy = popcount(one_x & one_y) + 2 popcount(one_x & two_y)
+           + 2 popcount(two_x & one_y) + 4 popcount(two_x & two_y)
+
+and are exact integers. `group_sums` gives the dosage sums over a set of
+lines that the count condition of 04a/04b uses. 02 writes the planes of all
+arms to `data/processed/snptable.packed.npz`.
+"""
+
+import os
+
+import numpy as np
+
+import shared
+from regions import FLANK, region_mask
+from tables import PROCESSED
+
+PACKED = os.path.join(PROCESSED, "snptable.packed.npz")
+
+
+def pack_bits(bits):
+    """(rows, lines) bool -> (rows, words) uint64, line i in bit i % 64"""
+    bits = np.atleast_2d(bits)
+    words = -(-bits.shape[1] // 64)
+    out = np.zeros((bits.shape[0], words * 8), dtype=np.uint8)
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    out[:, : packed.shape[1]] = packed
+    return out.view("<u8")
+
+
+def unpack_bits(words, n_lines):
+    bits = np.unpackbits(words.view(np.uint8), axis=1, bitorder="little")
+    return bits[:, :n_lines].astype(bool)
+
+
+class PackedGenotypes:
+    """Bit planes of a SNPs x lines genotype matrix, with positions and lines"""
+
+    def __init__(self, one, two, obs, lines, chrom=None, pos=None):
+        self.one, self.two, self.obs = one, two, obs
+        self.lines = list(lines)
+        n = len(one)
+        self.chrom = np.full(n, "") if chrom is None else np.asarray(chrom, "U")
+        self.pos = np.zeros(n, np.uint32) if pos is None else np.asarray(pos)
+
+    @classmethod
+    def from_dosages(cls, g, lines, chrom=None, pos=None):
+        # g is SNPs x lines with 0 / 0.5 / 1 and NaN for missing calls
+        g = np.asarray(g, dtype=np.float32)
+        obs = ~np.isnan(g)
+        bad = obs & (g != 0) & (g != 0.5) & (g != 1)
+        if bad.any():
+            raise ValueError(
+                f"genotypes must be 0, 0.5, 1 or missing, got {np.unique(g[bad])}"
+            )
+        return cls(
+            pack_bits(g == 0.5), pack_bits(g == 1), pack_bits(obs), lines, chrom, pos
+        )
+
+    @classmethod
+    def from_snptable(cls, snptable):
+        # a frame as read by read_snptable(_numeric): pos, lines..., chrom
+        lines = [c for c in snptable.columns if c not in ("chrom", "pos")]
+        return cls.from_dosages(
+            snptable[lines].to_numpy(np.float32),
+            lines,
+            np.asarray(snptable["chrom"]).astype(str),
+            snptable["pos"].to_numpy(np.uint32),
+        )
+
+    @classmethod
+    def load(cls, path=PACKED):
+        with np.load(path) as f:
+            return cls(
+                f["one"], f["two"], f["obs"], f["lines"].tolist(), f["chrom"], f["pos"]
+            )
+
+    def save(self, path=PACKED):
+        np.savez(
+            path,
+            one=self.one,
+            two=self.two,
+            obs=self.obs,
+            lines=np.asarray(self.lines),
+            chrom=self.chrom,
+            pos=self.pos,
+        )
+
+    def __len__(self):
+        return len(self.one)
+
+    def __getitem__(self, rows):
+        return PackedGenotypes(
+            self.one[rows],
+            self.two[rows],
+            self.obs[rows],
+            self.lines,
+            self.chrom[rows],
+            self.pos[rows],
+        )
+
+    @property
+    def nbytes(self):
+        return self.one.nbytes + self.two.nbytes + self.obs.nbytes
+
+    def dosages(self):
+        n = len(self.lines)
+        g = unpack_bits(self.one, n) * 0.5 + unpack_bits(self.two, n) * 1.0
+        g[~unpack_bits(self.obs, n)] = np.nan
+        return g.astype(np.float32)
+
+    def lines_mask(self, lines):
+        # words of a bool mask over self.lines
+        return pack_bits(np.asarray(lines, dtype=bool))[0]
+
+
+def load_genotypes(region=None, mask=None, path=PACKED):
+    """The packed store of 02 with the SNPs a stage works on
+
+    That is those in the regions plus the matching flank and outside the mask
+    (a RepeatMask), when given.
+    """
+    snps = PackedGenotypes.load(path)
+    if region:
+        snps = snps[region_mask(snps.chrom, snps.pos, region, FLANK)]
+    if mask is not None:
+        snps = snps[~mask.masked(snps.chrom, snps.pos)]
+    return snps
+
+
+def popcount(words):
+    return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+
+
+def cross_sums(x, y):
+    """Sums of 2 * dosage over the lines observed in both, SNPs x rows of y
+
+    Returns n, sum x, sum y, sum x^2, sum y^2 and sum xy as int64 arrays.
+    """
+    shape = (len(x), len(y))
+    n, sx, sy, sxx, syy, sxy = (np.zeros(shape, np.int64) for _ in range(6))
+    for j in range(len(y)):
+        y1, y2, my = y.one[j], y.two[j], y.obs[j]
+        x1, x2 = popcount(x.one & my), popcount(x.two & my)
+        y1n, y2n = popcount(y1 & x.obs), popcount(y2 & x.obs)
+        n[:, j] = popcount(x.obs & my)
+        sx[:, j], sxx[:, j] = x1 + 2 * x2, x1 + 4 * x2
+        sy[:, j], syy[:, j] = y1n + 2 * y2n, y1n + 4 * y2n
+        sxy[:, j] = (
+            popcount(x.one & y1)
+            + 2 * popcount(x.one & y2)
+            + 2 * popcount(x.two & y1)
+            + 4 * popcount(x.two & y2)
+        )
+    return n, sx, sy, sxx, syy, sxy
+
+
+def correlate(x, y):
+    """Pairwise-complete r of every SNP in x with every row of y
+
+    Missing calls drop the line from that pair, as ma.corrcoef on the masked
+    rows did; r is NaN where either side does not vary.
+    """
+    n, sx, sy, sxx, syy, sxy = cross_sums(x, y)
+    # exact in integers; only the final division is floating point
+    cov = n * sxy - sx * sy
+    var = (n * sxx - sx * sx) * (n * syy - sy * sy)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = cov / np.sqrt(var.astype(np.float64))
+    r[var <= 0] = np.nan
+    return np.clip(r, -1, 1)
+
+
+def group_sums(x, lines):
+    """Sum of the observed dosages of each SNP over the lines in a bool mask"""
+    g = x.lines_mask(lines)
+    return (popcount(x.one & g) + 2 * popcount(x.two & g)) / 2
+
+
+def publish(shared_arrays, snps, ace):
+    # the planes of the SNPs and of the Ace rows, for `ace_r` in workers
+    for name, p in [("snps", snps), ("ace", ace)]:
+        for plane in ["one", "two", "obs"]:
+            shared_arrays.publish(f"{name}.{plane}", getattr(p, plane))
+
+
+def ace_r(start, stop):
+    """Pool task: r of SNPs [start, stop) with the published Ace rows"""
+    a = shared.arrays
+    snps = PackedGenotypes(
+        a["snps.one"][start:stop],
+        a["snps.two"][start:stop],
+        a["snps.obs"][start:stop],
+        [],
+    )
+    ace = PackedGenotypes(a["ace.one"], a["ace.two"], a["ace.obs"], [])
+    return correlate(snps, ace)
@@ -0,0 +1,79 @@
+"""Region-of-interest mode for the numbered Figure4 stages.
+
+`--region 3R:8000000-10000000 [3L:...]` restricts every stage to a list of
+(chrom, start, end) intervals as early as possible, so that a run on the Ace
+neighbourhood or a control region takes seconds:
+
+- 02 only reads the SNP tables of the regions' arms and keeps their rows,
+- 03 only gathers the afmat rows of sites in the regions,
+- 04a/04b correlate only those SNPs and take linked SNPs from the regions,
+  with unlinked candidates from the regions plus the `FLANK` used to match,
+- 05 and 06 only form windows and bins over the regions.
+
+02 and 03 keep the flank as well, so that 04a/04b find the same unlinked
+candidates near the region's edges as in a genome-wide run. The outputs
+replace the genome-wide ones in `data/processed` and `plot_data`, so run a
+region in a separate working directory when both are needed.
+"""
+
+import numpy as np
+import polars as pl
+
+# unlinked SNPs are matched within this distance of a linked SNP (04a/04b)
+FLANK = 500_000
+
+
+def parse_region(region):
+    chrom, span = region.split(":")
+    start, end = span.replace(",", "").split("-")
+    return chrom, int(start), int(end)
+
+
+def add_region_argument(parser):
+    parser.add_argument(
+        "--region",
+        nargs="+",
+        type=parse_region,
+        help="only process these chrom:start-end intervals",
+    )
+    return parser
+
+
+def chroms(regions):
+    return list(dict.fromkeys(chrom for chrom, _, _ in regions))
+
+
+def region_mask(chrom, pos, regions, flank=0):
+    """Boolean mask of the (chrom, pos) pairs inside any region +- flank"""
+    chrom = np.asarray(chrom).astype(str)
+    pos = np.asarray(pos, dtype=np.int64)
+    mask = np.zeros(len(pos), dtype=bool)
+    for c, start, end in regions:
+        mask |= (chrom == c) & (pos >= start - flank) & (pos <= end + flank)
+    return mask
+
+
+def region_filter(regions, flank=0):
+    """The same test as a polars expression, for lazy scans"""
+    expr = pl.lit(False)
+    for c, start, end in regions:
+        expr = expr | (
+            (pl.col("chrom") == c)
+            & pl.col("pos").is_between(max(start - flank, 0), end + flank)
+        )
+    return expr
+
+
+def select_regions(df, regions, flank=0):
+    """Rows of a pandas or polars frame in the regions; all rows without"""
+    if not regions:
+        return df
+    if isinstance(df, (pl.DataFrame, pl.LazyFrame)):
+        return df.filter(region_filter(regions, flank))
+    return df[region_mask(df["chrom"], df["pos"], regions, flank)]
+
+
+def window_start(regions, chrom, w):
+    # first window boundary at or below the region's start on the arm
+    starts = [start for c, start, _ in regions or [] if c == chrom]
+    return np.floor(min(starts) / w) * w if starts else 0
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""RepeatMasker intervals as a site filter for the Python stages.
+
+`glm/01_glm_malathion.R` drops GLM sites inside the `dm3.fa.out`
+RepeatMasker annotation, so changing the mask meant rerunning the GLM. Here
+the annotation is parsed once into sorted, merged intervals per chromosome
+arm (1-based and closed, as in the .out file and the R join) and cached next
+to the processed data:
+
+    python repeatmask.py data/raw/dm3.fa.out   # data/processed/dm3.fa.out.npz
+
+A site is masked when the last interval starting at or before it also ends
+at or after it, one `searchsorted` per arm for any number of sites:
+
+    mask = RepeatMask.load()
+    mask.masked(df["chrom"], df["pos"])     # bool array
+    drop_masked(df, mask)                   # pandas, polars or lazy frames
+
+`--mask [PATH]` on 02, 03, 04a and 04b drops masked SNPs and sites, and
+`--mask-pad` widens every interval, so mask variants can be compared without
+rerunning anything upstream. The cache is rebuilt when the .out file changes.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from tables import PROCESSED
+
+REPEATMASKER = "data/raw/dm3.fa.out"
+
+
+def read_repeatmasker(path=REPEATMASKER):
+    """(chrom, start, end) of every annotated repeat, chrom without "chr" """
+    # three header lines; a trailing "*" marks overlapping hits
+    rm = pd.read_csv(
+        path,
+        sep=r"\s+",
+        skiprows=3,
+        header=None,
+        names=range(16),
+        usecols=[4, 5, 6],
+        dtype={4: str, 5: np.int64, 6: np.int64},
+    )
+    return rm[4].str.removeprefix("chr").to_numpy(), rm[5].to_numpy(), rm[6].to_numpy()
+
+
+def merge_intervals(starts, ends):
+    """Sorted, disjoint closed intervals covering the same positions"""
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    # a new interval begins past the end of everything before it (and is not
+    # adjacent to it, since positions are integers)
+    new = np.r_[True, starts[1:] > reach[:-1] + 1]
+    first = np.flatnonzero(new)
+    return starts[first], np.maximum.reduceat(ends, first)
+
+
+class RepeatMask:
+    """Per-arm sorted, merged intervals with vectorized point lookups"""
+
+    def __init__(self, intervals, pad=0):
+        # {chrom: (starts, ends)}
+        self.intervals = intervals
+        self.pad = pad
+
+    @classmethod
+    def from_repeatmasker(cls, path=REPEATMASKER):
+        chrom, starts, ends = read_repeatmasker(path)
+        intervals = {}
+        for c in np.unique(chrom):
+            on = chrom == c
+            intervals[str(c)] = merge_intervals(starts[on], ends[on])
+        return cls(intervals)
+
+    @classmethod
+    def load(cls, path=REPEATMASKER, cache=None, pad=0):
+        """From the binary cache of path, (re)built when missing or stale"""
+        cache = cache or os.path.join(PROCESSED, os.path.basename(path) + ".npz")
+        stat = os.stat(path)
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if os.path.exists(cache):
+            with np.load(cache) as f:
+                if np.array_equal(f["source"], source):
+                    intervals = {
+                        c: (f[f"{c}.starts"], f[f"{c}.ends"])
+                        for c in f["chroms"].tolist()
+                    }
+                    return cls(intervals, pad)
+        mask = cls.from_repeatmasker(path)
+        mask.pad = pad
+        mask.save(cache, source)
+        return mask
+
+    def save(self, path, source):
+        arrays = {"source": source, "chroms": np.asarray(list(self.intervals))}
+        for c, (starts, ends) in self.intervals.items():
+            arrays[f"{c}.starts"], arrays[f"{c}.ends"] = starts, ends
+        np.savez(path, **arrays)
+
+    def bp(self):
+        """Masked bp per arm, padding included"""
+        out = {}
+        for c, (starts, ends) in self.intervals.items():
+            starts, ends = merge_intervals(starts - self.pad, ends + self.pad)
+            out[c] = int((ends - starts + 1).sum())
+        return out
+
+    def masked(self, chrom, pos):
+        """Boolean mask of the (chrom, pos) pairs inside any repeat"""
+        chrom = np.asarray(chrom).astype(str)
+        pos = np.asarray(pos, dtype=np.int64)
+        out = np.zeros(len(pos), dtype=bool)
+        for c in np.unique(chrom):
+            if c not in self.intervals:
+                continue
+            on = np.flatnonzero(chrom == c)
+            starts, ends = self.intervals[c]
+            # padding every interval alike keeps the ends sorted, so the last
+            # interval starting at or before a site reaches furthest
+            i = np.searchsorted(starts - self.pad, pos[on], side="right") - 1
+            out[on] = (i >= 0) & (pos[on] <= ends[np.maximum(i, 0)] + self.pad)
+        return out
+
+    def expr(self):
+        """The same test as a polars expression, for lazy scans"""
+        return pl.struct("chrom", "pos").map_batches(
+            lambda s: pl.Series(
+                self.masked(
+                    s.struct.field("chrom").cast(pl.String).to_numpy(),
+                    s.struct.field("pos").to_numpy(),
+                )
+            ),
+            return_dtype=pl.Boolean,
+        )
+
+
+def add_mask_argument(parser):
+    parser.add_argument(
+        "--mask",
+        nargs="?",
+        const=REPEATMASKER,
+        help=f"drop sites in RepeatMasker repeats (default file {REPEATMASKER})",
+    )
+    parser.add_argument(
+        "--mask-pad",
+        type=int,
+        default=0,
+        help="widen every repeat by this many bp on both sides",
+    )
+    return parser
+
+
+def load_mask(args):
+    """The RepeatMask of --mask / --mask-pad, or None"""
+    return RepeatMask.load(args.mask, pad=args.mask_pad) if args.mask else None
+
+
+def drop_masked(df, mask):
+    """Rows of a pandas or polars frame outside the mask; all rows without"""
+    if mask is None:
+        return df
+    if isinstance(df, (pl.DataFrame, pl.LazyFrame)):
+        return df.filter(~mask.expr())
+    return df[~mask.masked(df["chrom"], df["pos"])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", nargs="?", default=REPEATMASKER)
+    parser.add_argument("--cache", help="defaults to data/processed/<name>.npz")
+    args = parser.parse_args()
+
+    mask = RepeatMask.load(args.path, args.cache)
+    bp = mask.bp()
+    for chrom, (starts, _) in mask.intervals.items():
+        print(f"{chrom}\t{len(starts)} intervals\t{bp[chrom]} bp")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Genome-wide reversal scores for every SNP, by a streaming sorted join.
+
+05 builds the reversal table only for the matched SNPs in sites.arrow. Here
+every SNP in the GLM output gets its treatment (trt) and post-treatment
+(post_trt) effect and a reversal score
+
+    score = -sign(trt) * post_trt
+
+i.e. how far the allele moved back against the direction it took during
+treatment (positive = reversal). The GLM output is first written as a
+columnar table sorted by (chrom, pos, treatment) (`--lm-sites`, one row per
+key as in 05; written from `--glm` when missing or when the CSV's size or
+mtime changed since, or with `--rebuild`). Its trt and post_trt rows are then read
+as two batch streams and merge-joined on the sorted key, so only a batch of
+each is in memory at a time. Per-SNP results are appended to
+`data/processed/reversal_genome.parquet` batch by batch, and windowed
+summaries (mean effects, median score, fraction of SNPs reversing) are
+emitted as windows close and written to `plot_data/reversal_windows.arrow`:
+
+    python reversal_genome.py --window 1000000
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from instrument import Run, add_arguments
+from stream_windows import QuantileSketch
+from tables import (
+    LM_SITES,
+    PROCESSED,
+    REVERSAL_GENOME,
+    conform,
+    scan_lm_sites,
+    table_path,
+    write_table,
+)
+
+SORT = ["chrom", "pos", "treatment"]
+GLM = "data/raw/sigsite_malathion.csv"
+
+
+def _stamp(csv):
+    stat = os.stat(csv)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _stamp_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def write_lm_sites(path, csv=GLM):
+    # the GLM effects as a sorted columnar table; polars sorts out of core.
+    # 05 drops the duplicate rows of the GLM output, and so do we
+    key = SORT + ["sweep"]
+    scan_lm_sites(csv).unique(key, keep="first").sort(key).sink_parquet(path)
+    with open(_stamp_path(path), "w") as f:
+        json.dump({"source": _stamp(csv)}, f)
+
+
+def lm_sites_stale(path, csv=GLM):
+    """Whether path is missing or was not written from the current csv"""
+    if not os.path.exists(path):
+        return True
+    if not os.path.exists(csv):
+        # only the sorted table was kept
+        return False
+    try:
+        with open(_stamp_path(path)) as f:
+            return json.load(f)["source"] != _stamp(csv)
+    except (OSError, ValueError, KeyError):
+        return True
+
+
+def sweep_batches(path, sweep, batch_size=500_000):
+    """Batches of one sweep's effects with their int64 join key"""
+    columns = SORT + ["sweep", "lm_effect"]
+    last = -1
+    for batch in pq.ParquetFile(path).iter_batches(batch_size, columns=columns):
+        df = pl.from_arrow(batch).cast({c: LM_SITES[c] for c in columns})
+        df = df.filter(pl.col("sweep") == sweep).drop("sweep")
+        if df.height == 0:
+            continue
+        df = df.with_columns(_key().alias("key"))
+        key = df["key"].to_numpy()
+        if key[0] <= last or (np.diff(key) <= 0).any():
+            raise ValueError(f"{path}: not sorted by (chrom, pos, treatment)")
+        last = key[-1]
+        yield df
+
+
+def _key():
+    # one sortable int64 per (chrom, pos, treatment)
+    return (
+        (pl.col("chrom").to_physical().cast(pl.Int64) * 2**32 + pl.col("pos"))
+        * 2
+        + pl.col("treatment").to_physical()
+    )
+
+
+def merge_join(left, right):
+    """Inner join of two key-sorted batch streams; yields joined batches"""
+    left, right = iter(left), iter(right)
+    lbuf = rbuf = None
+    while True:
+        # refill whichever side was used up; either stream ending ends the join
+        lbuf = next(left, None) if lbuf is None or lbuf.height == 0 else lbuf
+        rbuf = next(right, None) if rbuf is None or rbuf.height == 0 else rbuf
+        if lbuf is None or rbuf is None:
+            return
+        # every key up to the smaller of the two last keys is complete
+        limit = min(lbuf["key"][-1], rbuf["key"][-1])
+        lcut = int(np.searchsorted(lbuf["key"].to_numpy(), limit, side="right"))
+        rcut = int(np.searchsorted(rbuf["key"].to_numpy(), limit, side="right"))
+        done = lbuf[:lcut].join(rbuf[:rcut].select("key", "lm_effect"), on="key")
+        lbuf, rbuf = lbuf[lcut:], rbuf[rcut:]
+        if done.height:
+            yield done
+
+
+def score(joined):
+    return joined.select(
+        "chrom",
+        "pos",
+        "treatment",
+        pl.col("lm_effect").alias("trt"),
+        pl.col("lm_effect_right").alias("post_trt"),
+    ).with_columns(
+        (-pl.col("trt").sign() * pl.col("post_trt")).alias("score")
+    )
+
+
+class _Window:
+    def __init__(self):
+        self.n = 0
+        self.trt = self.post_trt = self.score = self.reversed = 0.0
+        self.sketch = QuantileSketch()
+
+    def add(self, g):
+        self.n += g.height
+        self.trt += g["trt"].sum()
+        self.post_trt += g["post_trt"].sum()
+        self.score += g["score"].sum()
+        self.reversed += (g["score"] > 0).sum()
+        self.sketch.add(g["score"].to_numpy())
+
+
+def window_summaries(batches, window=1_000_000):
+    """Yield (per-SNP batch, closed window rows) pairs"""
+    open_, chrom = {}, None
+
+    def close(below=None):
+        rows = []
+        for key in sorted(k for k in open_ if below is None or k[1] < below):
+            w = open_.pop(key)
+            rows.append(
+                {
+                    "treatment": key[0],
+                    "chrom": chrom,
+                    "mid": (key[1] + 0.5) * window,
+                    "nsnp": w.n,
+                    "trt_mean": w.trt / w.n,
+                    "post_trt_mean": w.post_trt / w.n,
+                    "score_mean": w.score / w.n,
+                    "score_median": float(w.sketch.quantile(0.5)),
+                    "frac_reversed": w.reversed / w.n,
+                }
+            )
+        return rows
+
+    for df in batches:
+        for part in df.partition_by("chrom", maintain_order=True):
+            rows = []
+            if part["chrom"][0] != chrom:
+                rows += close()
+                chrom = part["chrom"][0]
+            win = part["pos"].to_numpy() // window
+            rows += close(below=win[0])
+            part = part.with_columns(pl.Series("win", win))
+            for (treatment, w), g in part.group_by("treatment", "win"):
+                open_.setdefault((treatment, int(w)), _Window()).add(g)
+            yield part.drop("win"), rows
+    yield None, close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--window", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=500_000)
+    parser.add_argument(
+        "--lm-sites", default=table_path("lm_sites", PROCESSED, "parquet")
+    )
+    parser.add_argument("--glm", default=GLM, help="GLM output of glm/")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="rewrite --lm-sites from --glm"
+    )
+    parser.add_argument(
+        "--out", default=table_path("reversal_genome", PROCESSED, "parquet")
+    )
+    parser.add_argument(
+        "--csv", action="store_true", help="also export the plot table as CSV"
+    )
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("reversal_genome", args)
+
+    if args.rebuild or lm_sites_stale(args.lm_sites, args.glm):
+        run.begin("sort")
+        write_lm_sites(args.lm_sites, args.glm)
+        run.end()
+
+    run.begin("join")
+    joined = merge_join(
+        sweep_batches(args.lm_sites, "trt", args.batch_size),
+        sweep_batches(args.lm_sites, "post_trt", args.batch_size),
+    )
+    writer, n, windows = None, 0, []
+    for snps, rows in window_summaries(map(score, joined), args.window):
+        windows += rows
+        if snps is None:
+            continue
+        snps = conform(snps, REVERSAL_GENOME, "reversal_genome")
+        if writer is None:
+            writer = pq.ParquetWriter(args.out, snps.to_arrow().schema)
+        writer.write_table(snps.to_arrow())
+        n += snps.height
+    if writer is not None:
+        writer.close()
+    run.end(rows=n)
+
+    run.begin("write")
+    write_table(pl.DataFrame(windows), "reversal_windows", csv=args.csv)
+    run.finish()
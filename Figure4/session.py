@@ -0,0 +1,258 @@
+"""The Figure4 stages 02-06 in one process, over data kept in memory.
+
+Each numbered script reads its inputs from disk and writes its outputs back
+for the next one. A `Session` runs the same stage functions instead, loading
+every input the first time a stage asks for it and keeping it, and keeping
+each stage's outputs for the stages after it:
+
+    genotypes    bit-packed inbred-line genotypes (the packed store of 02, or
+                 the SNP tables when it has not been written)
+    ace_table    Ace allele dosages of the lines
+    afmat        allele frequency matrix, memory-mapped
+    site_list    afmat rows of the sites (sites.csv), with samps
+    lm_sites     GLM effects
+    sites_main   per-cage site table (03)
+    sweep_r2s    correlation with R2 + R3 and the line counts, shared by
+                 04a and 04b
+    sites        matched site tables (04a, 04b)
+    sites_post
+
+so a notebook or driver script can run the pipeline, or one stage again with
+other parameters, without disk round trips:
+
+    from session import Session
+    s = Session(region=[("3R", 8_000_000, 10_000_000)])
+    s.run()                                           # 02 -> 06
+    s.windows(bootstrap="hierarchical", seed=1)       # 05 again
+    s.save(csv=True)                                  # as the scripts would
+
+A stage uses the latest outputs of the stages before it, and inputs that no
+stage has produced yet are read from `data/processed` and `plot_data`; after
+rerunning a stage, rerun the stages that depend on it. With `checkpoint`, a
+directory as `--checkpoint`, the correlation blocks and bootstrap windows are
+kept there as in the scripts (checkpoint.py).
+"""
+
+import importlib
+from functools import cached_property
+
+import pandas as pd
+import polars as pl
+
+from afstore import open_afmat
+from checkpoint import Checkpoints
+from packed import PACKED, PackedGenotypes, load_genotypes
+from regions import FLANK, select_regions
+from repeatmask import drop_masked
+from tables import (
+    PROCESSED,
+    SCHEMAS,
+    SITES_MAIN,
+    conform,
+    read_sites_main,
+    read_table,
+    scan_lm_sites,
+    write_sites_main,
+    write_table,
+)
+
+# the numbered scripts, whose names are not identifiers
+stage02 = importlib.import_module("02_process_snptables")
+stage03 = importlib.import_module("03_process_sites")
+stage04a = importlib.import_module("04a_trt_precompute")
+stage04b = importlib.import_module("04b_post-trt_precompute")
+stage05 = importlib.import_module("05_windows_and_reversal")
+stage06 = importlib.import_module("06_mwu_tests")
+
+
+class Session:
+    def __init__(self, region=None, mask=None, checkpoint=None):
+        # region: (chrom, start, end) tuples as --region; mask: a RepeatMask;
+        # checkpoint: a directory for resumable work units
+        self.region = region
+        self.mask = mask
+        self.checkpoint = checkpoint
+        # names of the outputs computed in this session, for save()
+        self.outputs = []
+        self.plot_tables = {}
+
+    # inputs, loaded on first use
+
+    @cached_property
+    def snptable(self):
+        return stage02.load_snptable(self.region, self.mask)
+
+    @cached_property
+    def genotypes(self):
+        try:
+            return load_genotypes(self.region, self.mask)
+        except FileNotFoundError:
+            return PackedGenotypes.from_snptable(self.snptable)
+
+    @cached_property
+    def ace_table(self):
+        return stage02.ace_dosages(pd.read_csv("data/raw/ace_haplotypes.csv"))
+
+    @cached_property
+    def afmat(self):
+        return open_afmat()
+
+    @cached_property
+    def samps(self):
+        return stage03.read_samps().collect()
+
+    @cached_property
+    def site_list(self):
+        return stage03.read_site_list().collect()
+
+    @cached_property
+    def lm_sites(self):
+        return select_regions(scan_lm_sites(), self.region, FLANK).collect()
+
+    @cached_property
+    def sites_main(self):
+        sites_main = select_regions(read_sites_main(), self.region, FLANK)
+        return drop_masked(sites_main, self.mask)
+
+    @cached_property
+    def sweep_r2s(self):
+        g = self.genotypes
+        checkpoint = self._checkpoints(
+            "sweep_r", g.one, g.two, g.obs, g.lines, self.ace_table
+        )
+        return stage04a.sweep_correlations(g, self.ace_table, checkpoint)
+
+    @cached_property
+    def snpcounts(self):
+        return stage04a.snp_counts(self.genotypes, self.ace_table)
+
+    @cached_property
+    def sites(self):
+        return read_table("sites")
+
+    @cached_property
+    def sites_post(self):
+        return read_table("sites_post")
+
+    # stages
+
+    def process_snptables(self):
+        """02: genotypes from the SNP tables and their Ace correlations"""
+        self.genotypes = PackedGenotypes.from_snptable(self.snptable)
+        g = self.genotypes
+        checkpoint = self._checkpoints(
+            "ace_r", g.one, g.two, g.obs, g.lines, self.ace_table
+        )
+        ace_r2s = stage02.ace_correlations(g, self.ace_table, checkpoint)
+        self.ace_r2s = stage02.classify(ace_r2s)
+        self.outputs.append("ace_r2s")
+        # 04a/04b correlate the new genotypes again
+        self.__dict__.pop("sweep_r2s", None)
+        self.__dict__.pop("snpcounts", None)
+        return self.ace_r2s
+
+    def process_sites(self):
+        """03: the per-cage site table"""
+        sites = stage03.explode(self.site_list, self.samps, self.region, self.mask)
+        sites = stage03.gather_freqs(sites, self.samps, self.afmat, self.lm_sites)
+        self.sites_main = conform(sites, SITES_MAIN, "sites_main")
+        self.outputs.append("sites_main")
+        return self.sites_main
+
+    def trt_precompute(self, thresh=0.60):
+        """04a: linked and matched unlinked sites of the treatment sweep"""
+        self.sites = self._precompute(stage04a, "sites", thresh)
+        self.outputs.append("sites")
+        return self.sites
+
+    def post_trt_precompute(self, thresh=0.60):
+        """04b: the same for the post-treatment sweep"""
+        self.sites_post = self._precompute(stage04b, "sites_post", thresh)
+        self.outputs.append("sites_post")
+        return self.sites_post
+
+    def _precompute(self, stage, name, thresh):
+        sites, linked, linked_initials, unlinked_initials = stage.join_sites(
+            self.sites_main, self.sweep_r2s, self.snpcounts, self.region, thresh
+        )
+        unlinked = stage.match_unlinked(sites, linked_initials, unlinked_initials)
+        return conform(stage.plot_table(linked, unlinked), SCHEMAS[name], name)
+
+    def windows(self, bootstrap="snp", replicates=100_000, seed=None):
+        """05: window medians and CIs, and the reversal table"""
+        d = select_regions(self.sites, self.region).to_pandas()
+        d_post = select_regions(self.sites_post, self.region).to_pandas()
+        params = (bootstrap, replicates, seed, self.region)
+        if bootstrap == "hierarchical":
+            main = select_regions(self.sites_main, self.region)
+            trt = main.filter(pl.col("sweep") == "trt")
+            post = main.filter(pl.col("sweep") == "post_trt")
+            dwin, dwin_post = (
+                stage05.hierarchical(
+                    x,
+                    m,
+                    self.region,
+                    replicates,
+                    seed,
+                    self._checkpoints(name, x, m, *params),
+                )
+                for name, x, m in [("windows", d, trt), ("windows_post", d_post, post)]
+            )
+        else:
+            dwin, dwin_post = (
+                stage05.snp_windows(
+                    x,
+                    self.region,
+                    replicates,
+                    seed,
+                    self._checkpoints(name, x, *params),
+                )
+                for name, x in [("windows", d), ("windows_post", d_post)]
+            )
+        lmd = stage05.lm_effects(select_regions(self.lm_sites, self.region))
+        self.plot_tables.update(
+            windows=dwin,
+            windows_post=dwin_post,
+            reversal=stage05.reversal(d, lmd),
+        )
+        return dwin, dwin_post
+
+    def _checkpoints(self, stage, *inputs):
+        if self.checkpoint is None:
+            return None
+        return Checkpoints(self.checkpoint, stage, *inputs)
+
+    def mwu_tests(self):
+        """06: per-bin MWU tests of linked vs unlinked sites"""
+        d = select_regions(self.sites, self.region).to_pandas()
+        d_post = select_regions(self.sites_post, self.region).to_pandas()
+        self.plot_tables["mwu"] = stage06.mwu_tests(d, d_post)
+        return self.plot_tables["mwu"]
+
+    def run(self, bootstrap="snp", replicates=100_000, seed=None):
+        """02 -> 06"""
+        self.process_snptables()
+        self.process_sites()
+        self.trt_precompute()
+        self.post_trt_precompute()
+        self.windows(bootstrap, replicates, seed)
+        self.mwu_tests()
+        return self
+
+    def save(self, csv=False):
+        """Write the outputs computed so far where the scripts write them"""
+        done = set(self.outputs)
+        if "ace_r2s" in done:
+            self.snptable.to_csv(f"{PROCESSED}/snptable.csv", index=False)
+            self.genotypes.save(PACKED)
+            self.ace_table.to_csv(f"{PROCESSED}/ace_snptable.csv")
+            self.ace_r2s.write_parquet(f"{PROCESSED}/ace_r2s.parquet")
+        if done & {"sites", "sites_post"}:
+            self.sweep_r2s.to_csv(f"{PROCESSED}/sweep_r2s.csv")
+        if "sites_main" in done:
+            write_sites_main(self.sites_main)
+        for name in ["sites", "sites_post"]:
+            if name in done:
+                write_table(getattr(self, name), name, csv=csv)
+        for name, table in self.plot_tables.items():
+            write_table(table, name, csv=csv)
@@ -0,0 +1,157 @@
+"""Read-only arrays shared with pool workers without copying.
+
+The correlation stages used to pickle every SNP row to the workers. Here the
+large arrays are published once: `SharedArrays.publish` copies an array into
+a shared-memory segment (a memory-mapped `.npy`, e.g. afmat, is shared
+through its file instead, so it is not copied at all), and the workers attach
+to all published arrays once, in the pool initializer, as read-only NumPy
+views. Tasks are then only (start, stop) ranges:
+
+    with SharedArrays() as shared:
+        shared.publish("afmat", afmat)
+        shared.publish("lm_effect", lm_effect)
+        out = map_blocks(task, len(afmat), shared, processes=10)
+
+where `task(start, stop)` reads `shared.arrays["afmat"][start:stop]`.
+
+The process that publishes owns the segments: they are unlinked when the
+`with` block exits, also on errors. Workers only attach, so a worker that
+dies cannot remove or leak a segment. `map_blocks` runs the tasks in a
+`concurrent.futures.ProcessPoolExecutor`, which fails every pending task with
+`BrokenProcessPool` when a worker dies; `map_blocks` then raises instead of
+waiting forever, which unwinds the `with` block. If the owner itself is
+killed, the resource tracker of `multiprocess` unlinks the segments it
+registered.
+"""
+
+import mmap
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import multiprocess as mp
+import numpy as np
+from multiprocess.shared_memory import SharedMemory
+
+# the views attached in a worker, by name
+arrays = {}
+_segments = []
+
+
+class SharedArrays:
+    """Named arrays published for pool workers; use as a context manager"""
+
+    def __init__(self):
+        self.specs = {}
+        self._segments = []
+
+    def empty(self, name, shape, dtype):
+        # a writable shared array to fill in place before starting the pool
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = SharedMemory(create=True, size=size)
+        self._segments.append(shm)
+        self.specs[name] = ("shm", shm.name, tuple(shape), dtype.str)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def publish(self, name, array):
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+            # already in the page cache: workers map the same file
+            order = "F" if array.flags.f_contiguous and array.ndim > 1 else "C"
+            self.specs[name] = (
+                "file",
+                array.filename,
+                array.offset,
+                array.shape,
+                array.dtype.str,
+                order,
+            )
+            return array
+        array = np.asarray(array)
+        view = self.empty(name, array.shape, array.dtype)
+        view[...] = array
+        return view
+
+    def close(self):
+        for shm in self._segments:
+            shm.close()
+            shm.unlink()
+        self._segments = []
+        self.specs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(specs):
+    """Read-only views of published arrays, without copying"""
+    views = {}
+    for name, spec in specs.items():
+        if spec[0] == "shm":
+            _, shm_name, shape, dtype = spec
+            shm = SharedMemory(name=shm_name)
+            # keep the segment open for as long as the view lives
+            _segments.append(shm)
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        else:
+            _, path, offset, shape, dtype, order = spec
+            view = np.memmap(
+                path,
+                dtype=np.dtype(dtype),
+                mode="r",
+                offset=offset,
+                shape=shape,
+                order=order,
+            )
+        view.flags.writeable = False
+        views[name] = view
+    return views
+
+
+def _init(specs):
+    arrays.update(attach(specs))
+
+
+def blocks(n, block):
+    return [(start, min(start + block, n)) for start in range(0, n, block)]
+
+
+def map_blocks(func, n, shared, processes=10, block=10_000, checkpoint=None):
+    """[func(start, stop) for each block of range(n)], run in a pool
+
+    func reads its inputs from `shared.arrays` in the worker. With a
+    checkpoint.Checkpoints, blocks finished in an earlier run are loaded
+    instead, and each block is saved as soon as it finishes.
+    """
+    units = blocks(n, block)
+    results = {}
+    if checkpoint is not None:
+        results = {u: checkpoint.load(u) for u in units if u in checkpoint}
+    todo = [u for u in units if u not in results]
+    if not todo:
+        return [results[u] for u in units]
+
+    pool = ProcessPoolExecutor(
+        processes,
+        mp_context=mp.get_context(),
+        initializer=_init,
+        initargs=(shared.specs,),
+    )
+    try:
+        pending = {pool.submit(func, *u): u for u in todo}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                u = pending.pop(future)
+                results[u] = future.result()
+                if checkpoint is not None:
+                    checkpoint.save(u, results[u])
+    except BrokenProcessPool:
+        # a worker died; the blocks saved so far are kept
+        raise RuntimeError("a worker process died; shared arrays released") from None
+    finally:
+        # on errors, drop the queued blocks rather than running them
+        pool.shutdown(cancel_futures=True)
+    return [results[u] for u in units]
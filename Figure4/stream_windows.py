@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Genome-wide window medians of lm_effect over all unlinked SNPs, streamed.
+
+`05_windows_and_reversal.py` bootstraps window medians for the matched subset
+in `plot_data/sites.arrow`. This stage computes the same kind of summary for
+the full genome-wide unlinked background in `sites_main.parquet` (sites with
+r2 < `--r2-max` to the resistant Ace alleles in `sweep_r2s.csv`) without
+loading it: row batches are read in file order, which is chrom then position,
+the per-cage copies of each site are dropped, and every (treatment, window)
+keeps a quantile sketch. A window is summarised and emitted as soon as the
+stream moves past it, so memory depends on the batch size and sketch size,
+not on the size of an arm.
+
+The sketch keeps values exactly up to `--exact` per window and switches to a
+fixed-bin histogram over [-1, 1] (lm_effect is a frequency difference) beyond
+that, with quantile error below 2 / `--bins`. For large n the bootstrap
+percentile interval of the median in 05 converges to the order-statistic
+interval, so the CI here is the quantile pair 0.5 -/+ z / (2 sqrt(n)). Only
+windows with at least one SNP are written.
+
+    python stream_windows.py --sweep trt --window 1000000
+"""
+
+import argparse
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from instrument import Run, add_arguments
+from tables import PROCESSED, SITES_MAIN, table_path, write_table
+
+KEYS = ["chrom", "pos", "treatment", "sweep"]
+
+
+class QuantileSketch:
+    """Exact values up to `exact`, then a fixed-bin histogram on [lo, hi]"""
+
+    def __init__(self, exact=100_000, lo=-1.0, hi=1.0, bins=2**16):
+        self.exact, self.lo, self.hi, self.bins = exact, lo, hi, bins
+        self.values = []
+        self.counts = None
+        self.n = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        if self.counts is None:
+            self.values.append(values)
+            if self.n > self.exact:
+                self._to_histogram()
+        else:
+            self._count(values)
+
+    def _to_histogram(self):
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self._count(np.concatenate(self.values))
+        self.values = []
+
+    def _count(self, values):
+        # values outside [lo, hi] land in the edge bins
+        scaled = (values - self.lo) / (self.hi - self.lo) * self.bins
+        i = np.clip(scaled.astype(np.int64), 0, self.bins - 1)
+        self.counts += np.bincount(i, minlength=self.bins)
+
+    def quantile(self, q):
+        q = np.clip(np.asarray(q, dtype=np.float64), 0, 1)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)
+        if self.counts is None:
+            return np.quantile(np.concatenate(self.values), q)
+        # linear interpolation inside the bin that holds rank q * n
+        cum = np.cumsum(self.counts)
+        rank = q * self.n
+        i = np.minimum(np.searchsorted(cum, rank, side="left"), self.bins - 1)
+        below = np.where(i > 0, cum[i - 1], 0)
+        frac = (rank - below) / np.maximum(self.counts[i], 1)
+        width = (self.hi - self.lo) / self.bins
+        return self.lo + (i + np.clip(frac, 0, 1)) * width
+
+
+def read_batches(path, batch_size=500_000, sweep=None):
+    # record batches of the columns needed here, in file order
+    columns = KEYS + ["lm_effect"]
+    for batch in pq.ParquetFile(path).iter_batches(batch_size, columns=columns):
+        df = pl.from_arrow(batch).cast({c: SITES_MAIN[c] for c in columns})
+        if sweep is not None:
+            df = df.filter(pl.col("sweep") == sweep)
+        if df.height:
+            yield df
+
+
+def unique_sites(batches):
+    # sites_main has one row per cage; lm_effect is per site, treatment and
+    # sweep. Rows of one site are adjacent but may straddle two batches.
+    last = None
+    for df in batches:
+        df = df.unique(KEYS, maintain_order=True)
+        if last is not None:
+            df = df.join(last, on=KEYS, how="anti")
+        tail = df.tail(1).select("chrom", "pos")
+        last = df.join(tail, on=["chrom", "pos"]).select(KEYS)
+        yield df
+
+
+def unlinked_positions(path, chrom, r2_max):
+    # sorted positions of the arm's sites that are unlinked to Ace R2+R3
+    return (
+        pl.scan_csv(path)
+        .filter((pl.col("chrom") == chrom) & (pl.col("r2") < r2_max))
+        .select(pl.col("pos").cast(pl.UInt32))
+        .collect()
+        .to_series()
+        .sort()
+        .to_numpy()
+    )
+
+
+def only_unlinked(batches, path, r2_max):
+    chrom, positions = None, None
+    for df in batches:
+        for part in df.partition_by("chrom", maintain_order=True):
+            c = part["chrom"][0]
+            if c != chrom:
+                chrom, positions = c, unlinked_positions(path, c, r2_max)
+            if not len(positions):
+                continue
+            pos = part["pos"].to_numpy()
+            i = np.minimum(np.searchsorted(positions, pos), len(positions) - 1)
+            keep = positions[i] == pos
+            if keep.any():
+                yield part.filter(pl.Series(keep))
+
+
+def window_summaries(batches, window=1_000_000, z=1.96, **sketch):
+    """Yield one summary row per (treatment, chrom, window) as windows close"""
+    chrom, done, last_pos = None, set(), -1
+    open_ = {}
+
+    def close(below=None):
+        for key in sorted(k for k in open_ if below is None or k[1] < below):
+            s = open_.pop(key)
+            half = z / (2 * np.sqrt(s.n))
+            lower, median, upper = s.quantile([0.5 - half, 0.5, 0.5 + half])
+            yield {
+                "treatment": key[0],
+                "chrom": chrom,
+                "link": "unlinked",
+                "mid": (key[1] + 0.5) * window,
+                "lm_median": median,
+                "lm_lower": lower,
+                "lm_upper": upper,
+                "nsnp": s.n,
+            }
+
+    for df in batches:
+        for part in df.partition_by("chrom", maintain_order=True):
+            c = part["chrom"][0]
+            if c != chrom:
+                yield from close()
+                if c in done:
+                    raise ValueError(f"input is not sorted by chrom ({c} twice)")
+                if chrom is not None:
+                    done.add(chrom)
+                chrom, last_pos = c, -1
+
+            pos = part["pos"].to_numpy()
+            if pos[0] < last_pos or np.any(np.diff(pos.astype(np.int64)) < 0):
+                raise ValueError(f"input is not sorted by position on {c}")
+            last_pos = pos[-1]
+
+            win = pos // window
+            # windows before this batch's first SNP can get no more values
+            yield from close(below=win[0])
+            groups = part.with_columns(pl.Series("win", win)).group_by(
+                "treatment", "win"
+            )
+            for (treatment, w), g in groups:
+                key = (treatment, int(w))
+                if key not in open_:
+                    open_[key] = QuantileSketch(**sketch)
+                open_[key].add(g["lm_effect"].to_numpy())
+    yield from close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sweep", choices=["trt", "post_trt"], default="trt")
+    parser.add_argument("--window", type=int, default=1_000_000)
+    parser.add_argument("--r2-max", type=float, default=0.01)
+    parser.add_argument("--z", type=float, default=1.96)
+    parser.add_argument("--exact", type=int, default=100_000)
+    parser.add_argument("--bins", type=int, default=2**16)
+    parser.add_argument("--batch-size", type=int, default=500_000)
+    parser.add_argument(
+        "--sites", default=table_path("sites_main", PROCESSED, "parquet")
+    )
+    parser.add_argument("--r2s", default=table_path("sweep_r2s", PROCESSED, "csv"))
+    parser.add_argument(
+        "--csv", action="store_true", help="also export the plot table as CSV"
+    )
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("stream_windows", args)
+
+    run.begin("windows")
+    batches = read_batches(args.sites, args.batch_size, args.sweep)
+    batches = only_unlinked(unique_sites(batches), args.r2s, args.r2_max)
+    rows = list(
+        window_summaries(
+            batches, args.window, args.z, exact=args.exact, bins=args.bins
+        )
+    )
+    run.end(rows=len(rows))
+
+    run.begin("write")
+    name = "windows_genome" if args.sweep == "trt" else "windows_post_genome"
+    write_table(pl.DataFrame(rows), name, csv=args.csv)
+    run.finish()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""Synthetic inputs for exercising the Figure4 pipeline without the Dryad data.
+
+Writes, under a working directory laid out like this one:
+
+    data/snptables/Orchard2021/inbredv2_withHets.orch2021.{chrom}.snpTable.numeric
+    data/raw/ace_haplotypes.csv
+    data/raw/sigsite_malathion.csv
+    data/processed/{afmat.npy, samps.csv, sites.csv}
+
+i.e. everything `02_process_snptables.py` onwards reads (the outputs of
+`01_process_data.R` are written directly). Ace-linked signal is planted on 3R
+around 9.07 Mb: inbred-line genotypes near Ace track the resistant (VGFA/VAYG)
+haplotypes with a linkage that decays with distance, and allele frequencies in
+the treated (P) cages follow the resistant allele up during treatment and back
+down afterwards.
+
+Stage 04 hard-codes 59 susceptible and 17 resistant (R/R) lines, so the
+default `--lines 76` matches it; other line counts keep the same proportion.
+
+    python synth.py /tmp/f4 --snps-per-arm 5000 --seed 1
+"""
+
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+from scipy.special import erfc
+
+ARMS = {
+    "2L": 23011544,
+    "2R": 21146708,
+    "3L": 24543557,
+    "3R": 27905053,
+    "X": 22422827,
+}
+ACE_CHROM = "3R"
+ACE_POS = 9069500
+HAPLOTYPES = ["IGFG", "VGFG", "VGFA", "VAYG"]
+
+# resistant (R2 + R3) allele frequency in treated cages at tpt 1..8: forward
+# sweep during treatment (2 -> 6) and partial reversal afterwards (6 -> 8)
+R_TREATED = np.array([0.25, 0.30, 0.40, 0.50, 0.60, 0.65, 0.55, 0.45])
+R_UNTREATED = np.full(8, 0.25)
+
+
+def add_arguments(parser):
+    parser.add_argument("--lines", type=int, default=76)
+    parser.add_argument("--snps-per-arm", type=int, default=2000)
+    parser.add_argument("--cages", type=int, default=10, help="cages per treatment")
+    parser.add_argument("--timepoints", type=int, default=8)
+    parser.add_argument(
+        "--linkage-scale",
+        type=float,
+        default=2e5,
+        help="distance (bp) over which linkage to Ace decays by 1/e",
+    )
+    parser.add_argument("--missing", type=float, default=0.07)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def ace_lines(n_lines, rng):
+    # R/R lines carry two resistant haplotypes, all others at least one
+    # susceptible haplotype
+    n_rr = round(n_lines * 17 / 76)
+    rr = rng.choice([2, 3], size=(n_rr, 2))
+    other = np.column_stack(
+        [rng.choice([0, 1], size=n_lines - n_rr), rng.choice(4, size=n_lines - n_rr)]
+    )
+    haps = rng.permutation(np.vstack([rr, other]))
+    ids = np.array([f"RAL-{i + 1:03d}" for i in range(n_lines)])
+    return ids, haps
+
+
+def linkage(chrom, pos, scale):
+    if chrom != ACE_CHROM:
+        return np.zeros(len(pos))
+    return np.exp(-np.abs(pos - ACE_POS) / scale)
+
+
+def genotypes(rho, phase, haps, missing, rng):
+    # each haplotype copy carries the allele in phase with Ace with prob. rho,
+    # otherwise an allele drawn at the site's background frequency
+    n_snps, n_lines = len(rho), haps.shape[0]
+    background = rng.beta(0.8, 0.8, size=n_snps)
+    resistant = haps >= 2
+    g = np.zeros((n_snps, n_lines))
+    for copy in range(2):
+        in_phase = np.where(phase[:, None] > 0, resistant[:, copy], ~resistant[:, copy])
+        linked = rng.random((n_snps, n_lines)) < rho[:, None]
+        drawn = rng.random((n_snps, n_lines)) < background[:, None]
+        g += np.where(linked, in_phase, drawn) / 2
+    g[rng.random(g.shape) < missing] = -1
+    return g
+
+
+def trajectories(rho, phase, p0, n_cages, n_tpts, rng):
+    # sites x (treatment, tpt, cage) in the order 01_process_data.R sorts samps
+    cols, samps = [], []
+    for treatment, r_traj in [("E", R_UNTREATED), ("P", R_TREATED)]:
+        r_traj = np.resize(r_traj, n_tpts)
+        for tpt in range(n_tpts):
+            for cage in range(1, n_cages + 1):
+                drift = rng.normal(0, 0.01 * np.sqrt(tpt + 1), size=len(rho))
+                shift = phase * rho * (r_traj[tpt] - r_traj[0])
+                cols.append(np.clip(p0 + shift + drift, 0, 1))
+                samps.append(
+                    {
+                        "sample": f"{treatment}{cage}_t{tpt + 1}",
+                        "treatment": treatment,
+                        "cage": cage,
+                        "tpt": tpt + 1,
+                        "biol.rep": "No",
+                        "tech.rep": "No",
+                    }
+                )
+    afmat = np.column_stack(cols)
+    samps = pl.DataFrame(samps).with_columns(
+        pl.int_range(1, len(samps) + 1).alias("freq_idx")
+    )
+    return afmat, samps
+
+
+def bh_adjust(p):
+    order = np.argsort(p)
+    ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+    adjusted = np.minimum.accumulate(ranked[::-1])[::-1]
+    out = np.empty_like(p)
+    out[order] = np.minimum(adjusted, 1)
+    return out
+
+
+def glm_table(sites, afmat, samps, rng):
+    # stand-in for glm/02_summarize_glm.R: per treatment and time range, the
+    # mean frequency change across cages plays the role of the GLM effect size
+    tpt = samps["tpt"].to_numpy()
+    treatment = samps["treatment"].to_numpy()
+    frames = []
+    for trt in ["E", "P"]:
+        for t1, t2 in [(1, 2), (2, 6), (6, 8)]:
+            f1 = afmat[:, (treatment == trt) & (tpt == t1)].mean(axis=1)
+            f2 = afmat[:, (treatment == trt) & (tpt == t2)].mean(axis=1)
+            effect = f2 - f1
+            lf1 = np.log((f1 + 1e-3) / (1 - f1 + 1e-3))
+            lf2 = np.log((f2 + 1e-3) / (1 - f2 + 1e-3))
+            se = np.abs(rng.normal(0.02, 0.005, size=len(effect))) + 1e-3
+            p = erfc(np.abs(effect) / se / np.sqrt(2))
+            p_adj = bh_adjust(p)
+            sig = np.select(
+                [
+                    (p_adj < 0.01) & (np.abs(effect) > 0.02),
+                    (p_adj < 0.05) & (np.abs(effect) > 0.02),
+                    p_adj < 0.2,
+                ],
+                [3, 2, 1],
+                0,
+            )
+            frames.append(
+                sites.select("chrom", "pos").with_columns(
+                    term=pl.lit("tpt"),
+                    estimate=(lf2 - lf1) / (t2 - t1),
+                    **{
+                        "std.error": se,
+                        "statistic": effect / se,
+                        "p.value": p,
+                        "p.value.adjusted": p_adj,
+                    },
+                    sigLevel=sig,
+                    freq1=f1,
+                    freq2=f2,
+                    effect_size=effect,
+                    treatment=pl.lit(1 if trt == "E" else 2),
+                    cage=pl.lit(trt),
+                    comparison=pl.lit(f"{t1}_{t2}"),
+                )
+            )
+    return pl.concat(frames)
+
+
+def generate(
+    root,
+    lines=76,
+    snps_per_arm=2000,
+    cages=10,
+    timepoints=8,
+    linkage_scale=2e5,
+    missing=0.07,
+    seed=0,
+):
+    if timepoints < 8:
+        raise ValueError("the pipeline uses timepoints 1..8")
+    rng = np.random.default_rng(seed)
+
+    snp_dir = os.path.join(root, "data/snptables/Orchard2021")
+    for d in [snp_dir, "data/raw", "data/processed", "plot_data", "reports"]:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    line_ids, haps = ace_lines(lines, rng)
+    pl.DataFrame(
+        {
+            "Inbred_Line_ID": line_ids,
+            "Haplotype.aa": [
+                f"{HAPLOTYPES[a]}.{HAPLOTYPES[b]}" for a, b in haps.tolist()
+            ],
+        }
+    ).write_csv(os.path.join(root, "data/raw/ace_haplotypes.csv"))
+
+    site_frames, rhos, phases, p0s = [], [], [], []
+    for chrom, length in ARMS.items():
+        pos = np.sort(rng.choice(length, size=snps_per_arm, replace=False) + 1)
+        if chrom == ACE_CHROM:
+            # densify the Ace neighbourhood so that linked sets are not empty
+            near = ACE_POS + rng.integers(-500_000, 500_000, size=snps_per_arm // 10)
+            pos = np.unique(np.concatenate([pos, near]))
+        rho = linkage(chrom, pos, linkage_scale)
+        phase = rng.choice([-1, 1], size=len(pos))
+        g = genotypes(rho, phase, haps, missing, rng)
+
+        # the snpTable.numeric layout: first column named after the arm
+        pl.DataFrame(
+            {chrom: pos, **{lid: g[:, i] for i, lid in enumerate(line_ids)}}
+        ).write_csv(
+            os.path.join(snp_dir, f"inbredv2_withHets.orch2021.{chrom}.snpTable.numeric")
+        )
+
+        called = np.where(g >= 0, g, np.nan)
+        p0 = np.clip(np.nanmean(called, axis=1), 0.02, 0.98)
+        site_frames.append(pl.DataFrame({"chrom": chrom, "pos": pos}))
+        rhos.append(rho)
+        phases.append(phase)
+        p0s.append(np.nan_to_num(p0, nan=0.5))
+
+    sites = pl.concat(site_frames).with_columns(
+        pl.int_range(1, pl.len() + 1).alias("site_idx")
+    )
+    afmat, samps = trajectories(
+        np.concatenate(rhos),
+        np.concatenate(phases),
+        np.concatenate(p0s),
+        cages,
+        timepoints,
+        rng,
+    )
+
+    sites.write_csv(os.path.join(root, "data/processed/sites.csv"))
+    samps.write_csv(os.path.join(root, "data/processed/samps.csv"))
+    np.save(os.path.join(root, "data/processed/afmat.npy"), afmat)
+    glm_table(sites, afmat, samps, rng).write_csv(
+        os.path.join(root, "data/raw/sigsite_malathion.csv")
+    )
+    return sites.shape[0], samps.shape[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("root", help="working directory to populate")
+    args = add_arguments(parser).parse_args()
+
+    n_sites, n_samps = generate(
+        args.root,
+        lines=args.lines,
+        snps_per_arm=args.snps_per_arm,
+        cages=args.cages,
+        timepoints=args.timepoints,
+        linkage_scale=args.linkage_scale,
+        missing=args.missing,
+        seed=args.seed,
+    )
+    print(f"wrote {n_sites} sites x {n_samps} samples to {args.root}")
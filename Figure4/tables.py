@@ -0,0 +1,335 @@
+"""Typed tables shared by the Figure4 stages and plot.Rmd.
+
+Plot tables are written as uncompressed Arrow IPC (Feather v2) files so that
+both polars (`pl.read_ipc`) and R (`arrow::read_feather(..., mmap = TRUE)`) can
+memory-map them. Every table has a fixed schema which is checked when it is
+written, so dtype drift in one stage fails in that stage instead of surfacing
+as a parse problem further down the pipeline.
+
+The schemas also carry the compact dtype policy used throughout the pipeline:
+chromosome arms and labels are Enums, positions uint32, frequencies and effects
+float32, significance levels int8. `conform` casts a frame to its schema, but
+only within a dtype family (labels to Enum, integer to integer, float to
+float); anything else, or a label outside an Enum, is an error.
+"""
+
+import os
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+PLOT_DATA = "plot_data"
+PROCESSED = "data/processed"
+
+CHROMS = ["2L", "2R", "3L", "3R", "X"]
+
+CHROM = pl.Enum(CHROMS)
+TREATMENT = pl.Enum(["E", "P"])
+SWEEP = pl.Enum(["trt", "post_trt"])
+LINK = pl.Enum(["linked", "unlinked"])
+POS = pl.UInt32
+CAGE = pl.UInt8
+FREQ = pl.Float32
+EFFECT = pl.Float32
+SIGNIFICANCE = pl.Int8
+
+# timepoints of each sweep; a site's trajectory starts at the first one
+SWEEP_TPTS = {"trt": [2, 3, 4, 5, 6], "post_trt": [6, 7, 8]}
+
+# (treatment, cage) pairs without data, left out of sites_main
+EMPTY_CAGES = [("E", 2)]
+
+# pandas equivalent for the stages that work on pandas frames
+PD_CHROM = pd.CategoricalDtype(CHROMS)
+
+SITES = {
+    "chrom": CHROM,
+    "pos": POS,
+    "treatment": TREATMENT,
+    "r2": pl.Float32,
+    "significance_level": SIGNIFICANCE,
+    "lm_slope": EFFECT,
+    "lm_effect": EFFECT,
+    "link": LINK,
+}
+
+WINDOWS = {
+    "treatment": TREATMENT,
+    "chrom": CHROM,
+    "link": LINK,
+    "mid": pl.Float64,
+    "lm_median": EFFECT,
+    "lm_lower": EFFECT,
+    "lm_upper": EFFECT,
+    "nsnp": pl.UInt32,
+}
+
+REVERSAL = {
+    "chrom": CHROM,
+    "pos": POS,
+    "link": LINK,
+    "treatment": TREATMENT,
+    "post_trt": EFFECT,
+    "trt": EFFECT,
+}
+
+REVERSAL_WINDOWS = {
+    "treatment": TREATMENT,
+    "chrom": CHROM,
+    "mid": pl.Float64,
+    "nsnp": pl.UInt32,
+    "trt_mean": EFFECT,
+    "post_trt_mean": EFFECT,
+    "score_mean": EFFECT,
+    "score_median": EFFECT,
+    "frac_reversed": pl.Float32,
+}
+
+JACKKNIFE_WINDOWS = {
+    "treatment": TREATMENT,
+    "sweep": SWEEP,
+    "chrom": CHROM,
+    "link": LINK,
+    "mid": pl.Float64,
+    "nsnp": pl.UInt32,
+    "cage": CAGE,
+    "freq0_median": FREQ,
+    "freq0_full": FREQ,
+    "freq0_se": FREQ,
+    "total_delta_median": FREQ,
+    "total_delta_full": FREQ,
+    "total_delta_se": FREQ,
+}
+
+MWU = {
+    "chrom": CHROM,
+    "bin": pl.Int16,
+    "binmid": pl.Float64,
+    "pval": pl.Float64,
+    "sweep": pl.Enum(["trt", "rev"]),
+}
+
+SCHEMAS = {
+    "sites": SITES,
+    "sites_post": SITES,
+    "windows": WINDOWS,
+    "windows_post": WINDOWS,
+    # genome-wide unlinked background, from stream_windows.py
+    "windows_genome": WINDOWS,
+    "windows_post_genome": WINDOWS,
+    "reversal": REVERSAL,
+    "reversal_windows": REVERSAL_WINDOWS,
+    "jackknife_windows": JACKKNIFE_WINDOWS,
+    "mwu": MWU,
+}
+
+# inter-stage tables under data/processed
+LM_SITES = {
+    "chrom": CHROM,
+    "pos": POS,
+    "treatment": TREATMENT,
+    "sweep": SWEEP,
+    "lm_slope": EFFECT,
+    "significance_level": SIGNIFICANCE,
+    "lm_effect": EFFECT,
+}
+
+# row order of sites_main.parquet
+SITES_MAIN_ORDER = ["chrom", "pos", "treatment", "cage", "sweep"]
+SITES_MAIN = {
+    "chrom": CHROM,
+    "pos": POS,
+    "treatment": TREATMENT,
+    "cage": CAGE,
+    "sweep": SWEEP,
+    "lm_slope": EFFECT,
+    "significance_level": SIGNIFICANCE,
+    "lm_effect": EFFECT,
+    "total_delta": FREQ,
+    "freq0": FREQ,
+}
+
+REVERSAL_GENOME = {
+    "chrom": CHROM,
+    "pos": POS,
+    "treatment": TREATMENT,
+    "trt": EFFECT,
+    "post_trt": EFFECT,
+    "score": EFFECT,
+}
+
+JACKKNIFE_SITES = {
+    "chrom": CHROM,
+    "pos": POS,
+    "treatment": TREATMENT,
+    "sweep": SWEEP,
+    "cage": CAGE,
+    "freq0": FREQ,
+    "total_delta": FREQ,
+}
+
+SWEEP_R2S = {
+    "chrom": CHROM,
+    "pos": POS,
+    "r": pl.Float32,
+    "r2": pl.Float32,
+}
+
+ACE_R2S = {
+    "chrom": CHROM,
+    "pos": POS,
+    "ace_allele": pl.Enum(["S", "R1", "R2", "R3"]),
+    "ace_linked": pl.Enum(["drop", "linked", "unlinked"]),
+    "r": pl.Float32,
+    "flip": pl.Enum(["no", "yes"]),
+    "threshold": pl.Float32,
+}
+
+
+def table_path(name, directory=PLOT_DATA, ext="arrow"):
+    return os.path.join(directory, f"{name}.{ext}")
+
+
+def _family(dtype):
+    if dtype == pl.String or isinstance(dtype, (pl.Enum, pl.Categorical)):
+        return "label"
+    if dtype.is_integer():
+        return "int"
+    if dtype.is_float():
+        return "float"
+    if isinstance(dtype, pl.List):
+        return ("list", _family(dtype.inner))
+    return str(dtype)
+
+
+def conform(df, schema, name="table"):
+    # accept pandas frames from the older stages, but never their index
+    if not isinstance(df, pl.DataFrame):
+        df = pl.from_pandas(df, include_index=False)
+
+    missing = [c for c in schema if c not in df.columns]
+    if missing:
+        raise ValueError(f"{name}: missing columns {missing}")
+
+    df = df.select(list(schema))
+    wrong = [
+        f"{c} is {df.schema[c]}, expected {dtype}"
+        for c, dtype in schema.items()
+        if _family(df.schema[c]) != _family(dtype)
+    ]
+    if wrong:
+        raise TypeError(f"{name}: schema mismatch ({'; '.join(wrong)})")
+
+    try:
+        return df.cast(schema, strict=True)
+    except pl.exceptions.InvalidOperationError as e:
+        raise TypeError(f"{name}: values do not fit the schema\n{e}") from None
+
+
+def wide_size(df):
+    # bytes the frame would take with Int64/Float64/String columns, i.e.
+    # without the compact policy; strings are counted as 16-byte views
+    n = df.height
+    total = 0
+    for c, dtype in df.schema.items():
+        if _family(dtype) == "label":
+            total += 16 * n
+        elif isinstance(dtype, pl.List):
+            total += 8 * n + 8 * (df[c].list.len().sum() or 0)
+        elif dtype == pl.Boolean:
+            total += n // 8 + 1
+        else:
+            total += 8 * n
+    return int(total)
+
+
+def measure(run, name, df):
+    # record the compact and the equivalent wide size of a frame in the report
+    if isinstance(df, pl.DataFrame):
+        nbytes, wide = int(df.estimated_size()), wide_size(df)
+    else:
+        usage = df.memory_usage(index=False, deep=True)
+        nbytes = int(usage.sum())
+        wide = sum(
+            int(df[c].astype(object).memory_usage(index=False, deep=True))
+            if isinstance(df[c].dtype, pd.CategoricalDtype)
+            else 8 * len(df) if df[c].dtype.kind in "biuf" else int(usage[c])
+            for c in df.columns
+        )
+    run.frame(name, rows=len(df), nbytes=nbytes, wide_bytes=wide)
+    return df
+
+
+def write_table(df, name, directory=PLOT_DATA, csv=False):
+    df = conform(df, SCHEMAS[name], name)
+    # uncompressed so that readers can memory-map the file
+    df.write_ipc(table_path(name, directory), compression="uncompressed")
+    if csv:
+        df.write_csv(table_path(name, directory, "csv"))
+    return df
+
+
+def read_table(name, directory=PLOT_DATA):
+    # polars memory-maps uncompressed IPC files by default
+    df = pl.read_ipc(table_path(name, directory))
+    return conform(df, SCHEMAS[name], name)
+
+
+def read_snptable_numeric(path):
+    # inbred-line SNP table for one arm: the first column is named after the
+    # arm and holds positions, the others are line genotypes (-1 = missing)
+    arm = pd.read_csv(path, nrows=0).columns[0]
+    dtype = defaultdict(lambda: np.float32, {arm: np.uint32})
+    df = pd.read_csv(path, dtype=dtype).rename(columns={arm: "pos"})
+    return df.assign(chrom=pd.Categorical([arm] * len(df), dtype=PD_CHROM))
+
+
+def read_snptable(path=os.path.join(PROCESSED, "snptable.csv")):
+    # genotypes are 0 / 0.5 / 1 / NaN, which float32 holds exactly
+    dtype = defaultdict(lambda: np.float32, pos=np.uint32, chrom=PD_CHROM)
+    return pd.read_csv(path, dtype=dtype)
+
+
+def scan_lm_sites(path="data/raw/sigsite_malathion.csv"):
+    # GLM effects from glm/02_summarize_glm.R, renamed to the pipeline's terms
+    return (
+        pl.scan_csv(path)
+        .drop(["treatment"])
+        .rename(
+            {
+                "comparison": "sweep",
+                "cage": "treatment",
+                "estimate": "lm_slope",
+                "sigLevel": "significance_level",
+                "effect_size": "lm_effect",
+            }
+        )
+        .filter([pl.col("sweep") != "1_2"])
+        .with_columns(
+            [
+                pl.col("sweep").replace({"2_6": "trt", "6_8": "post_trt"}),
+            ]
+        )
+        .select(list(LM_SITES))
+        .cast(LM_SITES, strict=True)
+    )
+
+
+def drop_empty_cages(df):
+    """Rows of a polars frame outside EMPTY_CAGES"""
+    for treatment, cage in EMPTY_CAGES:
+        df = df.filter(~((pl.col("treatment") == treatment) & (pl.col("cage") == cage)))
+    return df
+
+
+def write_sites_main(df, path=os.path.join(PROCESSED, "sites_main.parquet")):
+    # readers such as stream_windows.py rely on (chrom, pos) order
+    df = conform(df, SITES_MAIN, "sites_main").sort(SITES_MAIN_ORDER)
+    df.write_parquet(path)
+    return df
+
+
+def read_sites_main(path=os.path.join(PROCESSED, "sites_main.parquet")):
+    return conform(pl.read_parquet(path), SITES_MAIN, "sites_main")
@@ -0,0 +1,60 @@
+"""Stages 02-06 on a small synthetic data set, checked against tables.py.
+
+    python -m pytest Figure4/test_pipeline.py
+"""
+
+import os
+
+import polars as pl
+import pytest
+
+import synth
+from bench import run_stage
+from tables import (
+    ACE_R2S,
+    PLOT_DATA,
+    PROCESSED,
+    SCHEMAS,
+    SITES_MAIN,
+    SITES_MAIN_ORDER,
+    read_table,
+)
+
+# plot tables written by each stage
+OUTPUTS = {
+    "04a": ["sites"],
+    "04b": ["sites_post"],
+    "05": ["windows", "windows_post", "reversal"],
+    "06": ["mwu"],
+}
+
+
+@pytest.fixture(scope="module")
+def workdir(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("figure4"))
+    synth.generate(root, snps_per_arm=500, seed=1)
+    report_dir = os.path.join(root, "reports")
+    for stage in ["02", "03", "04a", "04b", "05", "06"]:
+        extra = ["--replicates", "50", "--seed", "1"] if stage == "05" else []
+        record = run_stage(stage, root, report_dir, extra)
+        assert record["returncode"] == 0, record.get("stderr")
+    return root
+
+
+@pytest.mark.parametrize("name", [n for names in OUTPUTS.values() for n in names])
+def test_plot_table_schema(workdir, name):
+    df = read_table(name, os.path.join(workdir, PLOT_DATA))
+    assert df.schema == pl.Schema(SCHEMAS[name])
+    assert df.height > 0
+
+
+def test_sites_main(workdir):
+    main = pl.read_parquet(os.path.join(workdir, PROCESSED, "sites_main.parquet"))
+    assert main.schema == pl.Schema(SITES_MAIN)
+    assert main.height > 0
+    assert main.equals(main.sort(SITES_MAIN_ORDER))
+
+
+def test_ace_r2s(workdir):
+    ace = pl.read_parquet(os.path.join(workdir, PROCESSED, "ace_r2s.parquet"))
+    assert ace.schema == pl.Schema(ACE_R2S)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""Incremental updates of sites_main.parquet when samples are added.
+
+`03_process_sites.py` derives, for every site and (treatment, cage, sweep),
+the starting frequency `freq0` and the change `total_delta` between the
+first and last sample of the sweep (SWEEP_TPTS). Both depend only on those
+two samples, so when new sample columns arrive only groups whose first or
+last sample changed need updating, and only the new columns need reading:
+
+    python update_sites.py init        # afmat + samps.csv -> column store
+    python update_sites.py append new_afmat.npy new_samps.csv
+
+`init` copies the current afmat into an append-only `ColumnStore`
+(afstore.py). `append` adds the new columns (sites x samples, rows aligned
+with sites.csv; samps with treatment, cage and tpt) as a new chunk, then
+recomputes freq0/total_delta for the affected groups from the new columns
+and the values already in sites_main, adds rows for groups that did not
+exist before, and rewrites sites_main.parquet in (chrom, pos) order.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+
+from afstore import ColumnStore, open_afmat
+from instrument import Run, add_arguments
+from tables import (
+    CAGE,
+    CHROM,
+    PROCESSED,
+    SWEEP,
+    SWEEP_TPTS,
+    TREATMENT,
+    drop_empty_cages,
+    read_sites_main,
+    scan_lm_sites,
+    write_sites_main,
+)
+
+STORE = os.path.join(PROCESSED, "afstore")
+GROUP = ["treatment", "cage", "sweep"]
+KEYS = ["chrom", "pos", "treatment", "cage", "sweep"]
+
+
+def read_samps(path):
+    return (
+        pl.read_csv(path)
+        .select("treatment", "cage", "tpt")
+        .cast({"treatment": TREATMENT, "cage": CAGE, "tpt": pl.Int8})
+    )
+
+
+def read_sites(path=os.path.join(PROCESSED, "sites.csv")):
+    # afmat row (0-based site_idx) of every site, in file order
+    return (
+        pl.read_csv(path)
+        .drop_nulls()
+        .select("chrom", "pos", "site_idx")
+        .cast({"chrom": CHROM, "pos": pl.UInt32, "site_idx": pl.UInt32})
+        .with_columns(pl.col("site_idx").sub(1))
+    )
+
+
+def sweep_endpoints(samps):
+    """First and last freq_idx of each (treatment, cage, sweep)"""
+    # cages that 03 leaves out get no groups here either
+    samps = drop_empty_cages(samps)
+    frames = []
+    for sweep, tpts in SWEEP_TPTS.items():
+        frames.append(
+            samps.filter(pl.col("tpt").is_in(tpts))
+            .sort("tpt", "freq_idx")
+            .group_by("treatment", "cage")
+            .agg(
+                pl.col("tpt").first().alias("tpt0"),
+                pl.col("freq_idx").first().alias("first"),
+                pl.col("freq_idx").last().alias("last"),
+            )
+            # as in 03, a group starts at the sweep's first timepoint
+            .filter(pl.col("tpt0") == tpts[0])
+            .drop("tpt0")
+            .with_columns(pl.lit(sweep, dtype=SWEEP).alias("sweep"))
+        )
+    return pl.concat(frames).select(GROUP + ["first", "last"])
+
+
+def affected_groups(before, after):
+    # groups whose first or last sample changed, and groups that are new
+    d = after.join(before, on=GROUP, how="left", suffix="_old")
+    changed = d.filter(
+        pl.col("first_old").is_not_null()
+        & (
+            (pl.col("first") != pl.col("first_old"))
+            | (pl.col("last") != pl.col("last_old"))
+        )
+    )
+    new = d.filter(pl.col("first_old").is_null())
+    return changed, new
+
+
+def update_group(main, sites, store, g):
+    # new freq0/total_delta for an existing group from its changed endpoints
+    rows = main.filter(
+        (pl.col("treatment") == g["treatment"])
+        & (pl.col("cage") == g["cage"])
+        & (pl.col("sweep") == g["sweep"])
+    ).join(sites, on=["chrom", "pos"])
+    idx = rows["site_idx"].to_numpy()
+    freq0 = rows["freq0"].to_numpy()
+    last = freq0 + rows["total_delta"].to_numpy()
+    if g["first"] != g["first_old"]:
+        freq0 = store.columns([g["first"]])[idx, 0]
+    if g["last"] != g["last_old"]:
+        last = store.columns([g["last"]])[idx, 0]
+    return rows.select(KEYS).with_columns(
+        pl.Series("freq0", freq0, dtype=pl.Float32),
+        pl.Series("total_delta", last - freq0, dtype=pl.Float32),
+    )
+
+
+def new_group(sites, store, lm_sites, g):
+    # rows for a group with no rows yet, built as in 03
+    first, last = store.columns([g["first"], g["last"]]).T
+    idx = sites["site_idx"].to_numpy()
+    return (
+        sites.with_columns(
+            pl.lit(g["treatment"], dtype=TREATMENT).alias("treatment"),
+            pl.lit(g["cage"], dtype=CAGE).alias("cage"),
+            pl.lit(g["sweep"], dtype=SWEEP).alias("sweep"),
+            pl.Series("freq0", first[idx], dtype=pl.Float32),
+            pl.Series("total_delta", last[idx] - first[idx], dtype=pl.Float32),
+        )
+        .join(lm_sites, on=["chrom", "pos", "treatment", "sweep"])
+        .drop_nulls()
+    )
+
+
+def update_sites_main(main, sites, store, before, after):
+    changed, new = affected_groups(before, after)
+    updates = [
+        update_group(main, sites, store, g) for g in changed.iter_rows(named=True)
+    ]
+    if updates:
+        main = main.update(pl.concat(updates), on=KEYS)
+    if new.height:
+        lm_sites = scan_lm_sites().collect()
+        added = [
+            new_group(sites, store, lm_sites, g) for g in new.iter_rows(named=True)
+        ]
+        # write_sites_main restores the (chrom, pos) order
+        main = pl.concat([main, *(a.select(main.columns) for a in added)])
+    return main, changed.height, new.height
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("command", choices=["init", "append"])
+    parser.add_argument("freqs", nargs="?", help="new columns, sites x samples .npy")
+    parser.add_argument("samps", nargs="?", help="CSV with treatment, cage, tpt")
+    parser.add_argument("--store", default=STORE)
+    args = add_arguments(parser).parse_args()
+    run = Run.from_args("update_sites", args)
+
+    if args.command == "init":
+        run.begin("init")
+        afmat = open_afmat()
+        samps = read_samps(os.path.join(PROCESSED, "samps.csv"))
+        store = ColumnStore.create(args.store, afmat, samps)
+        run.end(rows=store.n_samples)
+        run.finish()
+        raise SystemExit
+
+    run.begin("append")
+    store = ColumnStore(args.store)
+    before = sweep_endpoints(store.samps())
+    freqs = np.load(args.freqs, mmap_mode="r")
+    new_cols = store.append(freqs, read_samps(args.samps))
+    after = sweep_endpoints(store.samps())
+    run.end(rows=len(new_cols))
+
+    run.begin("update")
+    main, n_changed, n_new = update_sites_main(
+        read_sites_main(), read_sites(), store, before, after
+    )
+    run.end(rows=main.height)
+    print(f"{len(new_cols)} samples added: {n_changed} groups updated, {n_new} new")
+
+    run.begin("write")
+    write_sites_main(main)
+    run.finish()